@@ -0,0 +1,683 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the game server hot paths. Runs against fake_firestore, no Firebase needed.
+
+Usage:
+    python bench.py tick --players 300 --ticks 0,100
+    python bench.py tick --players 300 --json tick.json
+    python bench.py metrics --budget-us 5
+    python bench.py codec
+    python bench.py wire --players 30 --questions 10
+    python bench.py timers --lobbies 5000
+    python bench.py memory --players 1000 --questions 30
+    python bench.py actor --players 300 --batches 1,16
+    python bench.py limits --flood 10000
+    python bench.py reaper --lobbies 100 --players 30
+    python bench.py homework --students 200 --questions 20
+"""
+
+import argparse
+import asyncio
+import gc
+import datetime
+import json
+import random
+import sys
+import time
+import tracemalloc
+import zlib
+
+import fake_firestore
+import httpx
+
+fake_firestore.install()
+import main  # noqa: E402  (must come after install())
+
+
+class CountingSocket:
+    """Stands in for a WebSocket and only counts what would have been sent."""
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    async def send_text(self, data):
+        self.frames += 1
+        self.bytes += len(data.encode())
+
+    async def send_bytes(self, data):
+        self.frames += 1
+        self.bytes += len(data)
+
+    async def close(self, code=1000):
+        pass
+
+
+class RecordingSocket(CountingSocket):
+    """CountingSocket that also keeps every frame."""
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    async def send_text(self, data):
+        await super().send_text(data)
+        self.sent.append(data)
+
+
+def make_quiz(questions=10, options=4):
+    return {
+        "title": "Benchmark quiz",
+        "questions": [
+            {
+                "question": f"Question {i}: which option is the right one?",
+                "type": "single",
+                "options": [f"Option {j} for question {i}" for j in range(options)],
+                "correct": random.randrange(options),
+                "timeLimit": 60,
+                "point": 1,
+                "explanation": "Because the benchmark says so.",
+            }
+            for i in range(questions)
+        ],
+    }
+
+
+async def make_lobby(players, game_type=None, quiz=None, socket=CountingSocket):
+    main.db.seed("games/bench-game", {"host": "bench-host", "players": [], "active": True})
+    host = main.User(socket(), "bench-host", {"name": "Bench", "lastName": "Host", "isTeacher": True})
+    lobby = main.Lobby(host, quiz or make_quiz(), "bench-game", "BENCH1", game_type or {})
+    users = []
+    for i in range(players):
+        user = main.User(socket(), f"bench-player-{i}", {"name": "Player", "lastName": str(i), "isTeacher": False})
+        await lobby.connect(user)
+        users.append(user)
+    lobby.flush_joins()
+    return lobby, host, users
+
+
+async def drain(users):
+    await asyncio.gather(*(user.flush(timeout=30) for user in users))
+
+
+def reset_counters(users):
+    for user in users:
+        user.ws_id.frames = 0
+        user.ws_id.bytes = 0
+
+
+async def bench_tick_round(players, tick_ms, spread):
+    """One question where every player answers within `spread` seconds."""
+    lobby, host, users = await make_lobby(players, {"tick_ms": tick_ms})
+    await lobby.start_game()
+    await drain([host] + users)
+    reset_counters([host] + users)
+
+    cpu_started = time.process_time()
+    for user in users:
+        await lobby.save_answer(user, random.randrange(4))
+        await asyncio.sleep(spread / players)
+    await drain([host] + users)
+    cpu = time.process_time() - cpu_started
+
+    result = {
+        "tick_ms": tick_ms,
+        "players": players,
+        "player_frames": sum(user.ws_id.frames for user in users),
+        "host_frames": host.ws_id.frames,
+        "bytes": sum(user.ws_id.bytes for user in [host] + users),
+        "cpu_ms": round(cpu * 1000, 1),
+    }
+    for user in [host] + users:
+        user.stop()
+    return result
+
+
+async def run_tick(args):
+    results = []
+    for tick_ms in args.ticks:
+        results.append(await bench_tick_round(args.players, tick_ms, args.spread))
+    print(f"{'tick_ms':>8} {'player frames':>14} {'host frames':>12} {'MB sent':>8} {'CPU ms':>8}")
+    for r in results:
+        print(f"{r['tick_ms']:>8} {r['player_frames']:>14} {r['host_frames']:>12} {r['bytes'] / 1e6:>8.2f} {r['cpu_ms']:>8}")
+    return results
+
+
+async def run_metrics(args):
+    """Per-message cost of the instrumentation: message counter plus one timed handler call."""
+    message = {"answer": 1}
+
+    async def handler():
+        pass
+
+    timed_handler = main.timed("bench")(handler)
+
+    async def plain():
+        for _ in range(args.messages):
+            await handler()
+
+    async def instrumented():
+        for _ in range(args.messages):
+            main.MESSAGES_RECEIVED.inc(main.message_kind(message))
+            await timed_handler()
+
+    timings = {}
+    for name, fn in (("plain", plain), ("instrumented", instrumented)):
+        best = None
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            await fn()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+    overhead_us = (timings["instrumented"] - timings["plain"]) / args.messages * 1e6
+    started = time.perf_counter()
+    main.METRICS.render()
+    render_ms = (time.perf_counter() - started) * 1000
+    ok = overhead_us <= args.budget_us
+    print(f"instrumentation overhead: {overhead_us:.2f} us/message (budget {args.budget_us} us) {'OK' if ok else 'OVER BUDGET'}")
+    print(f"/metrics render: {render_ms:.2f} ms")
+    if not ok:
+        raise SystemExit(1)
+    return {"overhead_us": round(overhead_us, 3), "budget_us": args.budget_us, "render_ms": round(render_ms, 3)}
+
+
+# What every message went through before the dispatch table: one check per branch, all of them
+LEGACY_BRANCHES = ("quiz", "code", "start", "next", "show_results", "players_snapshot", "answer", "report")
+
+
+def legacy_dispatch(data):
+    message = json.loads(data)
+    return [key for key in LEGACY_BRANCHES if key in message]
+
+
+def table_dispatch(codec, data, user_obj):
+    message = codec.decode(data)
+    spec = main.MESSAGE_HANDLERS.get(main.message_kind(message))
+    return spec.validate(user_obj, message)
+
+
+def rate(fn, items, seconds):
+    """Calls per second of fn over items, measured for roughly `seconds`."""
+    done = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        for item in items:
+            fn(item)
+        done += len(items)
+    return done / (time.perf_counter() - started)
+
+
+async def run_codec(args):
+    lobby, host, users = await make_lobby(args.players)
+    for user in users:
+        lobby.score_board[user.user_id][1] = random.randrange(1000)
+    inbound = [json.dumps(m) for m in ({"answer": 2}, {"report": "switched_tabs"}, {"type": "answer", "answer": 1}, {"answer": [0, 2]})]
+    lobby.current_question = 0
+    outbound = [lobby.question_payload(), {"type": "scoreboard", "top": lobby.top_scores()}, {"answers": 12}]
+    user_obj = {"auth": True, "user": users[0], "lobby": lobby}
+    codecs = [main.JSONCodec()] + ([main.OrjsonCodec()] if main.orjson else [])
+
+    results = [{
+        "codec": "legacy (if-chain + json)",
+        "inbound_per_sec": round(rate(legacy_dispatch, inbound, args.seconds)),
+        "outbound_per_sec": round(rate(json.dumps, outbound, args.seconds)),
+        "host_scoreboard_per_sec": round(rate(json.dumps, [lobby.score_board], args.seconds)),
+    }]
+    for codec in codecs:
+        results.append({
+            "codec": f"table + {codec.name}",
+            "inbound_per_sec": round(rate(lambda data: table_dispatch(codec, data, user_obj), inbound, args.seconds)),
+            "outbound_per_sec": round(rate(codec.encode, outbound, args.seconds)),
+            "host_scoreboard_per_sec": round(rate(codec.encode, [lobby.score_board], args.seconds)),
+        })
+    for user in [host] + users:
+        user.stop()
+
+    print(f"{'':<26} {'inbound msg/s':>14} {'outbound frames/s':>18} {f'{args.players}-player board/s':>20}")
+    for r in results:
+        print(f"{r['codec']:<26} {r['inbound_per_sec']:>14} {r['outbound_per_sec']:>18} {r['host_scoreboard_per_sec']:>20}")
+    return results
+
+
+async def record_game(players, questions):
+    """Play a whole game and return the text frames each connection received."""
+    lobby, host, users = await make_lobby(players, quiz=make_quiz(questions), socket=RecordingSocket)
+    for question in range(questions):
+        if question == 0:
+            await lobby.start_game()
+        else:
+            await lobby.start_next_round()
+        for user in users:
+            await lobby.save_answer(user, random.randrange(4))  # The last answer finishes the round
+    await lobby.finish_game()
+    await lobby.persist_task
+    await drain([host] + users)
+    for user in [host] + users:
+        user.stop()
+    return [user.ws_id.sent for user in [host] + users]
+
+
+def deflated_size(frames, window_bits, level, mem_level):
+    """Bytes on the wire with permessage-deflate and context takeover, as one connection sends them."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -window_bits, mem_level)
+    total = 0
+    for frame in frames:
+        data = compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        total += len(data) - 4  # The empty-block tail is stripped from every message
+    return total
+
+
+async def run_wire(args):
+    connections = await record_game(args.players, args.questions)
+    formats = {"json": lambda frame: frame.encode()}
+    if main.msgpack is not None:
+        formats["msgpack"] = lambda frame: main.msgpack.packb(main.decode(frame))
+    frames = sum(len(sent) for sent in connections)
+
+    results = []
+    for name, encode in formats.items():
+        encoded = [[encode(frame) for frame in sent] for sent in connections]
+        results.append({"format": name, "deflate": None, "bytes": sum(len(frame) for sent in encoded for frame in sent)})
+        for window_bits, level, mem_level in args.deflate:
+            results.append({
+                "format": name,
+                "deflate": {"window_bits": window_bits, "level": level, "mem_level": mem_level},
+                "bytes": sum(deflated_size(sent, window_bits, level, mem_level) for sent in encoded),
+            })
+
+    baseline = results[0]["bytes"]
+    print(f"one game: {args.players} players, {args.questions} questions, {frames} frames")
+    print(f"{'format':<10} {'deflate (window/level/mem)':<28} {'KB':>10} {'vs json':>9}")
+    for r in results:
+        deflate = "off" if r["deflate"] is None else "{window_bits}/{level}/{mem_level}".format(**r["deflate"])
+        print(f"{r['format']:<10} {deflate:<28} {r['bytes'] / 1024:>10.1f} {r['bytes'] / baseline * 100:>8.0f}%")
+    return results
+
+
+async def bench_round_timers(lobbies, style):
+    """Arm one 60 s question timer per lobby, then end every round early, as when everyone answers."""
+    tracemalloc.start()
+    started = time.perf_counter()
+    if style == "sleeping tasks":
+        # What start_game used to do: a task per question that sleeps out the time limit
+        timers = [asyncio.create_task(asyncio.sleep(60)) for _ in range(lobbies)]
+        await asyncio.sleep(0)
+    else:
+        timers = [main.round_timers.schedule(60_000, lambda: None) for _ in range(lobbies)]
+        await asyncio.sleep(0)
+    armed = time.perf_counter() - started
+    memory = tracemalloc.get_traced_memory()[0]
+    tasks = len(asyncio.all_tasks()) - 1
+    for timer in timers:
+        timer.cancel()
+    await asyncio.sleep(0)
+    tracemalloc.stop()
+    return {
+        "style": style,
+        "lobbies": lobbies,
+        "tasks": tasks,
+        "kb": round(memory / 1024, 1),
+        "arm_ms": round(armed * 1000, 2),
+    }
+
+
+async def run_timers(args):
+    results = [await bench_round_timers(args.lobbies, style) for style in ("sleeping tasks", "scheduler")]
+    print(f"{'':<16} {'tasks':>8} {'KB':>10} {'arm ms':>9}")
+    for r in results:
+        print(f"{r['style']:<16} {r['tasks']:>8} {r['kb']:>10} {r['arm_ms']:>9}")
+    print(f"pending after early finish: {len(main.round_timers)}")
+    return results
+
+
+def columns_size(columns):
+    """Bytes held by an AnswerColumns: the arrays, the spill-over dicts and the row index."""
+    size = sys.getsizeof(columns.rows) + sys.getsizeof(columns.questions)
+    for question in columns.questions:
+        size += sys.getsizeof(question) + sum(sys.getsizeof(column) for column in question[1:])
+    return size
+
+
+def dict_object_size(obj):
+    """What obj would take as a plain __dict__ instance with the same attributes."""
+    plain = type("Plain", (), {})()
+    plain.__dict__.update({name: getattr(obj, name) for name in type(obj).__slots__})
+    return sys.getsizeof(plain) + sys.getsizeof(plain.__dict__)
+
+
+async def run_memory(args):
+    quiz = make_quiz(args.questions)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    lobby, host, users = await make_lobby(args.players, quiz=quiz)
+    for question in range(args.questions):
+        if question == 0:
+            await lobby.start_game()
+        else:
+            await lobby.start_next_round()
+        for user in users[:int(len(users) * args.answered)]:
+            await lobby.save_answer(user, random.randrange(4))
+        if lobby.currently_round:
+            await lobby.finish_round()
+    await drain([host] + users)
+    game_state = tracemalloc.get_traced_memory()[0] - before
+
+    # The old layout: a full record dict per player per question, kept for the whole game
+    started = tracemalloc.get_traced_memory()[0]
+    records = {user.user_id: lobby.answer_columns.records(user.user_id, quiz["questions"], lobby.graders) for user in users}
+    records_size = tracemalloc.get_traced_memory()[0] - started
+    tracemalloc.stop()
+
+    per_1000 = 1000 / args.players
+    result = {
+        "players": args.players,
+        "questions": args.questions,
+        "answers": sum(len(r) for r in records.values()),
+        "answer_records_kb_per_1000": round(records_size * per_1000 / 1024, 1),
+        "answer_columns_kb_per_1000": round(columns_size(lobby.answer_columns) * per_1000 / 1024, 1),
+        "lobby_state_kb_per_1000": round(game_state * per_1000 / 1024, 1),
+        "user_bytes": {"slots": sys.getsizeof(users[0]), "dict": dict_object_size(users[0])},
+        "lobby_bytes": {"slots": sys.getsizeof(lobby), "dict": dict_object_size(lobby)},
+    }
+    for user in [host] + users:
+        user.stop()
+
+    print(f"{args.players} players x {args.questions} questions, {result['answers']} answer records")
+    print(f"answer history per 1000 players: {result['answer_records_kb_per_1000']} KB as record dicts, "
+          f"{result['answer_columns_kb_per_1000']} KB as columns")
+    print(f"whole lobby after the last round, per 1000 players: {result['lobby_state_kb_per_1000']} KB (includes send queues and writer tasks)")
+    print(f"User object: {result['user_bytes']['slots']} bytes with __slots__, {result['user_bytes']['dict']} with __dict__")
+    print(f"Lobby object: {result['lobby_bytes']['slots']} bytes with __slots__, {result['lobby_bytes']['dict']} with __dict__")
+    return result
+
+
+async def bench_actor_round(players, batch, tick_ms):
+    """One question where every player's answer arrives at once and goes through the lobby actor."""
+    main.LOBBY_BATCH_SIZE = batch
+    lobby, host, users = await make_lobby(players, {"tick_ms": tick_ms})
+    await lobby.start_game()
+    await drain([host] + users)
+    reset_counters([host] + users)
+
+    depth = 0
+
+    async def answer(user):
+        nonlocal depth
+        depth = max(depth, len(lobby.actor))
+        await lobby.actor.call(lobby.save_answer, user, random.randrange(4))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(answer(user) for user in users))
+    elapsed = time.perf_counter() - started
+    await drain([host] + users)
+    result = {
+        "batch": batch,
+        "tick_ms": tick_ms,
+        "players": players,
+        "answers_per_sec": round(players / elapsed),
+        "max_depth": depth,
+        "frames": sum(user.ws_id.frames for user in [host] + users),
+    }
+    for user in [host] + users:
+        user.stop()
+    return result
+
+
+async def run_actor(args):
+    results = [await bench_actor_round(args.players, batch, args.tick_ms) for batch in args.batches]
+    print(f"{'batch':>6} {'answers/s':>10} {'max depth':>10} {'frames':>8}")
+    for r in results:
+        print(f"{r['batch']:>6} {r['answers_per_sec']:>10} {r['max_depth']:>10} {r['frames']:>8}")
+    return results
+
+
+async def bench_flood(players, flood, limited):
+    """One tab in a tab_tracking lobby sends `flood` tab-switch reports and answers as fast as it can."""
+    saved = main.RATE_LIMITS, main.REPORT_COALESCE_MS
+    if not limited:
+        main.RATE_LIMITS = {"normal": {"*": (1e9, 1e9)}}
+        main.REPORT_COALESCE_MS = 0
+    lobby, host, users = await make_lobby(players, {"mode": "tab_tracking", "tick_ms": 100})
+    await lobby.start_game()
+    await drain([host] + users)
+    reset_counters([host] + users)
+
+    flooder = users[0]
+    user_obj = {"auth": True, "user": flooder, "lobby": lobby, "limiter": main.RateLimiter()}
+    admitted = 0
+    started = time.perf_counter()
+    for i in range(flood):
+        message = {"report": "switched_tabs"} if i % 2 else {"answer": random.randrange(4)}
+        kind = main.message_kind(message)
+        if await main.admit(flooder.ws_id, user_obj, kind):
+            admitted += 1
+            await main.handle_message(flooder.ws_id, user_obj, message, kind)
+    elapsed = time.perf_counter() - started
+    await drain([host] + users)
+    main.RATE_LIMITS, main.REPORT_COALESCE_MS = saved
+
+    result = {
+        "limited": limited,
+        "flood": flood,
+        "admitted": admitted,
+        "tab_switches": lobby.tab_switches[flooder.user_id],
+        "host_frames": host.ws_id.frames,
+        "flooder_frames": flooder.ws_id.frames,
+        "ms": round(elapsed * 1000, 1),
+    }
+    for user in [host] + users:
+        user.stop()
+    return result
+
+
+async def run_limits(args):
+    limiter = main.RateLimiter()
+    started = time.perf_counter()
+    for _ in range(args.flood):
+        limiter.allow("answer")
+    allow_us = (time.perf_counter() - started) / args.flood * 1e6
+
+    results = [await bench_flood(args.players, args.flood, limited) for limited in (False, True)]
+    print(f"{'limits':<8} {'admitted':>9} {'counted switches':>17} {'host frames':>12} {'flooder frames':>15} {'ms':>8}")
+    for r in results:
+        print(f"{'on' if r['limited'] else 'off':<8} {r['admitted']:>9} {r['tab_switches']:>17} {r['host_frames']:>12} "
+              f"{r['flooder_frames']:>15} {r['ms']:>8}")
+    print(f"RateLimiter.allow: {allow_us:.2f} us per message")
+    return {"allow_us": round(allow_us, 3), "flood": results}
+
+
+async def run_reaper(args):
+    """Finish games, sweep them out and compare the reaper's estimate with what tracemalloc saw freed."""
+    tracemalloc.start()
+    connections = []
+    for i in range(args.lobbies):
+        main.db.seed(f"games/reap-{i}", {"host": "bench-host", "players": [], "active": True})
+        lobby, host, users = await make_lobby(args.players, quiz=make_quiz(args.questions))
+        main.LOBBIES.remove(lobby)
+        lobby.game_id, lobby.code = f"reap-{i}", f"R{i:05d}"
+        main.LOBBIES.add(lobby)
+        await lobby.start_game()
+        for question in range(args.questions):
+            if question:
+                await lobby.start_next_round()
+            for user in users:
+                await lobby.save_answer(user, random.randrange(4))
+        await lobby.finish_game()
+        await lobby.persist_task
+        await drain([host] + users)
+        connections += [host] + users
+    lobbies = len(main.LOBBIES)
+
+    main.FINISHED_LOBBY_TTL = 0
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    swept = await main.sweep()
+    elapsed = time.perf_counter() - started
+    del lobby, host, users
+    gc.collect()  # Lobbies and their actors point at each other
+    freed = before - tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    for user in connections:
+        user.stop()
+
+    result = {
+        "lobbies": lobbies,
+        "evicted": swept["evicted"],
+        "estimated_kb": round(swept["reclaimed_bytes"] / 1024, 1),
+        "freed_kb": round(freed / 1024, 1),
+        "sweep_ms": round(elapsed * 1000, 1),
+    }
+    print(f"{result['evicted']} of {lobbies} finished lobbies evicted in {result['sweep_ms']} ms")
+    print(f"reported reclaimed: {result['estimated_kb']} KB, actually freed (tracemalloc): {result['freed_kb']} KB")
+    return result
+
+
+def token_issuer():
+    """Sign Firebase-style ID tokens with a throwaway key that main's verifier is made to trust."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from google.auth import crypt, jwt
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    public_pem = key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+    main.token_verifier.certs = {"bench": public_pem.decode()}
+    main.token_verifier.certs_expire = float("inf")
+    signer = crypt.RSASigner.from_string(private_pem, key_id="bench")
+    project = main.token_verifier.project_id
+
+    def issue(uid):
+        now = int(time.time())
+        claims = {"iss": f"https://securetoken.google.com/{project}", "aud": project, "sub": uid, "iat": now, "exp": now + 3600}
+        return jwt.encode(signer, claims).decode()
+    return issue
+
+
+async def run_homework(args):
+    """Submit a class's homework through the endpoint, then compare the two ways a teacher's view can load it."""
+    quiz = make_quiz(args.questions)
+    for i, question in enumerate(quiz["questions"]):
+        main.db.seed(f"questions/bench-hw-q{i}", question)
+    main.db.seed("quizes/bench-hw-quiz", {"title": quiz["title"], "questions": [f"bench-hw-q{i}" for i in range(args.questions)]})
+    deadline = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
+    students = [f"bench-student-{i}" for i in range(args.students)]
+    main.db.seed("groups/bench-group", {"name": "Bench", "students": students})
+    main.db.seed("homework/bench-hw", {"quiz_id": "bench-hw-quiz", "group_id": "bench-group", "teacher_id": "bench-teacher",
+                                       "deadline": deadline, "time_limit_minutes": 30})
+    for student in students:
+        main.db.seed(f"users/{student}", {"name": "Student", "lastName": student, "isTeacher": False})
+    issue = token_issuer()
+    tokens = {uid: {"Authorization": f"Bearer {issue(uid)}"} for uid in students + ["bench-teacher"]}
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        started = time.perf_counter()
+        responses = await asyncio.gather(*(
+            client.post("/homework/bench-hw/submissions", headers=tokens[student], json={
+                "answers": [[random.randrange(4)] for _ in range(args.questions)],
+                "status": "cheated" if i % 20 == 0 else "completed",
+            })
+            for i, student in enumerate(students)
+        ))
+        submit_elapsed = time.perf_counter() - started
+        duplicate = await client.post("/homework/bench-hw/submissions", headers=tokens[students[0]], json={"answers": []})
+
+        started = time.perf_counter()
+        stats = (await client.get("/homework/bench-hw/stats", headers=tokens["bench-teacher"])).json()
+        stats_elapsed = time.perf_counter() - started
+    # What the teacher's page does without the aggregate: read every submission and add it up
+    started = time.perf_counter()
+    submissions = [doc.to_dict() for doc in main.db.collection("homework").document("bench-hw").collection("submissions").stream()]
+    recounted = sum(doc["score"] for doc in submissions) / len(submissions)
+    scan_elapsed = time.perf_counter() - started
+
+    result = {
+        "students": args.students,
+        "saved": sum(response.status_code == 200 for response in responses),
+        "duplicate_status": duplicate.status_code,
+        "submissions_per_sec": round(args.students / submit_elapsed, 1),
+        "stats_submissions": stats["submissions"],
+        "average_score": stats["average_score"],
+        "recounted_average": recounted,
+        "stats_read_ms": round(stats_elapsed * 1000, 2),
+        "scan_read_ms": round(scan_elapsed * 1000, 2),
+        "scan_documents": len(submissions),
+    }
+    print(f"{result['saved']} of {args.students} submissions graded and saved, {result['submissions_per_sec']}/s; resubmission got {duplicate.status_code}")
+    print(f"stats document: {stats['submissions']} submissions, average {stats['average_score']:.3f} (scan of submissions: {recounted:.3f})")
+    print(f"teacher view: 1 document in {result['stats_read_ms']} ms vs {len(submissions)} documents in {result['scan_read_ms']} ms")
+    return result
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--json", help="also save results to this file")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    tick = commands.add_parser("tick", parents=[common], help="frames and CPU per round with and without answer ticks")
+    tick.add_argument("--players", type=int, default=300)
+    tick.add_argument("--ticks", type=lambda v: [int(el) for el in v.split(",")], default=[0, 50, 100])
+    tick.add_argument("--spread", type=float, default=1.0, help="seconds over which all answers arrive")
+    tick.set_defaults(run=run_tick)
+
+    metrics = commands.add_parser("metrics", parents=[common], help="check that metrics cost stays under a per-message budget")
+    metrics.add_argument("--messages", type=int, default=100000)
+    metrics.add_argument("--repeat", type=int, default=5)
+    metrics.add_argument("--budget-us", type=float, default=5.0)
+    metrics.set_defaults(run=run_metrics)
+
+    codec = commands.add_parser("codec", parents=[common], help="message decode/dispatch and frame encode rates per codec")
+    codec.add_argument("--players", type=int, default=300, help="size of the host scoreboard frame")
+    codec.add_argument("--seconds", type=float, default=1.0, help="time spent on each measurement")
+    codec.set_defaults(run=run_codec)
+
+    wire = commands.add_parser("wire", parents=[common], help="bytes per game for each wire format and deflate setting")
+    wire.add_argument("--players", type=int, default=30)
+    wire.add_argument("--questions", type=int, default=10)
+    wire.add_argument("--deflate", type=lambda v: [tuple(int(el) for el in item.split("/")) for item in v.split(",")],
+                      default=[(15, 6, 8), (12, 6, 5), (10, 1, 3)], help="window_bits/level/mem_level settings to try")
+    wire.set_defaults(run=run_wire)
+
+    timers = commands.add_parser("timers", parents=[common], help="tasks and memory for round timers of many lobbies")
+    timers.add_argument("--lobbies", type=int, default=5000)
+    timers.set_defaults(run=run_timers)
+
+    memory = commands.add_parser("memory", parents=[common], help="memory held by a lobby's players and answer history")
+    memory.add_argument("--players", type=int, default=1000)
+    memory.add_argument("--questions", type=int, default=30)
+    memory.add_argument("--answered", type=float, default=0.9, help="share of players answering each question, the rest miss it")
+    memory.set_defaults(run=run_memory)
+
+    actor = commands.add_parser("actor", parents=[common], help="answers per second through a lobby's event queue")
+    actor.add_argument("--players", type=int, default=300)
+    actor.add_argument("--batches", type=lambda v: [int(el) for el in v.split(",")], default=[1, 16])
+    actor.add_argument("--tick-ms", type=int, default=0, help="answer tick of the game (0: scoreboard per answer or per batch)")
+    actor.set_defaults(run=run_actor)
+
+    limits = commands.add_parser("limits", parents=[common], help="what one flooding tab costs a lobby with and without rate limits")
+    limits.add_argument("--players", type=int, default=30)
+    limits.add_argument("--flood", type=int, default=10000, help="messages sent by the flooding tab")
+    limits.set_defaults(run=run_limits)
+
+    reaper = commands.add_parser("reaper", parents=[common], help="memory a sweep reclaims from finished lobbies, reported vs measured")
+    reaper.add_argument("--lobbies", type=int, default=100)
+    reaper.add_argument("--players", type=int, default=30)
+    reaper.add_argument("--questions", type=int, default=10)
+    reaper.set_defaults(run=run_reaper)
+
+    homework = commands.add_parser("homework", parents=[common], help="homework grading throughput and the aggregated stats read")
+    homework.add_argument("--students", type=int, default=200)
+    homework.add_argument("--questions", type=int, default=20)
+    homework.set_defaults(run=run_homework)
+
+    args = parser.parse_args()
+    results = asyncio.run(args.run(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"command": args.command, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,207 @@
+"""
+In-memory stand-in for the parts of google.cloud.firestore.Client that main.py uses.
+
+Used by bench.py to run the backend without Firebase credentials:
+
+    import fake_firestore
+    fake_firestore.install(latency=0.05)  # before importing main
+    import main
+"""
+
+import copy
+import datetime
+import itertools
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+from google.api_core import exceptions
+from google.cloud import firestore
+from google.cloud.firestore_v1 import transforms
+from google.oauth2 import service_account
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data, update_time=None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.update_time = update_time
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+
+class FakeDocument:
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name):
+        return FakeCollection(self.client, f"{self.path}/{name}")
+
+    def get(self):
+        self.client.call("get")
+        with self.client.lock:
+            return FakeSnapshot(self, copy.deepcopy(self.client.docs.get(self.path)), self.client.update_times.get(self.path))
+
+    def set(self, data, merge=False):
+        self.client.call("set")
+        self.client.write(self.path, data, merge=merge)
+
+    def update(self, data):
+        self.client.call("update")
+        self.client.write(self.path, data, merge=True, must_exist=True)
+
+    def delete(self):
+        self.client.call("delete")
+        with self.client.lock:
+            self.client.docs.pop(self.path, None)
+            self.client.update_times.pop(self.path, None)
+
+
+class FakeCollection:
+    def __init__(self, client, path, filters=()):
+        self.client = client
+        self.path = path
+        self.filters = filters
+
+    def document(self, document_id=None):
+        if document_id is None:
+            document_id = f"fake{next(self.client.ids)}"
+        return FakeDocument(self.client, f"{self.path}/{document_id}")
+
+    def add(self, data):
+        ref = self.document()
+        ref.set(data)
+        return self.client.update_times[ref.path], ref
+
+    def where(self, field, op, value):
+        if op != "==":
+            raise NotImplementedError(f"fake Firestore only supports '==' filters, got {op!r}")
+        return FakeCollection(self.client, self.path, self.filters + ((field, value),))
+
+    def limit(self, count):
+        return self
+
+    def stream(self):
+        self.client.call("query")
+        with self.client.lock:
+            return [
+                FakeSnapshot(FakeDocument(self.client, path), copy.deepcopy(data), self.client.update_times.get(path))
+                for path, data in self.client.docs.items()
+                if path.rsplit("/", 1)[0] == self.path and all(data.get(f) == v for f, v in self.filters)
+            ]
+
+    def get(self):
+        return self.stream()
+
+
+class FakeBatch:
+    def __init__(self, client):
+        self.client = client
+        self.writes = []
+
+    def set(self, reference, data, merge=False):
+        self.writes.append((reference.path, data, merge, False))
+
+    def update(self, reference, data):
+        self.writes.append((reference.path, data, True, True))
+
+    def create(self, reference, data):
+        self.writes.append((reference.path, data, False, None))
+
+    def commit(self):
+        if len(self.writes) > 500:
+            raise exceptions.InvalidArgument("maximum 500 writes allowed per request")
+        self.client.call("commit")
+        with self.client.lock:
+            # All or nothing, like the real thing: check every create before applying anything
+            for path, data, merge, must_exist in self.writes:
+                if must_exist is None and path in self.client.docs:
+                    raise exceptions.AlreadyExists(f"Document already exists: {path}")
+            for path, data, merge, must_exist in self.writes:
+                self.client.write(path, data, merge=merge, must_exist=bool(must_exist), locked=True)
+        return []
+
+
+class FakeClient:
+    """Thread-safe dict-backed client. `latency` seconds are slept on every round trip."""
+
+    def __init__(self, latency=0.0, **kwargs):
+        self.latency = latency
+        self.project = kwargs.get("project") or "quizit-fake"
+        self.docs = {}  # "collection/doc[/collection/doc...]" -> dict
+        self.update_times = {}
+        self.calls = {}  # operation -> count
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def get_all(self, references):
+        self.call("get_all")
+        with self.lock:
+            return [FakeSnapshot(ref, copy.deepcopy(self.docs.get(ref.path)), self.update_times.get(ref.path)) for ref in references]
+
+    def call(self, operation):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def write(self, path, data, merge=False, must_exist=False, locked=False):
+        if not locked:
+            with self.lock:
+                return self.write(path, data, merge=merge, must_exist=must_exist, locked=True)
+        if must_exist and path not in self.docs:
+            raise exceptions.NotFound(f"No document to update: {path}")
+        self.docs[path] = merge_fields(self.docs.get(path, {}) if merge else {}, data, merge)
+        self.update_times[path] = datetime.datetime.now(datetime.timezone.utc)
+
+    def seed(self, path, data):
+        """Put a document in place directly, without counting a call or sleeping."""
+        with self.lock:
+            self.docs[path] = copy.deepcopy(data)
+            self.update_times[path] = datetime.datetime.now(datetime.timezone.utc)
+
+
+def merge_fields(current, data, merge):
+    """current with data written over it. A merge goes into nested maps instead of replacing them."""
+    document = dict(current)
+    for field, value in data.items():
+        if merge and isinstance(value, dict) and isinstance(document.get(field), dict):
+            document[field] = merge_fields(document[field], value, merge)
+        elif isinstance(value, dict):
+            document[field] = merge_fields({}, value, merge)
+        else:
+            document[field] = apply_transform(document.get(field), value)
+    return document
+
+
+def apply_transform(current, value):
+    if value is firestore.SERVER_TIMESTAMP:
+        return datetime.datetime.now(datetime.timezone.utc)
+    if isinstance(value, transforms.ArrayUnion):
+        merged = list(current or [])
+        merged.extend(el for el in value.values if el not in merged)
+        return merged
+    if isinstance(value, transforms.Increment):
+        return (current or 0) + value.value
+    return copy.deepcopy(value)
+
+
+def install(latency=0.0):
+    """Make main.py's get_firestore_client() build a FakeClient instead of talking to Firebase."""
+    firestore.Client = lambda *args, **kwargs: FakeClient(latency=latency, **kwargs)
+    service_account.Credentials.from_service_account_file = staticmethod(
+        lambda path: SimpleNamespace(project_id="quizit-fake")
+    )
+    os.environ["FIREBASE_CREDENTIALS_JSON"] = "{}"
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Load test for the game server: runs the FastAPI app in this process on top of fake_firestore
+and plays whole games over real WebSockets with simulated hosts and students.
+
+Every lobby goes through the full protocol: auth, quiz, code, start, answer, next, show_results.
+Reports round-trip latencies per request type (p50/p99), messages per second and peak RSS.
+
+Usage:
+    python loadtest.py --lobbies 50 --players 40
+    python loadtest.py --lobbies 100 --players 30 --latency 0.03 --json run.json
+    python loadtest.py --lobbies 100 --players 30 --json new.json --baseline run.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import threading
+import time
+
+import websockets
+
+import fake_firestore
+
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}  # request type -> [seconds]
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+
+    def record(self, kind, seconds):
+        self.latencies.setdefault(kind, []).append(seconds)
+
+    @staticmethod
+    def summarize(values):
+        values = sorted(values)
+        pick = lambda q: values[min(int(q * len(values)), len(values) - 1)] * 1000
+        return {"count": len(values), "p50_ms": round(pick(0.5), 2), "p99_ms": round(pick(0.99), 2), "max_ms": round(values[-1] * 1000, 2)}
+
+
+class SimClient:
+    """One simulated browser: a socket, a reader task and request/response timing."""
+
+    def __init__(self, url, stats):
+        self.url = url
+        self.stats = stats
+        self.inbox = asyncio.Queue()
+        self.ws = None
+        self.reader = None
+
+    async def connect(self):
+        self.ws = await websockets.connect(self.url, max_size=None, open_timeout=60)
+        self.reader = asyncio.create_task(self.read())
+        await self.expect(lambda m: m.get("type") == "welcome")
+
+    async def read(self):
+        try:
+            async for frame in self.ws:
+                self.stats.received += 1
+                message = json.loads(frame)
+                if message.get("type") == "ping":
+                    await self.ws.send(json.dumps({"type": "pong"}))
+                    continue
+                self.inbox.put_nowait(message)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def send(self, payload):
+        self.stats.sent += 1
+        await self.ws.send(json.dumps(payload))
+
+    async def expect(self, predicate, timeout=120):
+        """Skip frames until one matches predicate and return it."""
+        async def wait():
+            while True:
+                message = await self.inbox.get()
+                if predicate(message):
+                    return message
+        return await asyncio.wait_for(wait(), timeout)
+
+    async def request(self, kind, payload, predicate):
+        started = time.perf_counter()
+        await self.send(payload)
+        message = await self.expect(predicate)
+        self.stats.record(kind, time.perf_counter() - started)
+        return message
+
+    async def close(self):
+        await self.ws.close()
+        await self.reader
+
+
+def is_question(message):
+    return "question" in message and "timeLimit" in message
+
+
+def seed(db, args):
+    """Users, one quiz and its questions in the fake Firestore."""
+    question_ids = []
+    for i in range(args.questions):
+        question_ids.append(f"load-q{i}")
+        db.seed(f"questions/load-q{i}", {
+            "question": f"Load test question {i}",
+            "type": "single",
+            "options": ["A", "B", "C", "D"],
+            "correct": [i % 4],
+            "timeLimit": args.time_limit,
+            "point": 1,
+        })
+    db.seed("quizes/load-quiz", {"title": "Load test", "questions": question_ids})
+    for lobby in range(args.lobbies):
+        db.seed(f"users/host-{lobby}", {"name": "Host", "lastName": str(lobby), "isTeacher": True})
+        for player in range(args.players):
+            db.seed(f"users/player-{lobby}-{player}", {"name": "Player", "lastName": f"{lobby}-{player}", "isTeacher": False})
+
+
+async def run_host(url, stats, lobby, args, code_future, connect_limit):
+    host = SimClient(url, stats)
+    async with connect_limit:
+        await host.connect()
+    await host.request("auth", {"user_id": f"host-{lobby}"}, lambda m: m.get("type") == "auth_success")
+    created = await host.request("quiz", {"quiz": "load-quiz", "group": "load", "game_type": {}}, lambda m: m.get("type") == "game_created")
+    code_future.set_result(created["code"])
+
+    joined = 0
+    while joined < args.players:
+        message = await host.expect(lambda m: m.get("type") in ("player_joined", "player_left"))
+        joined += len(message.get("joined", [])) - len(message.get("left", []))
+
+    for question in range(args.questions):
+        await host.request("start" if question == 0 else "next", {"start": True} if question == 0 else {"next": True}, is_question)
+        await host.expect(lambda m: m.get("type") == "round_results", timeout=args.time_limit + 60)
+    await host.request("show_results", {"show_results": True}, lambda m: m.get("type") == "game_finished")
+    await host.expect(lambda m: m.get("type") == "results_saved")
+    await host.close()
+
+
+async def run_player(url, stats, lobby, player, args, code_future, connect_limit):
+    client = SimClient(url, stats)
+    async with connect_limit:
+        await client.connect()
+    await client.request("auth", {"user_id": f"player-{lobby}-{player}"}, lambda m: m.get("type") == "auth_success")
+    code = await code_future
+    await client.request("code", {"code": code}, lambda m: m.get("type") == "joined")
+    while True:
+        message = await client.expect(lambda m: is_question(m) or m.get("type") == "game_finished", timeout=600)
+        if message.get("type") == "game_finished":
+            break
+        await asyncio.sleep(random.uniform(0, args.think))
+        await client.request("answer", {"answer": random.randrange(4)}, lambda m: m.get("type") in ("answer_saved", "error"))
+    await client.close()
+
+
+async def run_lobby(url, stats, lobby, args, connect_limit):
+    code_future = asyncio.get_running_loop().create_future()
+    try:
+        await asyncio.gather(
+            run_host(url, stats, lobby, args, code_future, connect_limit),
+            *(run_player(url, stats, lobby, player, args, code_future, connect_limit) for player in range(args.players)),
+        )
+    except Exception as e:
+        stats.errors += 1
+        print(f"lobby {lobby} failed: {type(e).__name__}: {e}")
+
+
+def start_server(app):
+    """Serve app on a free local port from a thread with its own event loop."""
+    import uvicorn
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning", backlog=4096))
+    thread = threading.Thread(target=lambda: asyncio.run(server.serve(sockets=[sock])), daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread, port
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def compare(result, baseline):
+    """Print how this run moved against a saved one."""
+    def change(new, old):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    print(f"\nvs baseline:")
+    print(f"  msgs/sec  {baseline['msgs_per_sec']:>10} -> {result['msgs_per_sec']:>10} ({change(result['msgs_per_sec'], baseline['msgs_per_sec'])})")
+    print(f"  peak RSS  {baseline['peak_rss_mb']:>10} -> {result['peak_rss_mb']:>10} ({change(result['peak_rss_mb'], baseline['peak_rss_mb'])})")
+    for kind, summary in result["latency"].items():
+        old = baseline["latency"].get(kind)
+        if old:
+            print(f"  {kind:<12} p99 {old['p99_ms']:>8} -> {summary['p99_ms']:>8} ms ({change(summary['p99_ms'], old['p99_ms'])})")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lobbies", type=int, default=20)
+    parser.add_argument("--players", type=int, default=30, help="students per lobby")
+    parser.add_argument("--questions", type=int, default=5)
+    parser.add_argument("--time-limit", type=int, default=60, help="question timeLimit in seconds")
+    parser.add_argument("--think", type=float, default=1.0, help="students answer after up to this many seconds")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every fake Firestore call")
+    parser.add_argument("--connect-concurrency", type=int, default=200, help="WebSocket handshakes in flight at once")
+    parser.add_argument("--json", help="save results to this file")
+    parser.add_argument("--baseline", help="compare against results saved earlier with --json")
+    args = parser.parse_args()
+
+    fake_firestore.install(latency=args.latency)
+    import main  # noqa: E402  (must come after install())
+
+    raise_fd_limit()
+    seed(main.db, args)
+    server, thread, port = start_server(main.app)
+    url = f"ws://127.0.0.1:{port}/ws"
+    stats = Stats()
+
+    async def run():
+        connect_limit = asyncio.Semaphore(args.connect_concurrency)
+        await asyncio.gather(*(run_lobby(url, stats, lobby, args, connect_limit) for lobby in range(args.lobbies)))
+
+    print(f"{args.lobbies} lobbies x {args.players} players, {args.questions} questions, Firestore latency {args.latency * 1000:.0f} ms")
+    started = time.perf_counter()
+    asyncio.run(run())
+    duration = time.perf_counter() - started
+    server.should_exit = True
+    thread.join(timeout=10)
+
+    all_latencies = [value for values in stats.latencies.values() for value in values]
+    result = {
+        "config": vars(args),
+        "duration_s": round(duration, 2),
+        "clients": args.lobbies * (args.players + 1),
+        "messages_sent": stats.sent,
+        "messages_received": stats.received,
+        "msgs_per_sec": round((stats.sent + stats.received) / duration, 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "errors": stats.errors,
+        "latency": {kind: Stats.summarize(values) for kind, values in stats.latencies.items()},
+        "latency_all": Stats.summarize(all_latencies) if all_latencies else None,
+        "firestore_calls": dict(main.db.calls),
+    }
+
+    print(f"{'request':<14} {'count':>8} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for kind, summary in result["latency"].items():
+        print(f"{kind:<14} {summary['count']:>8} {summary['p50_ms']:>9} {summary['p99_ms']:>9} {summary['max_ms']:>9}")
+    print(f"{result['clients']} clients in {result['duration_s']} s: {result['msgs_per_sec']} msgs/sec, "
+          f"peak RSS {result['peak_rss_mb']} MB (server and clients), {stats.errors} failed lobbies")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(result, json.load(f))
+    if stats.errors:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,17 +1,281 @@
+import math
 import random
 import string
 import os
+import secrets
+import socket
 from array import ArrayType
 
+import atexit
 import asyncio
+import base64
+import bisect
 import json
+import logging
+import queue
+import sys
 import datetime
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import JSONResponse
+import heapq
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from logging.handlers import QueueHandler, QueueListener
+from urllib.parse import urlsplit
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
+from google.api_core import exceptions as google_exceptions
+from google.auth import jwt
+from google.auth.exceptions import GoogleAuthError
+from google.auth.transport.requests import Request as AuthRequest
 from google.cloud import firestore
 from google.oauth2 import service_account
 
+# Logging. Records are handed to a queue on the event loop and formatted and written by a
+# listener thread, so a log call never waits on stdout. LOG_LEVEL is the default level,
+# LOG_LEVELS overrides it per category ("quizit.answers=DEBUG,quizit.firestore=WARNING").
+# High-frequency events are logged with sampled=True and only LOG_SAMPLE_RATE of them are kept.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # "json" or "text"
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
+# Structured fields picked up from `extra=`
+LOG_FIELDS = ("lobby", "user", "msg_type", "game_id", "homework", "worker", "error")
+
+
+class LogFormatter(logging.Formatter):
+    """One JSON object per line, or a plain line with the structured fields appended."""
+
+    def __init__(self, as_json=True):
+        super().__init__()
+        self.as_json = as_json
+
+    def format(self, record):
+        fields = {field: getattr(record, field) for field in LOG_FIELDS if getattr(record, field, None) is not None}
+        if self.as_json:
+            entry = {
+                "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+                "level": record.levelname,
+                "logger": record.name,
+                "message": record.getMessage(),
+                **fields,
+            }
+            if record.exc_info:
+                entry["exc"] = self.formatException(record.exc_info)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        line = f"{self.formatTime(record)} {record.levelname:<7} {record.name} {record.getMessage()}"
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class SampleFilter(logging.Filter):
+    """Keeps only LOG_SAMPLE_RATE of the records logged with sampled=True."""
+
+    def filter(self, record):
+        return not getattr(record, "sampled", False) or random.random() < LOG_SAMPLE_RATE
+
+
+class LogQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # Leave formatting to the listener thread; log calls only pass immutable arguments
+        return record
+
+
+def setup_logging():
+    log_queue = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(LogFormatter(as_json=LOG_FORMAT == "json"))
+    listener = QueueListener(log_queue, output)
+    handler = LogQueueHandler(log_queue)
+    handler.addFilter(SampleFilter())
+    root = logging.getLogger("quizit")
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(handler)
+    root.propagate = False
+    for item in LOG_LEVELS.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+log_listener = setup_logging()
+log = logging.getLogger("quizit")
+conn_log = logging.getLogger("quizit.conn")  # Connects, disconnects, socket trouble
+message_log = logging.getLogger("quizit.messages")  # Every incoming message (DEBUG)
+game_log = logging.getLogger("quizit.game")  # Lobby and game lifecycle
+answer_log = logging.getLogger("quizit.answers")  # Per-answer events (DEBUG, sampled)
+firestore_log = logging.getLogger("quizit.firestore")
+shard_log = logging.getLogger("quizit.shard")
+homework_log = logging.getLogger("quizit.homework")  # Homework submissions and their aggregates
+
+# Metrics, served at /metrics in the Prometheus text format. Updates are plain dict and list
+# operations on the event loop (no locks, no label validation), cheap enough for per-message use.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# How often the event loop lag probe wakes up
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "1.0"))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}  # label values tuple -> value
+
+    @staticmethod
+    def escape(value):
+        """Label value escaping of the text exposition format."""
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def label_text(self, values, extra=""):
+        pairs = [f'{label}="{self.escape(value)}"' for label, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self):
+        for values, value in self.values.items():
+            yield f"{self.name}{self.label_text(values)} {value}"
+
+    def render(self):
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self.samples()])
+
+
+class Counter(Metric):
+    """A running total, incremented here or read from `source` (a count kept elsewhere) when scraped."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=(), source=None):
+        super().__init__(name, help, labels)
+        self.source = source
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        if self.source is not None:
+            self.values[()] = self.source()
+        return super().samples()
+
+
+class Gauge(Metric):
+    """A value that is set, or read from `source` when scraped."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), source=None):
+        super().__init__(name, help, labels)
+        self.source = source
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def samples(self):
+        if self.source is not None:
+            self.values[()] = self.source()
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            # Per-bucket counts (the last one is +Inf), then sum of observations
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for values, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{self.label_text(values, le)} {cumulative}"
+            yield f"{self.name}_sum{self.label_text(values)} {total}"
+            yield f"{self.name}_count{self.label_text(values)} {cumulative}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=(), source=None):
+        return self.register(Counter(name, help, labels, source))
+
+    def gauge(self, name, help, labels=(), source=None):
+        return self.register(Gauge(name, help, labels, source))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+METRICS = MetricsRegistry()
+MESSAGES_RECEIVED = METRICS.counter("quizit_messages_received_total", "Client messages received, by type", ("type",))
+HANDLER_SECONDS = METRICS.histogram("quizit_handler_seconds", "Time spent in game hot paths", ("handler",))
+FIRESTORE_CALLS = METRICS.counter("quizit_firestore_calls_total", "Firestore calls, by operation and outcome", ("op", "outcome"))
+FIRESTORE_SECONDS = METRICS.histogram("quizit_firestore_seconds", "Firestore call latency, including the wait for a worker thread", ("op",))
+SEND_FAILURES = METRICS.counter("quizit_send_failures_total", "Outbound frames not delivered: failed writes, dropped by a full queue, slow-consumer disconnects", ("reason",))
+LOOP_LAG_SECONDS = METRICS.histogram("quizit_event_loop_lag_seconds", "How late the event loop woke up a sleeping task")
+
+
+def timed(handler):
+    """Record the duration of every call of the decorated function or coroutine in HANDLER_SECONDS."""
+    def decorate(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def timed_call(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    HANDLER_SECONDS.observe(time.perf_counter() - started, handler)
+        else:
+            @wraps(fn)
+            def timed_call(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    HANDLER_SECONDS.observe(time.perf_counter() - started, handler)
+        return timed_call
+    return decorate
+
+
+async def watch_loop_lag():
+    """Sleep for LOOP_LAG_INTERVAL over and over and record how much later than asked we woke up."""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG_SECONDS.observe(max(time.perf_counter() - started - LOOP_LAG_INTERVAL, 0.0))
+
+
 app = FastAPI()
 
 # Configure CORS
@@ -39,11 +303,10 @@ def get_firestore_client():
             
             creds = service_account.Credentials.from_service_account_file(temp_path)
             os.unlink(temp_path)
-            print("Using Firebase credentials from FIREBASE_CREDENTIALS_JSON environment variable")
+            firestore_log.info("Using Firebase credentials from FIREBASE_CREDENTIALS_JSON environment variable")
             return firestore.Client(credentials=creds, project=creds.project_id)
         except Exception as e:
-            print(f"Error reading Firebase from environment variable: {e}")
-            print("Falling back to file-based credentials...")
+            firestore_log.warning("Error reading Firebase from environment variable, falling back to file-based credentials", extra={"error": str(e)})
     
     # Option 2: Use Firebase key file from the same directory as main.py
     # Get the directory where main.py is located
@@ -54,16 +317,14 @@ def get_firestore_client():
     if not os.path.exists(firebase_key_file):
         firebase_key_file = os.path.join(os.getcwd(), "quizit-57a37-firebase-adminsdk-fbsvc-fd321561cc.json")
     
-    print(f"DEBUG: Looking for Firebase key at: {firebase_key_file}")
-    print(f"DEBUG: Current working directory: {os.getcwd()}")
-    print(f"DEBUG: Main.py directory: {main_dir}")
-    print(f"DEBUG: File exists: {os.path.exists(firebase_key_file)}")
+    firestore_log.debug("Looking for Firebase key at %s (cwd %s, main.py dir %s, exists %s)",
+                        firebase_key_file, os.getcwd(), main_dir, os.path.exists(firebase_key_file))
     
     if not os.path.exists(firebase_key_file):
         # List files in main.py directory for debugging
         try:
             files_in_dir = os.listdir(main_dir)
-            print(f"DEBUG: Files in main.py directory: {files_in_dir}")
+            firestore_log.debug("Files in main.py directory: %s", files_in_dir)
         except:
             pass
         
@@ -73,787 +334,2783 @@ def get_firestore_client():
             f"Please ensure the file is in the same directory as main.py or set FIREBASE_CREDENTIALS_JSON environment variable"
         )
     
-    print(f"Using Firebase key file: {firebase_key_file}")
+    firestore_log.info("Using Firebase key file: %s", firebase_key_file)
     creds = service_account.Credentials.from_service_account_file(firebase_key_file)
     return firestore.Client(credentials=creds, project=creds.project_id)
 
 db = get_firestore_client()
 
-def generate_room_code(length: int) -> str:
-    """
-    Generates a random string consisting only of digits (0-9) of a given length.
-    """
-    if length <= 0:
-        return ""
-    digits = string.digits  # '0123456789'
-    code = "".join(random.choices(digits, k=length))
-    while code in [lobby.code for lobby in LOBBIES]:
-        code = "".join(random.choices(digits, k=length))
-    return code
-
-
-def generate_unique_game_code(length: int = 6) -> str:
-    if length <= 0:
-        return ""
-    
-    characters = string.ascii_uppercase + string.digits
-    
-    while True:
-        code = "".join(random.choices(characters, k=length))
-        
-        games_ref = db.collection("games")
-        query = games_ref.where("code", "==", code).limit(1)
-        docs = query.get()
-        
-        if not docs:
-            return code
+# The Firestore client is blocking. Every call goes through a bounded thread pool so
+# a slow read or write never freezes the event loop (and with it every other lobby).
+FIRESTORE_WORKERS = int(os.getenv("FIRESTORE_WORKERS", "16"))
+# How many loaded quizzes (with their questions) to keep in memory
+QUIZ_CACHE_SIZE = int(os.getenv("QUIZ_CACHE_SIZE", "64"))
+# User profiles read during WebSocket auth. Reconnects and join waves hit the cache instead
+# of Firestore; unknown ids are remembered for a shorter time.
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "5000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+USER_CACHE_NEGATIVE_TTL = float(os.getenv("USER_CACHE_NEGATIVE_TTL", "30"))
 
+# Firestore accepts at most 500 writes per batch
+FIRESTORE_BATCH_SIZE = 500
+FIRESTORE_WRITE_RETRIES = int(os.getenv("FIRESTORE_WRITE_RETRIES", "3"))
 
-def get_user_info(user_id):
-    doc = db.collection("users").document(user_id).get()
-    if doc.exists:
-        return doc.to_dict()
-    else:
-        return None
+MISSING = object()
 
 
+class LRUCache:
+    """Bounded mapping that evicts the least recently used entry. Only used from the event loop."""
 
-class User:
-    def __init__(self, ws_id, user_id, user_info):
-        print(user_info)
-        self.ws_id = ws_id
-        self.username = f"{user_info['name']} {user_info['lastName']}"
-        self.teacher = user_info["isTeacher"]
-        self.user_id = user_id
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
 
+    def get(self, key, default=None):
+        if key in self.data:
+            self.data.move_to_end(key)
+            self.hits += 1
+            return self.data[key]
+        self.misses += 1
+        return default
 
-class Lobby:
-    def __init__(self, host, quiz, game_id, code, game_type=None):
-        self.host = host
-        self.quiz = quiz
-        self.game_id = game_id
-        self.players_ids = []
-        self.players = []
-        self.score_board = {}
-        self.code = code
-        self.started = False
-        self.currently_round = False
-        self.finished = False  # Track if game has been completed
-        self.current_question = -1
-        self.answers = []
-        self.results = {}  # Store final results for each student
-        self.game_type = game_type or {}  # Game mode: normal, lockdown, or tab_tracking
-        self.tab_switches = {}  # Track tab switches for each user {user_id: count}
-        self.user_answers = {}  # Track all answers for each user {user_id: [{question_num, answer, correct, points}]}
+    def set(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
 
+    def __len__(self):
+        return len(self.data)
 
 
-    def __eq__(self, other):
-        return self.code
+class TTLCache(LRUCache):
+    """LRU cache whose entries also expire. Cached None values (negative hits) get their own TTL."""
 
-    async def connect(self, user: User):
-        self.players_ids.append(user.user_id)
-        self.players.append(user)
-        self.score_board[user.user_id] = [user.username, 0]
-        self.tab_switches[user.user_id] = 0  # Initialize tab switch counter
-        self.user_answers[user.user_id] = []  # Initialize answers list for user
-        db.collection("games").document(self.game_id).update({
-            "players": firestore.ArrayUnion(self.players_ids)
-        })
-        await self.host.ws_id.send_text(json.dumps({"players": [el.username for el in self.players]}))
+    def __init__(self, maxsize, ttl, negative_ttl=None):
+        super().__init__(maxsize)
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
 
-    async def broadcast(self, message):
-        for el in self.players:
-            await el.ws_id.send_text(message)
+    def get(self, key, default=None):
+        entry = self.data.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self.data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.data[key]
+        self.misses += 1
+        return default
 
-    async def start_game(self):
-        print(self.quiz)
-        self.currently_round = True
-        self.started = True
-        self.current_question += 1
-        question_obj = self.quiz["questions"][self.current_question].copy()
-        question_points = question_obj.get("point", 1)
-        del question_obj["correct"]
-        
-        # Add points info to question object
-        question_obj["points"] = question_points
-        
-        await self.host.ws_id.send_text(json.dumps(question_obj))
-        await self.broadcast(json.dumps(question_obj))
-        asyncio.create_task(on_question_timer_end(self.current_question, self, self.quiz["questions"][self.current_question]))
+    def set(self, key, value):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        super().set(key, (time.monotonic() + ttl, value))
 
-    async def save_answer(self, user: User, answer):
-        if not self.currently_round:
-            await user.ws_id.send_text(json.dumps({"type": "error", "message": "Round is not active!"}))
-            return
-        
-        # Check if user already answered this question
-        for existing_answer in self.answers:
-            if existing_answer["user"].user_id == user.user_id:
-                await user.ws_id.send_text(json.dumps({"type": "error", "message": "You already answered this question!"}))
-                return
-        
-        self.answers.append({"user": user, "answer": answer})
-        
-        # Check if answer is correct and update score immediately
-        current_q = self.quiz["questions"][self.current_question]
-        question_type = current_q.get("type", "single")
-        
-        # For text questions, get the correct answer from textAnswer field
-        if question_type == "text":
-            correct_answer = current_q.get("textAnswer", current_q.get("correct", ""))
-            is_correct = str(answer).strip().lower() == str(correct_answer).strip().lower()
-        else:
-            correct_answer = current_q["correct"]
-            # Normalize types for comparison - convert both to same type
-            # Handle both single answer (int) and multiple answer (list)
-            if isinstance(answer, list):
-                # For multiple choice, compare lists
-                if isinstance(correct_answer, list):
-                    is_correct = sorted(answer) == sorted(correct_answer)
-                else:
-                    is_correct = False
-            else:
-                # For single choice, ensure both are same type (int)
-                # Convert answer to int if it's a string representation of a number
-                try:
-                    answer_int = int(answer) if not isinstance(answer, int) else answer
-                    correct_int = int(correct_answer) if not isinstance(correct_answer, int) else correct_answer
-                    is_correct = answer_int == correct_int
-                except (ValueError, TypeError):
-                    # Fallback to direct comparison if conversion fails
-                    is_correct = answer == correct_answer
-            
-        question_points = current_q.get("point", 1)
-        points_earned = question_points if is_correct else 0
-        
-        if is_correct:
-            self.score_board[user.user_id][1] += question_points
-            await user.ws_id.send_text(json.dumps({"correct": True, "points_earned": question_points}))
-        else:
-            await user.ws_id.send_text(json.dumps({"correct": False, "points_earned": 0}))
-        
-        # Store the answer details for this user
-        answer_record = {
-            "question_number": self.current_question,
-            "question_text": current_q.get("question", ""),
-            "question_type": current_q.get("type", "single"),
-            "options": current_q.get("options", []),
-            "user_answer": answer,
-            "correct_answer": correct_answer,
-            "is_correct": is_correct,
-            "points_earned": points_earned,
-            "possible_points": question_points,
-            "explanation": current_q.get("explanation", "")
-        }
-        self.user_answers[user.user_id].append(answer_record)
-        print(f"📝 Recorded answer for {user.username} on Q{self.current_question}: {'✓' if is_correct else '✗'} ({points_earned}/{question_points} pts)")
-        
-        # Send updated scoreboard to all players immediately
-        await self.broadcast(json.dumps({"type": "scoreboard", "data": self.score_board}))
-        
-        await self.host.ws_id.send_text(json.dumps({"answers": len(self.answers)}))
-        await user.ws_id.send_text(json.dumps({"type": "answer_saved", "message": "Saved! Waiting for end of round...."}))
-        
-        # Check if everyone has answered
-        if len(self.answers) == len(self.players):
-            await self.finish_round()
 
-    async def finish_round(self):
-        """Finish current round and send results to all players"""
-        self.currently_round = False
-        info_for_host = {"right": 0, "wrong": 0, "by_answer": {}}
-        
-        current_q = self.quiz["questions"][self.current_question]
-        question_type = current_q.get("type", "single")
-        
-        # For text questions, get the correct answer from textAnswer field
-        if question_type == "text":
-            correct_answer = current_q.get("textAnswer", current_q.get("correct", ""))
-        else:
-            correct_answer = current_q["correct"]
-        
-        # Initialize answer counts (skip for text questions)
-        if question_type != "text":
-            for i in range(len(self.quiz["questions"][self.current_question]["options"])):
-                info_for_host["by_answer"][i] = 0
-        
-        # Process all answers for statistics and send correct/incorrect to players
-        for answer_info in self.answers:
-            answer = answer_info["answer"]
-            # Handle both single answers and multiple choice answers
-            if isinstance(answer, list):
-                # For multiple choice, we'll count each selected option
-                for selected_answer in answer:
-                    if selected_answer in info_for_host["by_answer"]:
-                        info_for_host["by_answer"][selected_answer] += 1
-            else:
-                # For single choice answers
-                if answer in info_for_host["by_answer"]:
-                    info_for_host["by_answer"][answer] += 1
-            
-            # Check if answer is correct and send to player
-            if question_type == "text":
-                is_correct = str(answer).strip().lower() == str(correct_answer).strip().lower()
-            else:
-                # Normalize types for comparison - same logic as save_answer
-                if isinstance(answer, list):
-                    if isinstance(correct_answer, list):
-                        is_correct = sorted(answer) == sorted(correct_answer)
-                    else:
-                        is_correct = False
-                else:
-                    try:
-                        answer_int = int(answer) if not isinstance(answer, int) else answer
-                        correct_int = int(correct_answer) if not isinstance(correct_answer, int) else correct_answer
-                        is_correct = answer_int == correct_int
-                    except (ValueError, TypeError):
-                        is_correct = answer == correct_answer
-                
-            if is_correct:
-                info_for_host["right"] += 1
-
-        # Calculate wrong answers
-        info_for_host["wrong"] = len(self.answers) - info_for_host["right"]
-        
-        # Add question points info for host
-        question_points = self.quiz["questions"][self.current_question].get("point", 1)
-        info_for_host["question_points"] = question_points
-        info_for_host["total_possible_points"] = question_points * len(self.players)
-        info_for_host["total_earned_points"] = info_for_host["right"] * question_points
-        
-        # Send results to host
-        await self.host.ws_id.send_text(json.dumps({"type": "round_results", "data": info_for_host}))
-        
-        # Send round results with answer correctness and scoreboard to all players
-        answered_user_ids = set()
-        for answer_info in self.answers:
-            answer = answer_info["answer"]
-            # Check correctness using appropriate method for question type
-            if question_type == "text":
-                is_correct = str(answer).strip().lower() == str(correct_answer).strip().lower()
-            else:
-                # Normalize types for comparison - same logic as save_answer
-                if isinstance(answer, list):
-                    if isinstance(correct_answer, list):
-                        is_correct = sorted(answer) == sorted(correct_answer)
-                    else:
-                        is_correct = False
-                else:
-                    try:
-                        answer_int = int(answer) if not isinstance(answer, int) else answer
-                        correct_int = int(correct_answer) if not isinstance(correct_answer, int) else correct_answer
-                        is_correct = answer_int == correct_int
-                    except (ValueError, TypeError):
-                        is_correct = answer == correct_answer
-            answered_user_ids.add(answer_info["user"].user_id)
-            
-            await answer_info["user"].ws_id.send_text(json.dumps({
-                "type": "round_ended",
-                "correct": is_correct,
-                "scoreboard": self.score_board,
-                "question_points": question_points
-            }))
-        
-        # Notify players who did not answer in time and record missed answers
-        for player in self.players:
-            if player.user_id not in answered_user_ids:
-                await player.ws_id.send_text(json.dumps({
-                    "type": "round_ended",
-                    "correct": False,
-                    "missed": True,
-                    "message": "Время вышло! Вы не успели ответить на вопрос.",
-                    "scoreboard": self.score_board,
-                    "question_points": question_points
-                }))
-                
-                # Record missed answer
-                current_q = self.quiz["questions"][self.current_question]
-                question_type = current_q.get("type", "single")
-                # Get correct answer using appropriate field for question type
-                if question_type == "text":
-                    correct_answer = current_q.get("textAnswer", current_q.get("correct", ""))
-                else:
-                    correct_answer = current_q["correct"]
-                    
-                answer_record = {
-                    "question_number": self.current_question,
-                    "question_text": current_q.get("question", ""),
-                    "question_type": current_q.get("type", "single"),
-                    "options": current_q.get("options", []),
-                    "user_answer": None,
-                    "correct_answer": correct_answer,
-                    "is_correct": False,
-                    "points_earned": 0,
-                    "possible_points": question_points,
-                    "missed": True,
-                    "explanation": current_q.get("explanation", "")
-                }
-                self.user_answers[player.user_id].append(answer_record)
-                print(f"⏱️ Recorded MISSED answer for {player.username} on Q{self.current_question}")
-        
-        # Clear answers for next question
-        self.answers = []
+class FirestoreStore:
+    """Async persistence layer: runs the blocking Firestore client off the event loop."""
 
-    async def start_next_round(self):
-        """Start the next round (only called by host)"""
-        if self.current_question >= len(self.quiz["questions"]) - 1:
-            # This is the last question, don't auto-finish game
-            await self.host.ws_id.send_text(json.dumps({"type": "last_question_completed", "message": "All questions completed! Use 'show_results' to view final results."}))
-            return
-        
-        self.current_question += 1
-        self.currently_round = True
-        question_obj = self.quiz["questions"][self.current_question].copy()
-        question_points = question_obj.get("point", 1)
-        del question_obj["correct"]
-        
-        # Add points info to question object
-        question_obj["points"] = question_points
-        
-        await self.host.ws_id.send_text(json.dumps(question_obj))
-        await self.broadcast(json.dumps(question_obj))
-        asyncio.create_task(on_question_timer_end(self.current_question, self, self.quiz["questions"][self.current_question]))
+    def __init__(self, client, workers=FIRESTORE_WORKERS):
+        self.client = client
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="firestore")
+        self.quiz_cache = LRUCache(QUIZ_CACHE_SIZE)
+        self.user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL, USER_CACHE_NEGATIVE_TTL)
+        self.user_lookups = {}  # user_id -> in-flight read shared by concurrent callers
+        self.user_lookups_coalesced = 0
 
-    async def finish_game(self):
-        """Finish the game and send final results"""
-        self.finished = True  # Mark game as finished
-        
-        # Sort players by score (descending order)
-        sorted_players = sorted(self.score_board.items(), key=lambda x: x[1][1], reverse=True)
-        
-        # Create leaderboard with placements
-        leaderboard = []
-        for place, (user_id, [username, score]) in enumerate(sorted_players, 1):
-            leaderboard.append({
-                "place": place,
-                "username": username,
-                "score": score,
-                "user_id": user_id,
-                "tab_switches": self.tab_switches.get(user_id, 0)
-            })
-        
-        # Populate results object for each student with their score info
-        for user_id, [username, score] in self.score_board.items():
-            placement = next((p["place"] for p in leaderboard if p["user_id"] == user_id), len(leaderboard))
-            
-            # Calculate answer statistics
-            user_answer_list = self.user_answers.get(user_id, [])
-            correct_count = sum(1 for ans in user_answer_list if ans.get("is_correct", False))
-            missed_count = sum(1 for ans in user_answer_list if ans.get("missed", False))
-            wrong_count = len(user_answer_list) - correct_count - missed_count
-            
-            self.results[user_id] = {
-                "user_id": user_id,
-                "username": username,
-                "score": score,
-                "placement": placement,
-                "total_questions": len(self.quiz["questions"]),
-                "total_players": len(leaderboard),
-                "tab_switches": self.tab_switches.get(user_id, 0),
-                "answers": user_answer_list,
-                "correct_answers": correct_count,
-                "wrong_answers": wrong_count,
-                "missed_answers": missed_count
-            }
-        
-        # Send individual placement to each player
-        for player in self.players:
-            player_placement = next((p for p in leaderboard if p["user_id"] == player.user_id), None)
-            if player_placement:
-                await player.ws_id.send_text(json.dumps({
-                    "type": "game_finished",
-                    "placement": player_placement["place"],
-                    "score": player_placement["score"],
-                    "total_players": len(leaderboard)
-                }))
-        
-        # Send full leaderboard to host (include tab switches if tracking was enabled)
-        await self.host.ws_id.send_text(json.dumps({
-            "type": "game_finished",
-            "leaderboard": leaderboard,
-            "total_questions": len(self.quiz["questions"]),
-            "total_players": len(leaderboard),
-            "game_mode": self.game_type.get("mode", "normal")
-        }))
-        
-        # Mark game as inactive and finished in Firebase
+    async def run(self, op, fn, *args):
+        """Run a blocking client call on the pool; op labels it in the metrics."""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        outcome = "error"
         try:
-            db.collection("games").document(self.game_id).update({
-                "active": False,
-                "game_finished": True,
-                "finished_at": firestore.SERVER_TIMESTAMP,
-                "final_results": leaderboard,
-                "game_mode": self.game_type.get("mode", "normal")
-            })
-            
-            # Save individual student results to subcollection
-            for user_id, result_data in self.results.items():
-                db.collection("games").document(self.game_id).collection("results").document(user_id).set(result_data)
-                answers_count = len(result_data.get("answers", []))
-                print(f"  ✓ Saved results for {result_data['username']}: {answers_count} answers recorded")
-            
-            print(f"Game {self.game_id} marked as inactive and finished in Firebase")
-            print(f"Student results saved to /games/{self.game_id}/results/")
-        except Exception as e:
-            print(f"Error updating Firebase: {e}")
+            result = await loop.run_in_executor(self.executor, partial(fn, *args))
+            outcome = "ok"
+            return result
+        finally:
+            FIRESTORE_CALLS.inc(op, outcome)
+            FIRESTORE_SECONDS.observe(time.perf_counter() - started, op)
 
-    async def serve_next(self):
-        self.current_question += 1
-        self.currently_round = False
+    async def get_user_info(self, user_id):
+        """Profile for user_id (None if there is no such user), cached with a TTL.
 
+        Concurrent lookups for the same uid share a single Firestore read.
+        """
+        cached = self.user_cache.get(user_id, MISSING)
+        if cached is not MISSING:
+            return cached
 
-async def on_question_timer_end(dispatch_round_number, lobby: Lobby, question):
-    await asyncio.sleep(question["timeLimit"])
-    
-    # Only finish round if timer expired and round is still active
-    if lobby.currently_round and lobby.current_question == dispatch_round_number:
-        await lobby.finish_round()
-        
-        # Check if this was the last question
-        if lobby.current_question >= len(lobby.quiz["questions"]) - 1:
-            # Last question completed, wait for host to show results
-            await lobby.host.ws_id.send_text(json.dumps({"type": "last_question_completed", "message": "All questions completed! Use 'show_results' to view final results."}))
+        lookup = self.user_lookups.get(user_id)
+        if lookup is not None:
+            self.user_lookups_coalesced += 1
+        else:
+            def read():
+                doc = self.client.collection("users").document(user_id).get()
+                if doc.exists:
+                    return doc.to_dict()
+                return None
 
+            def done(future):
+                self.user_lookups.pop(user_id, None)
+                if not future.cancelled() and future.exception() is None:
+                    self.user_cache.set(user_id, future.result())
 
+            lookup = asyncio.ensure_future(self.run("get_user", read))
+            lookup.add_done_callback(done)
+            self.user_lookups[user_id] = lookup
+        # Shielded so one caller going away doesn't cancel the read for everyone else
+        return await asyncio.shield(lookup)
 
+    async def create_game(self, fields):
+        def add():
+            write_result, doc_ref = self.client.collection("games").add(fields)
+            if write_result:
+                return doc_ref.id
+        return await self.run("create_game", add)
 
-LOBBIES = []
-USERS = {}
+    async def fetch_quiz(self, quiz_id):
+        """Load a quiz with its questions: one quiz read plus one batched get_all for the questions.
 
-async def cleanup_user(websocket):
-    """Clean up user data when WebSocket connection is closed"""
-    if websocket in USERS:
-        user_obj = USERS[websocket]
-        user = user_obj.get("user")
-        lobby = user_obj.get("lobby")
-        
-        if user and lobby:
-            # Check if this is the host disconnecting
-            is_host = lobby.host == user
-            
-            # Remove user from lobby
-            if user in lobby.players:
-                lobby.players.remove(user)
-                if user.user_id in lobby.players_ids:
-                    lobby.players_ids.remove(user.user_id)
-                if user.user_id in lobby.score_board:
-                    del lobby.score_board[user.user_id]
-                if user.user_id in lobby.tab_switches:
-                    del lobby.tab_switches[user.user_id]
-                if user.user_id in lobby.user_answers:
-                    del lobby.user_answers[user.user_id]
-            
-            # Handle host disconnection
-            if is_host:
-                # If host disconnects, end the game for all players
-                if lobby.players:
-                    await lobby.broadcast(json.dumps({
-                        "type": "host_disconnected", 
-                        "message": "Host has left the game. The game is ending.",
-                        "username": user.username
-                    }))
-                
-                # Check if game was finished or not
-                if lobby.finished:
-                    # Game was completed - keep results in Firebase, just remove from local LOBBIES
-                    print(f"✅ Game {lobby.game_id} was completed. Keeping results in Firebase.")
-                else:
-                    # Game was not completed - delete from Firebase
-                    try:
-                        # First, check if there are any results subcollection documents to delete
-                        results_ref = db.collection("games").document(lobby.game_id).collection("results")
-                        results_docs = results_ref.stream()
-                        deleted_results = 0
-                        for doc in results_docs:
-                            doc.reference.delete()
-                            deleted_results += 1
-                        
-                        if deleted_results > 0:
-                            print(f"Deleted {deleted_results} result documents from game {lobby.game_id}")
-                        
-                        # Delete the main game document
-                        db.collection("games").document(lobby.game_id).delete()
-                        print(f"🗑️ Deleted incomplete game {lobby.game_id} from Firebase due to host disconnection")
-                    except Exception as e:
-                        print(f"❌ Error deleting game from Firebase: {e}")
-                
-                # Remove lobby from LOBBIES (always, whether finished or not)
-                if lobby in LOBBIES:
-                    LOBBIES.remove(lobby)
-                    print(f"Removed lobby from memory: {lobby.code}")
-            else:
-                # Regular player disconnection
-                if lobby.players:  # If there are still players left
-                    await lobby.broadcast(json.dumps({
-                        "type": "player_disconnected", 
-                        "message": f"{user.username} has left the game",
-                        "username": user.username
-                    }))
-                    
-                    # Update players list for host
-                    if lobby.host and lobby.host.ws_id:
-                        await lobby.host.ws_id.send_text(json.dumps({
-                            "type": "players_updated",
-                            "players": [player.username for player in lobby.players]
-                        }))
-                
-                # If lobby is empty, remove it
-                if not lobby.players:
-                    if lobby in LOBBIES:
-                        LOBBIES.remove(lobby)
-                        print(f"Removed empty lobby: {lobby.code}")
-        
-        # Remove user from USERS
-        del USERS[websocket]
-        client_info = f"{websocket.client.host}:{websocket.client.port}" if websocket.client else "unknown"
-        print(f"Cleaned up user data for: {client_info}")
-
-def create_game(user: User, group_id, game_type, quiz_id):
-    game_code = generate_unique_game_code(6)
-    write_result, doc_ref = db.collection("games").add({
-        "host": user.user_id, 
-        "players": [], 
-        "group_id": group_id, 
-        "active": True, 
-        "game_finished": False,
-        "code": game_code,
-        "type": game_type,
-        "quiz_id": quiz_id
-    })
-    if write_result:
-        return game_code, doc_ref.id
-
-
-def fetch_quiz(quiz_id):
-    doc = db.collection("quizes").document(quiz_id).get()
-    final = doc.to_dict().copy()
-    final["questions"] = []
-    for question in doc.to_dict()["questions"]:
-        q_doc = db.collection("questions").document(question).get()
-        final["questions"].append(q_doc.to_dict())
-    return final
+        Saving a quiz in the editor always rewrites the quiz document, so its update_time
+        works as a version: back-to-back games of an unchanged quiz are served from memory.
+        """
+        doc = await self.run("get_quiz", self.client.collection("quizes").document(quiz_id).get)
+        key = (quiz_id, doc.update_time)
+        quiz = self.quiz_cache.get(key)
+        if quiz is None:
+            quiz = doc.to_dict()
+            refs = [self.client.collection("questions").document(question) for question in quiz["questions"]]
+            snapshots = await self.run("get_questions", lambda: list(self.client.get_all(refs)))
+            # get_all doesn't keep the request order, so put the questions back in quiz order
+            by_id = {snap.id: snap.to_dict() for snap in snapshots if snap.exists}
+            quiz["questions"] = [by_id[question] for question in quiz["questions"] if question in by_id]
+            self.quiz_cache.set(key, quiz)
+        # Lobbies only read the quiz, so the cached questions can be shared between games
+        return dict(quiz)
 
+    async def update_game(self, game_id, fields):
+        def update():
+            self.client.collection("games").document(game_id).update(fields)
+        await self.run("update_game", update)
 
-async def main_handler(websocket: WebSocket):
-    """Main WebSocket handler."""
-    await websocket.accept()
-    # Log when a client connects
-    client_info = f"{websocket.client.host}:{websocket.client.port}" if websocket.client else "unknown"
-    print(f"New connection from: {client_info}")
-    await websocket.send_text(json.dumps({"type": "welcome", "message": "WELCOME! you have to auth first though..."}))
-    USERS[websocket] = {"auth": False, "user": None, "lobby": None}
-    print(USERS)
-    try:
-        # Handle incoming messages
-        while True:
-            message = await websocket.receive_text()
-            user_obj = USERS[websocket]
-            message = json.loads(message)
+    async def save_results(self, game_id, fields, results):
+        """Update the game document and write each student's result to its subcollection.
 
+        Writes go out as WriteBatches of up to FIRESTORE_BATCH_SIZE operations, each retried
+        on failure. Returns the number of writes made.
+        """
+        game_ref = self.client.collection("games").document(game_id)
+        writes = [("update", game_ref, fields)]
+        for user_id, result_data in results.items():
+            writes.append(("set", game_ref.collection("results").document(user_id), result_data))
+        for start in range(0, len(writes), FIRESTORE_BATCH_SIZE):
+            await self.commit_batch(writes[start:start + FIRESTORE_BATCH_SIZE])
+        return len(writes)
 
-            if user_obj["auth"] is False:
-                await websocket.send_text(json.dumps({"type": "auth_attempt", "message": "trying to auth you ahh"}))
-                user = get_user_info(message["user_id"])
-                if user:
-                    user_obj["auth"] = True
-                    user_obj["user"] = User(websocket, message["user_id"], user)
-                    await websocket.send_text(json.dumps({"type": "auth_success", "message": f"yeah wsg wats the haps {user['name']}"}))
+    async def commit_batch(self, writes):
+        """Commit [(op, ref, data), ...] as one atomic batch, retrying with backoff.
+
+        op is a WriteBatch method ("set", "update", "create") or "merge" for set(merge=True).
+        A failed create() means the document is already there, which no retry will change.
+        """
+        def commit():
+            batch = self.client.batch()
+            for op, ref, data in writes:
+                if op == "merge":
+                    batch.set(ref, data, merge=True)
                 else:
-                    await websocket.close(code=1008)
+                    getattr(batch, op)(ref, data)
+            batch.commit()
+
+        for attempt in range(1, FIRESTORE_WRITE_RETRIES + 1):
+            try:
+                return await self.run("commit_batch", commit)
+            except google_exceptions.AlreadyExists:
+                raise
+            except Exception as e:
+                if attempt == FIRESTORE_WRITE_RETRIES:
+                    raise
+                firestore_log.warning("Batch of %d writes failed (attempt %d), retrying", len(writes), attempt, extra={"error": str(e)})
+                await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+
+    async def delete_game(self, game_id):
+        """Delete a game document together with its results subcollection."""
+        def delete():
+            game_ref = self.client.collection("games").document(game_id)
+            deleted_results = 0
+            for doc in game_ref.collection("results").stream():
+                doc.reference.delete()
+                deleted_results += 1
+            game_ref.delete()
+            return deleted_results
+        return await self.run("delete_game", delete)
+
+    async def fetch_homework(self, homework_id):
+        """The homework document, or None if there is no such homework."""
+        def read():
+            doc = self.client.collection("homework").document(homework_id).get()
+            return doc.to_dict() if doc.exists else None
+        return await self.run("get_homework", read)
+
+    async def save_submission(self, homework_id, student_id, submission, stats):
+        """Create the student's submission and fold it into the homework stats in one batch.
+
+        The batch is atomic and create() fails on an existing submission, so a resubmission
+        raises AlreadyExists and the stats are never counted twice.
+        """
+        homework_ref = self.client.collection("homework").document(homework_id)
+        await self.commit_batch([
+            ("create", homework_ref.collection("submissions").document(student_id), submission),
+            ("merge", self.client.collection("homework_stats").document(homework_id), stats),
+        ])
+
+    async def fetch_group(self, group_id):
+        """The group document, or None if there is no such group."""
+        def read():
+            doc = self.client.collection("groups").document(group_id).get()
+            return doc.to_dict() if doc.exists else None
+        return await self.run("get_group", read)
+
+    async def fetch_homework_stats(self, homework_id):
+        def read():
+            doc = self.client.collection("homework_stats").document(homework_id).get()
+            return doc.to_dict() if doc.exists else None
+        return await self.run("get_homework_stats", read)
+
+    async def fetch_submissions(self, homework_id):
+        """Every submission of a homework. Only used to build its stats the first time."""
+        def read():
+            submissions = self.client.collection("homework").document(homework_id).collection("submissions")
+            return [doc.to_dict() for doc in submissions.stream()]
+        return await self.run("get_submissions", read)
+
+    async def create_homework_stats(self, homework_id, stats):
+        """Write a homework's first stats document; raises AlreadyExists if there is one."""
+        await self.commit_batch([("create", self.client.collection("homework_stats").document(homework_id), stats)])
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+store = FirestoreStore(db)
+METRICS.counter("quizit_user_cache_hits_total", "Profile lookups answered from the user cache", source=lambda: store.user_cache.hits)
+METRICS.counter("quizit_user_cache_misses_total", "Profile lookups that had to go to Firestore", source=lambda: store.user_cache.misses)
+METRICS.counter("quizit_user_lookups_coalesced_total", "Profile lookups that joined a read already in flight", source=lambda: store.user_lookups_coalesced)
+METRICS.counter("quizit_quiz_cache_hits_total", "Quiz loads served from the quiz cache", source=lambda: store.quiz_cache.hits)
+METRICS.counter("quizit_quiz_cache_misses_total", "Quiz loads that read the questions from Firestore", source=lambda: store.quiz_cache.misses)
+METRICS.gauge("quizit_user_cache_entries", "Profiles held in the user cache", source=lambda: len(store.user_cache))
+METRICS.gauge("quizit_quiz_cache_entries", "Quizzes held in the quiz cache", source=lambda: len(store.quiz_cache))
+
+# Game-document updates (like new players joining) are buffered and sent at most this often
+GAME_FLUSH_INTERVAL_MS = int(os.getenv("GAME_FLUSH_INTERVAL_MS", "500"))
+
+WRITE_BEHIND_FLUSH_SECONDS = METRICS.histogram("quizit_write_behind_flush_seconds", "Time to write out one flush of buffered game updates")
+WRITE_BEHIND_ERRORS = METRICS.counter("quizit_write_behind_errors_total", "Buffered game updates that failed to write")
+
+
+class WriteBehind:
+    """Write-behind buffer for game documents.
+
+    Pending field updates for a game are merged and new player ids collected, then sent as a
+    single update per game at most every interval, or straight away on flush().
+    """
+
+    def __init__(self, store, interval):
+        self.store = store
+        self.interval = interval
+        self.pending = {}  # game_id -> {"fields": {...}, "players": {user_id: None}}
+        self.timer = None
+        self.tasks = set()  # Flushes started with flush_soon()
+
+    @property
+    def depth(self):
+        """Number of games with updates waiting to be written."""
+        return len(self.pending)
+
+    def update(self, game_id, fields=None, players=()):
+        entry = self.pending.setdefault(game_id, {"fields": {}, "players": {}})
+        if fields:
+            entry["fields"].update(fields)
+        for user_id in players:
+            entry["players"][user_id] = None
+        if self.timer is None:
+            self.timer = asyncio.create_task(self.flush_later())
+
+    def discard(self, game_id):
+        """Drop pending updates for a game that is about to be deleted."""
+        self.pending.pop(game_id, None)
+
+    async def flush_later(self):
+        await asyncio.sleep(self.interval)
+        self.timer = None
+        await self.flush()
+
+    def flush_soon(self, game_id):
+        """Start flushing a game's updates without waiting for it."""
+        task = asyncio.create_task(self.flush(game_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush(self, game_id=None):
+        """Write pending updates for one game, or for every game if game_id is None."""
+        if game_id is None:
+            batch, self.pending = self.pending, {}
+        elif game_id in self.pending:
+            batch = {game_id: self.pending.pop(game_id)}
+        else:
+            return
+        if not batch:
+            return
+
+        started = time.perf_counter()
+        await asyncio.gather(*(self.write(pending_game_id, entry) for pending_game_id, entry in batch.items()))
+        WRITE_BEHIND_FLUSH_SECONDS.observe(time.perf_counter() - started)
+
+    async def write(self, game_id, entry):
+        fields = dict(entry["fields"])
+        if entry["players"]:
+            fields["players"] = firestore.ArrayUnion(list(entry["players"]))
+        try:
+            await self.store.update_game(game_id, fields)
+        except Exception as e:
+            WRITE_BEHIND_ERRORS.inc()
+            firestore_log.error("Error flushing updates for game", extra={"game_id": game_id, "error": str(e)})
+
+
+write_behind = WriteBehind(store, GAME_FLUSH_INTERVAL_MS / 1000)
+METRICS.gauge("quizit_write_behind_pending_games", "Games with buffered updates waiting to be written", source=lambda: write_behind.depth)
+
+# Default answer tick: scoreboard broadcasts and the host's answer counter are sent at most
+# once per window. A game can override it with "tick_ms" in its game_type.
+DEFAULT_TICK_MS = int(os.getenv("DEFAULT_TICK_MS", "100"))
+
+# How many leaders players see in scoreboard and round_ended frames (the host always gets everyone)
+SCOREBOARD_TOP_K = int(os.getenv("SCOREBOARD_TOP_K", "10"))
+
+# Players joining within this window are announced to the host in a single frame
+JOIN_COALESCE_MS = int(os.getenv("JOIN_COALESCE_MS", "50"))
+
+
+# Wire codec for frames in both directions. orjson is used when it is installed (several times
+# faster). JSON frames always go out as text: existing clients only parse text frames, and
+# binary frames are what tells a client it is talking msgpack. JSON_CODEC=json forces the
+# standard library.
+JSON_CODEC = os.getenv("JSON_CODEC", "auto")
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JSONCodec:
+    name = "json"
+
+    def encode(self, obj):
+        """Text for a text frame."""
+        return json.dumps(obj)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec(JSONCodec):
+    name = "orjson"
+
+    def __init__(self):
+        # Round histograms and the like have int keys, which the stdlib turns into strings too
+        self.option = orjson.OPT_NON_STR_KEYS
+
+    def encode(self, obj):
+        return orjson.dumps(obj, option=self.option).decode()
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+
+def make_codec(name):
+    if name == "orjson" or (name == "auto" and orjson is not None):
+        return OrjsonCodec()
+    return JSONCodec()
+
+
+CODEC = make_codec(JSON_CODEC)
+# Bound once: these are called for every frame
+encode = CODEC.encode
+decode = CODEC.decode
+
+
+# Wire formats, picked per connection through the WebSocket subprotocol. Clients that ask for
+# none (every client written before this) get JSON text frames, exactly as before.
+# "quizit.msgpack" needs the optional msgpack package and uses binary frames both ways.
+# Frames are handed to User.send as payload dicts and serialized for the connection's wire right
+# there; a frame for many connections is a SharedFrame, serialized once per wire it goes out on.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class SharedFrame:
+    """A payload going to many connections, with each wire's encoding made once, on first use."""
+
+    __slots__ = ("payload", "text", "packed")
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.text = None
+        self.packed = None
+
+
+class JSONWire:
+    binary = False
+
+    def __init__(self, name):
+        self.name = name  # Subprotocol to accept, None for clients that didn't ask for one
+
+    def frame(self, message):
+        """What goes on the socket for a payload dict, a SharedFrame or already encoded JSON text."""
+        if isinstance(message, SharedFrame):
+            if message.text is None:
+                message.text = encode(message.payload)
+            return message.text
+        if isinstance(message, dict):
+            return encode(message)
+        return message
+
+    def decode_bytes(self, data):
+        return decode(data)
+
+    async def send(self, websocket, payload):
+        """Write a frame straight to the socket, for the handshake before a User exists."""
+        await websocket.send_text(encode(payload))
+
+
+class MsgpackWire(JSONWire):
+    binary = True
+
+    def frame(self, message):
+        if isinstance(message, SharedFrame):
+            if message.packed is None:
+                message.packed = msgpack.packb(message.payload)
+            return message.packed
+        if isinstance(message, dict):
+            return msgpack.packb(message)
+        if isinstance(message, bytes):
+            return message  # A binary frame relayed from the worker that owns the lobby, already packed
+        # JSON text relayed from the worker that owns the lobby
+        return msgpack.packb(decode(message))
+
+    def decode_bytes(self, data):
+        return msgpack.unpackb(data)
+
+    async def send(self, websocket, payload):
+        await websocket.send_bytes(msgpack.packb(payload))
+
+
+LEGACY_WIRE = JSONWire(None)
+WIRES = {"quizit.json": JSONWire("quizit.json")}
+if msgpack is not None:
+    WIRES["quizit.msgpack"] = MsgpackWire("quizit.msgpack")
+
+
+def negotiate_wire(websocket):
+    """The first subprotocol offered by the client that we speak, in the client's order."""
+    for name in websocket.scope.get("subprotocols") or ():
+        if name in WIRES:
+            return WIRES[name]
+    return LEGACY_WIRE
+
+
+async def receive_message(websocket, wire):
+    frame = await websocket.receive()
+    if frame["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(frame.get("code", 1000))
+    data = frame["text"] if frame.get("text") is not None else frame["bytes"]
+    size = len(data)
+    if isinstance(data, str) and size * 4 > MAX_MESSAGE_SIZE:
+        # The limit is in bytes and a character is up to 4 of them in UTF-8; only long text is encoded to count
+        size = len(data.encode())
+    if size > MAX_MESSAGE_SIZE:
+        conn_log.warning("Message of %d bytes is over the limit, closing", size)
+        await websocket.close(code=1009)
+        raise WebSocketDisconnect(1009)
+    if isinstance(data, str):
+        return decode(data)
+    return wire.decode_bytes(data)
+
+
+# Inbound flood protection. Clients send a handful of small messages per question, so every
+# connection gets a token bucket per message type: (rate per second, burst). Messages over the
+# limit are dropped and the client is told at most once a second; a connection that has more
+# than RATE_LIMIT_MAX_DROPS dropped within RATE_LIMIT_WINDOW seconds is closed. RATE_LIMITS
+# adjusts the table per game mode, e.g. '{"tab_tracking": {"report": [0.5, 3]}}'.
+# Frames over MAX_MESSAGE_SIZE bytes close the connection.
+MAX_MESSAGE_SIZE = int(os.getenv("MAX_MESSAGE_SIZE", "65536"))
+RATE_LIMIT_MAX_DROPS = int(os.getenv("RATE_LIMIT_MAX_DROPS", "200"))
+RATE_LIMIT_WINDOW = float(os.getenv("RATE_LIMIT_WINDOW", "10"))
+RATE_LIMITS = {
+    "normal": {
+        "*": (10, 20),
+        "answer": (2, 5),
+        "report": (1, 5),
+        "code": (1, 5),
+        "quiz": (0.5, 3),
+        "start": (1, 3),
+        "next": (1, 3),
+        "show_results": (1, 3),
+        "players_snapshot": (1, 5),
+        "unknown": (1, 5),
+    },
+    "lockdown": {},
+    "tab_tracking": {"report": (2, 10)},
+}
+for mode, limits in json.loads(os.getenv("RATE_LIMITS", "{}")).items():
+    RATE_LIMITS.setdefault(mode, {}).update({kind: tuple(limit) for kind, limit in limits.items()})
+
+# Reports of the same student closer together than this count as one tab switch (the browser
+# fires both blur and visibilitychange for one switch, and a flapping tab fires many)
+REPORT_COALESCE_MS = int(os.getenv("REPORT_COALESCE_MS", "1000"))
+
+RATE_LIMITED = METRICS.counter("quizit_rate_limited_total", "Client messages dropped by the per-connection rate limits, by type", ("type",))
+
+
+def rate_limit(mode, kind):
+    """(rate, burst) for a message type in a game mode; modes fall back to "normal", types to "*"."""
+    for limits in (RATE_LIMITS.get(mode, {}), RATE_LIMITS["normal"]):
+        if kind in limits:
+            return limits[kind]
+    return RATE_LIMITS["normal"]["*"]
+
+
+class RateLimiter:
+    """Token buckets of one connection, one per message type."""
+
+    def __init__(self):
+        self.buckets = {}  # kind -> [tokens, time.monotonic() of the last refill]
+        self.dropped = 0  # Within the current window
+        self.window_start = time.monotonic()
+        self.warned_at = 0.0
+
+    def allow(self, kind, mode="normal"):
+        rate, burst = rate_limit(mode, kind)
+        now = time.monotonic()
+        bucket = self.buckets.get(kind)
+        if bucket is None:
+            bucket = self.buckets[kind] = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+        if now - self.window_start > RATE_LIMIT_WINDOW:
+            self.window_start = now
+            self.dropped = 0
+        self.dropped += 1
+        return False
+
+
+# Outbound fan-out: every connection gets a bounded queue drained by its own writer task,
+# so a slow or half-dead socket never holds up a broadcast for the rest of the lobby.
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", "256"))
+# What to do when a client's queue is full: "drop" discards its oldest queued frame,
+# "disconnect" closes the socket so the client can reconnect with fresh state.
+SLOW_CONSUMER_POLICY = os.getenv("SLOW_CONSUMER_POLICY", "drop")
+# How long a dropped player's seat, score and answers wait for them to come back with their resume token
+RESUME_GRACE_SECONDS = float(os.getenv("RESUME_GRACE_SECONDS", "60"))
+
+
+class User:
+    __slots__ = ("ws_id", "wire", "username", "teacher", "user_id", "resume_token", "outbox", "dropped", "closer", "writer")
+
+    def __init__(self, ws_id, user_id, user_info, wire=LEGACY_WIRE):
+        self.ws_id = ws_id
+        self.wire = wire
+        self.username = f"{user_info['name']} {user_info['lastName']}"
+        self.teacher = user_info["isTeacher"]
+        self.user_id = user_id
+        self.resume_token = None  # Issued when joining a lobby
+        self.outbox = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.dropped = 0  # Frames lost because the client could not keep up
+        self.closer = None
+        self.writer = asyncio.create_task(self.drain())
+
+    def send(self, message):
+        """Queue a frame for this connection. Never waits on the socket itself.
+
+        message is a payload dict, a SharedFrame or JSON text. It is serialized here, not in the
+        writer, so the frame shows the state at the time of the call.
+        """
+        if self.writer.done():
+            return False
+        message = self.wire.frame(message)
+        try:
+            self.outbox.put_nowait(message)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if SLOW_CONSUMER_POLICY == "disconnect":
+                SEND_FAILURES.inc("slow_consumer")
+                conn_log.warning("Client can't keep up (%d frames queued), disconnecting", self.outbox.qsize(), extra={"user": self.user_id})
+                self.stop()
+                self.closer = asyncio.create_task(self.ws_id.close(code=1013))
+                return False
+            # Drop the oldest frame: the newest state is the one worth delivering
+            SEND_FAILURES.inc("dropped")
+            self.outbox.get_nowait()
+            self.outbox.task_done()
+            self.outbox.put_nowait(message)
+        return True
+
+    async def drain(self):
+        """Writer task: pushes queued frames to the socket in order."""
+        while True:
+            message = await self.outbox.get()
+            try:
+                if isinstance(message, bytes):
+                    await self.ws_id.send_bytes(message)
+                else:
+                    await self.ws_id.send_text(message)
+            except Exception as e:
+                SEND_FAILURES.inc("send_error")
+                conn_log.info("Send failed, stopping writer", extra={"user": self.user_id, "error": str(e)})
+                return
+            finally:
+                self.outbox.task_done()
+
+    async def flush(self, timeout=2.0):
+        """Wait until everything queued so far is written, the writer dies or the timeout hits."""
+        if self.writer.done():
+            return
+        joined = asyncio.create_task(self.outbox.join())
+        await asyncio.wait([joined, self.writer], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        joined.cancel()
+
+    def stop(self):
+        """Stop the writer task; anything still queued is discarded."""
+        self.writer.cancel()
+
+    def reattach(self, ws_id, wire=LEGACY_WIRE):
+        """Move a resumed player onto their new socket with a fresh outbox."""
+        self.stop()
+        self.ws_id = ws_id
+        self.wire = wire
+        self.outbox = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.closer = None
+        self.writer = asyncio.create_task(self.drain())
+
+
+def normalize_text(value):
+    """Canonical form of a free-text answer: NFKC, trimmed, Unicode casefolded."""
+    return unicodedata.normalize("NFKC", str(value)).strip().casefold()
+
+
+def to_int(value):
+    """int(value) if it looks like an option index, otherwise the value unchanged."""
+    if isinstance(value, int):
+        return value
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return value
+
+
+class Grader(ABC):
+    """Answer check for one question, compiled once when the lobby is built."""
+
+    def __init__(self, question, correct_answer):
+        self.points = question.get("point", 1)
+        self.correct_answer = correct_answer  # As stored in the quiz, for answer records
+
+    @abstractmethod
+    def grade(self, answer):
+        """True if answer is right."""
+
+
+class TextGrader(Grader):
+    """Free-text question. textAnswer may be a single string or a list of accepted answers."""
+
+    def __init__(self, question):
+        super().__init__(question, question.get("textAnswer", question.get("correct", "")))
+        accepted = self.correct_answer if isinstance(self.correct_answer, list) else [self.correct_answer]
+        self.accepted = frozenset(normalize_text(el) for el in accepted)
+
+    def grade(self, answer):
+        return normalize_text(answer) in self.accepted
+
+
+class ChoiceGrader(Grader):
+    """Single-choice question: the answer is one option index."""
+
+    def __init__(self, question):
+        super().__init__(question, question.get("correct"))
+        correct = self.correct_answer
+        # The editor stores single-choice answers as a one-element list
+        if isinstance(correct, list) and len(correct) == 1:
+            correct = correct[0]
+        self.correct = to_int(correct)
+
+    def grade(self, answer):
+        if isinstance(answer, list):
+            if len(answer) != 1:
+                return False
+            answer = answer[0]
+        return to_int(answer) == self.correct
+
+
+class MultiChoiceGrader(Grader):
+    """Multiple-choice question: the selected option set must match exactly."""
+
+    def __init__(self, question):
+        super().__init__(question, question.get("correct"))
+        self.correct = frozenset(to_int(el) for el in self.correct_answer)
+
+    def grade(self, answer):
+        if not isinstance(answer, list):
+            return False
+        try:
+            return frozenset(to_int(el) for el in answer) == self.correct
+        except TypeError:  # Unhashable junk in the answer list
+            return False
+
+
+def compile_grader(question):
+    question_type = question.get("type", "single")
+    if question_type == "text":
+        return TextGrader(question)
+    correct = question.get("correct")
+    if isinstance(correct, list) and (question_type == "multiple" or len(correct) != 1):
+        return MultiChoiceGrader(question)
+    return ChoiceGrader(question)
+
+
+class ScoreIndex:
+    """Players bucketed by score, for live ranks.
+
+    A quiz only allows a handful of distinct totals, so keeping the distinct scores in a sorted
+    list makes an update a couple of bisects and all ranks one pass over the buckets.
+    """
+
+    def __init__(self):
+        self.scores = []  # Distinct scores, ascending
+        self.buckets = {}  # score -> {user_id: None}, in the order players reached that score
+        self.user_scores = {}
+
+    def add(self, user_id, score=0):
+        self.user_scores[user_id] = score
+        bucket = self.buckets.get(score)
+        if bucket is None:
+            bucket = self.buckets[score] = {}
+            bisect.insort(self.scores, score)
+        bucket[user_id] = None
+
+    def remove(self, user_id):
+        score = self.user_scores.pop(user_id, None)
+        if score is None:
+            return
+        bucket = self.buckets[score]
+        del bucket[user_id]
+        if not bucket:
+            del self.buckets[score]
+            del self.scores[bisect.bisect_left(self.scores, score)]
+
+    def update(self, user_id, score):
+        self.remove(user_id)
+        self.add(user_id, score)
+
+    def ranks(self):
+        """score -> place, with equal scores sharing a place (1, 1, 3)."""
+        ranks = {}
+        place = 1
+        for score in reversed(self.scores):
+            ranks[score] = place
+            place += len(self.buckets[score])
+        return ranks
+
+    def top(self, k):
+        """Up to k user ids, best first."""
+        leaders = []
+        for score in reversed(self.scores):
+            for user_id in self.buckets[score]:
+                if len(leaders) == k:
+                    return leaders
+                leaders.append(user_id)
+        return leaders
+
+
+class AnswerColumns:
+    """Answer history of a lobby, stored by question in columns rather than as a dict per answer.
+
+    Every opened question gets arrays with one slot per player row: what happened (OUTCOMES),
+    the chosen option and how many ms after the reveal the answer came. Answers that are not a
+    plain option index (text, several options) go to a small per-question dict instead. The
+    question text, options and explanation live only in the quiz; records() puts full answer
+    records together from both when results are persisted.
+    """
+
+    NOT_SEEN, MISSED, WRONG, CORRECT = 0, 1, 2, 3  # NOT_SEEN: joined later or parked, no record
+    NO_ANSWER = -2 ** 63
+
+    def __init__(self):
+        self.rows = {}  # user_id -> row
+        self.size = 0
+        self.questions = []  # Per opened question: [opened_ms, outcomes, answers, times, other answers {row: answer}]
+
+    def add_row(self, user_id):
+        self.rows[user_id] = self.size
+        self.size += 1
+        for _, outcomes, answers, times, _ in self.questions:
+            outcomes.append(self.NOT_SEEN)
+            answers.append(self.NO_ANSWER)
+            times.append(0)
+
+    def remove_row(self, user_id):
+        self.rows.pop(user_id, None)  # The slots stay, nothing refers to them any more
+
+    def open(self, question):
+        while len(self.questions) <= question:
+            self.questions.append([
+                monotonic_ms(),
+                ArrayType("b", bytes(self.size)),
+                ArrayType("q", [self.NO_ANSWER]) * self.size,
+                ArrayType("q", [0]) * self.size,
+                {},
+            ])
+
+    def record(self, question, user_id, answer, correct):
+        opened_ms, outcomes, answers, times, other = self.questions[question]
+        row = self.rows[user_id]
+        outcomes[row] = self.CORRECT if correct else self.WRONG
+        times[row] = monotonic_ms() - opened_ms
+        if type(answer) is int and self.NO_ANSWER < answer < 2 ** 63:
+            answers[row] = answer
+        else:
+            other[row] = answer
+
+    def mark_missed(self, question, user_id):
+        self.questions[question][1][self.rows[user_id]] = self.MISSED
+
+    def counts(self, user_id):
+        """(correct, wrong, missed) for one player."""
+        row = self.rows[user_id]
+        outcomes = [columns[1][row] for columns in self.questions]
+        return outcomes.count(self.CORRECT), outcomes.count(self.WRONG), outcomes.count(self.MISSED)
+
+    def records(self, user_id, quiz_questions, graders):
+        """The player's answer records in question order, in the shape stored with their result."""
+        row = self.rows[user_id]
+        records = []
+        for number, (_, outcomes, answers, times, other) in enumerate(self.questions):
+            outcome = outcomes[row]
+            if outcome == self.NOT_SEEN:
+                continue
+            question = quiz_questions[number]
+            grader = graders[number]
+            record = {
+                "question_number": number,
+                "question_text": question.get("question", ""),
+                "question_type": question.get("type", "single"),
+                "options": question.get("options", []),
+                "user_answer": None,
+                "correct_answer": grader.correct_answer,
+                "is_correct": outcome == self.CORRECT,
+                "points_earned": grader.points if outcome == self.CORRECT else 0,
+                "possible_points": grader.points,
+            }
+            if outcome == self.MISSED:
+                record["missed"] = True
+            else:
+                record["user_answer"] = other[row] if row in other else answers[row]
+                record["answer_time_ms"] = times[row]
+            record["explanation"] = question.get("explanation", "")
+            records.append(record)
+        return records
+
+
+# Round timers. Every question deadline of the worker sits in one heap served by one task, so
+# a thousand running lobbies cost one sleeping task rather than a thousand. Deadlines are
+# milliseconds on the monotonic clock; a timer is cancelled as soon as its round ends early.
+ROUND_EXTEND_MAX_SECONDS = int(os.getenv("ROUND_EXTEND_MAX_SECONDS", "600"))
+
+
+def monotonic_ms():
+    return time.monotonic_ns() // 1_000_000
+
+
+class RoundTimer:
+    """One scheduled callback. Paused timers keep the time they had left and count as pending."""
+
+    def __init__(self, scheduler, deadline_ms, callback):
+        self.scheduler = scheduler
+        self.deadline_ms = deadline_ms
+        self.callback = callback
+        self.paused_remaining_ms = None
+        self.done = False  # Fired or cancelled
+
+    @property
+    def paused(self):
+        return self.paused_remaining_ms is not None
+
+    def remaining_ms(self):
+        if self.done:
+            return 0
+        if self.paused:
+            return self.paused_remaining_ms
+        return max(self.deadline_ms - monotonic_ms(), 0)
+
+    def cancel(self):
+        if not self.done:
+            self.done = True
+            self.scheduler.pending -= 1
+
+    def pause(self):
+        if not self.done and not self.paused:
+            self.paused_remaining_ms = self.remaining_ms()
+
+    def resume(self):
+        if not self.done and self.paused:
+            self.deadline_ms = monotonic_ms() + self.paused_remaining_ms
+            self.paused_remaining_ms = None
+            self.scheduler.push(self)
+
+    def extend(self, ms):
+        if self.done:
+            return
+        if self.paused:
+            self.paused_remaining_ms += ms
+        else:
+            self.deadline_ms += ms
+            self.scheduler.push(self)
+
+
+class TimerScheduler:
+    """Heap of (deadline_ms, seq, timer) and the task that fires them.
+
+    Cancelling, pausing or moving a timer leaves its old heap entry behind; entries that no
+    longer match their timer are skipped when they come up. Callbacks run on the scheduler
+    task, one after another, so they must not block (coroutines are awaited). The task runs on
+    the loop serving the app: start() binds it at startup and stop() cancels it at shutdown.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.seq = 0
+        self.pending = 0
+        self.task = None
+        self.wakeup = None
+
+    def __len__(self):
+        return self.pending
+
+    def schedule(self, delay_ms, callback):
+        timer = RoundTimer(self, monotonic_ms() + delay_ms, callback)
+        self.pending += 1
+        self.push(timer)
+        return timer
+
+    def start(self):
+        """Run the scheduler task on the running loop, replacing one left on another loop."""
+        self.stop()
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        task, self.task = self.task, None
+        if task is None or task.done():
+            return
+        loop = task.get_loop()
+        if loop is asyncio.get_running_loop():
+            task.cancel()
+        elif not loop.is_closed():
+            loop.call_soon_threadsafe(task.cancel)
+
+    def push(self, timer):
+        self.seq += 1
+        heapq.heappush(self.heap, (timer.deadline_ms, self.seq, timer))
+        if self.task is None or self.task.done() or self.task.get_loop() is not asyncio.get_running_loop():
+            # Scheduled outside startup (bench.py, tests) or after the app moved to a new loop
+            self.start()
+        elif self.heap[0][2] is timer:
+            self.wakeup.set()  # New earliest deadline: sleep again with a shorter timeout
+
+    @staticmethod
+    def stale(entry):
+        deadline_ms, _, timer = entry
+        return timer.done or timer.paused or timer.deadline_ms != deadline_ms
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.wakeup.clear()
+            while self.heap and (self.stale(self.heap[0]) or self.heap[0][0] <= monotonic_ms()):
+                entry = heapq.heappop(self.heap)
+                if not self.stale(entry):
+                    await self.fire(entry[2])
+            wake = None
+            if self.heap:
+                wake = loop.call_later(max(self.heap[0][0] - monotonic_ms(), 0) / 1000, self.wakeup.set)
+            await self.wakeup.wait()
+            if wake is not None:
+                wake.cancel()
+
+    async def fire(self, timer):
+        timer.cancel()
+        try:
+            result = timer.callback()
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            game_log.error("Round timer callback failed", extra={"error": str(e)})
+
+
+round_timers = TimerScheduler()
+METRICS.gauge("quizit_round_timers_pending", "Round timers scheduled or paused on this worker", source=lambda: len(round_timers))
+
+
+# Lobby events. Everything that changes a lobby (client messages, round timeouts, disconnects,
+# expiring seats, answer ticks) runs on the lobby's actor one event at a time, in arrival order,
+# so a handler can await without another event slipping in half way. Client messages wait for
+# room once LOBBY_QUEUE_SIZE are queued, which in turn stops reading from their sockets; internal
+# events are never held back. Up to LOBBY_BATCH_SIZE events run back to back before the actor
+# lets other lobbies in; with more than one, untimed (tick_ms 0) scoreboards go out once per batch.
+LOBBY_QUEUE_SIZE = int(os.getenv("LOBBY_QUEUE_SIZE", "1024"))
+LOBBY_BATCH_SIZE = int(os.getenv("LOBBY_BATCH_SIZE", "1"))
+
+LOBBY_EVENT_WAIT = METRICS.histogram("quizit_lobby_event_wait_seconds", "Time lobby events spend queued before they run")
+
+
+class LobbyActor:
+    """The event queue of one lobby and the task draining it. The task only exists while there is work."""
+
+    def __init__(self, lobby):
+        self.lobby = lobby
+        self.events = deque()  # (fn, args, future or None, queued at)
+        self.room = None  # Semaphore bounding queued client messages, made on first use
+        self.task = None
+        self.batching = False
+
+    def __len__(self):
+        return len(self.events)
+
+    def enqueue(self, fn, args, future):
+        self.events.append((fn, args, future, time.perf_counter()))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def post(self, fn, *args):
+        """Queue an internal event and return at once; errors are logged."""
+        self.enqueue(fn, args, None)
+
+    async def call(self, fn, *args, bounded=True):
+        """Queue an event and wait for its result. Client messages (bounded) first wait for room in the queue."""
+        if not bounded:
+            future = asyncio.get_running_loop().create_future()
+            self.enqueue(fn, args, future)
+            return await future
+        if self.room is None:
+            self.room = asyncio.Semaphore(LOBBY_QUEUE_SIZE)
+        if self.room.locked():
+            game_log.warning("Lobby queue full (%d events), holding client messages back", len(self.events),
+                             extra={"lobby": self.lobby.code, "sampled": True})
+        async with self.room:
+            return await self.call(fn, *args, bounded=False)
+
+    async def run(self):
+        lobby = self.lobby
+        while self.events:
+            self.batching = LOBBY_BATCH_SIZE > 1
+            for _ in range(min(LOBBY_BATCH_SIZE, len(self.events))):
+                fn, args, future, queued = self.events.popleft()
+                if future is not None and future.done():
+                    continue  # The caller went away
+                LOBBY_EVENT_WAIT.observe(time.perf_counter() - queued)
+                lobby.last_activity = time.monotonic()
+                try:
+                    result = fn(*args)
+                    if asyncio.iscoroutine(result):
+                        result = await result
+                except Exception as e:
+                    if future is None:
+                        game_log.error("Lobby event failed", extra={"lobby": lobby.code, "error": str(e)})
+                    elif not future.done():
+                        future.set_exception(e)
+                else:
+                    if future is not None and not future.done():
+                        future.set_result(result)
+            self.batching = False
+            if lobby.tick_dirty and not lobby.tick_ms:
+                lobby.flush_tick()
+            await asyncio.sleep(0)  # Let other lobbies and the socket readers run
+
+
+class Lobby:
+    __slots__ = (
+        "host", "quiz", "game_id", "players_ids", "players", "score_board", "rank_index", "code", "started",
+        "currently_round", "finished", "current_question", "answers", "answered_user_ids", "round_timer",
+        "round_stats", "results", "persist_status", "persist_task", "game_type", "tab_switches", "tick_ms",
+        "tick_dirty", "tick_handle", "members_seq", "pending_joins", "join_flush", "parked", "answer_columns", "graders",
+        "actor", "last_tab_switch", "last_activity",
+    )
+
+    def __init__(self, host, quiz, game_id, code, game_type=None):
+        self.host = host
+        self.quiz = quiz
+        self.game_id = game_id
+        self.players_ids = []
+        self.players = []
+        self.score_board = {}
+        self.rank_index = ScoreIndex()  # Live placements, kept in step with score_board
+        self.code = code
+        self.started = False
+        self.currently_round = False
+        self.finished = False  # Track if game has been completed
+        self.current_question = -1
+        self.answers = []
+        self.answered_user_ids = set()  # Who has answered the current question
+        self.round_timer = None  # Deadline of the current question, on round_timers
+        self.round_stats = {"right": 0, "wrong": 0, "by_answer": {}}  # Kept up to date by save_answer
+        self.results = {}  # Final score and placement of each student; answer records are added when saving
+        self.persist_status = None  # None until finish_game, then "saving" -> "saved" / "failed"
+        self.persist_task = None
+        self.game_type = game_type or {}  # Game mode: normal, lockdown, or tab_tracking
+        self.tab_switches = {}  # Track tab switches for each user {user_id: count}
+        self.last_tab_switch = {}  # user_id -> monotonic_ms() of the last counted switch
+        # Tick mode: scoring side effects of answers are batched over this window (0 = send right away)
+        try:
+            self.tick_ms = min(max(int(self.game_type.get("tick_ms", DEFAULT_TICK_MS)), 0), 1000)
+        except (TypeError, ValueError):
+            self.tick_ms = DEFAULT_TICK_MS
+        self.tick_dirty = False
+        self.tick_handle = None
+        self.members_seq = 0  # Sequence number of the last membership frame sent to the host
+        self.pending_joins = []  # Joined players not yet announced to the host
+        self.join_flush = None
+        self.parked = {}  # resume token -> (user, expiry handle) for players whose socket dropped
+        self.answer_columns = AnswerColumns()  # Every answer of every player, by question
+        self.graders = [compile_grader(question) for question in quiz["questions"]]
+        self.actor = LobbyActor(self)
+        self.last_activity = time.monotonic()  # When the actor last ran an event, for the reaper
+
+    async def connect(self, user: User):
+        # Joining by code again (new tab, lost resume token, another worker) takes over a parked
+        # seat of the same account, and a second live seat shares the account's score and answers
+        self.take_parked_seat(user.user_id)
+        if user.user_id not in self.score_board:
+            self.players_ids.append(user.user_id)
+            self.score_board[user.user_id] = [user.username, 0]
+            self.rank_index.add(user.user_id, 0)
+            self.tab_switches[user.user_id] = 0  # Initialize tab switch counter
+            self.answer_columns.add_row(user.user_id)
+        self.players.append(user)
+        user.resume_token = secrets.token_urlsafe(16)
+        SESSIONS[user.resume_token] = self
+        write_behind.update(self.game_id, players=[user.user_id])
+        self.announce_join(user)
+
+    def remove_player(self, user: User):
+        """Drop a player from every lobby structure and tell the host. Returns False if they weren't here."""
+        if user.resume_token in self.parked:
+            # Already announced as gone when they were parked
+            self.parked.pop(user.resume_token)[1].cancel()
+        elif user in self.players:
+            self.players.remove(user)
+            self.announce_leave(user)
+        else:
+            return False
+        SESSIONS.pop(user.resume_token, None)
+        if self.seated(user.user_id):
+            # Another seat of the same account is still here and owns these rows
+            return True
+        if user.user_id in self.players_ids:
+            self.players_ids.remove(user.user_id)
+        if user.user_id in self.score_board:
+            del self.score_board[user.user_id]
+        self.rank_index.remove(user.user_id)
+        if user.user_id in self.tab_switches:
+            del self.tab_switches[user.user_id]
+        self.last_tab_switch.pop(user.user_id, None)
+        # A finished game's results still read the answer history, whoever has left since
+        if not self.finished:
+            self.answer_columns.remove_row(user.user_id)
+        return True
+
+    # Dropped players are parked rather than removed: they leave the broadcast list (and the
+    # host's player list) but keep their score, answers and tab switches until the grace
+    # period runs out. Reconnecting with the resume token puts the new socket in the same seat.
+    def park(self, user: User):
+        """Hold a dropped player's seat for RESUME_GRACE_SECONDS. Returns False if they weren't here."""
+        if user not in self.players:
+            return False
+        self.players.remove(user)
+        handle = asyncio.get_running_loop().call_later(RESUME_GRACE_SECONDS, self.actor.post, self.expire, user.resume_token)
+        self.parked[user.resume_token] = (user, handle)
+        self.announce_leave(user)
+        return True
+
+    def seated(self, user_id):
+        """True if a live or parked seat of this account is in the lobby."""
+        return any(el.user_id == user_id for el in self.players) or \
+            any(el.user_id == user_id for el, _ in self.parked.values())
+
+    def take_parked_seat(self, user_id):
+        """Forget a parked seat of this account, so the one joining now is the only seat it has."""
+        for token, (user, handle) in list(self.parked.items()):
+            if user.user_id == user_id:
+                handle.cancel()
+                del self.parked[token]
+                SESSIONS.pop(token, None)
+
+    def expire(self, token):
+        if token in self.parked:
+            user = self.parked[token][0]
+            game_log.info("Player did not come back, removing", extra={"lobby": self.code, "user": user.user_id})
+            self.remove_player(user)
+
+    def resume(self, token, ws_id, wire=LEGACY_WIRE):
+        """Reattach a parked player to a new socket. Returns the User, or None if the seat is gone."""
+        if token not in self.parked:
+            return None
+        user, handle = self.parked.pop(token)
+        handle.cancel()
+        user.reattach(ws_id, wire)
+        self.players.append(user)
+        self.announce_join(user)
+        return user
+
+    def replay(self, user: User):
+        """Catch a resumed player up with the game settings, the open question and the scoreboard."""
+        user.send({
+            "type": "resumed",
+            "message": "Welcome back!",
+            "game_settings": self.game_settings(),
+            "answered": user.user_id in self.answered_user_ids
+        })
+        if self.finished and user.user_id in self.results:
+            result = self.results[user.user_id]
+            user.send({
+                "type": "game_finished",
+                "game_id": self.game_id,
+                "placement": result["placement"],
+                "score": result["score"],
+                "total_players": result["total_players"]
+            })
+            return
+        if self.currently_round:
+            question_obj = self.question_payload()
+            question_obj["timeLimit"] = math.ceil(self.round_timer.remaining_ms() / 1000)
+            user.send(question_obj)
+            if self.round_timer.paused:
+                user.send(self.timer_frame())
+        self.send_ranked({"type": "scoreboard", "top": self.top_scores()}, players=[user])
+
+    def drop_sessions(self):
+        """Forget every resume token of this lobby; called when it goes away."""
+        for token, (user, handle) in self.parked.items():
+            handle.cancel()
+            SESSIONS.pop(token, None)
+        self.parked = {}
+        for player in self.players:
+            SESSIONS.pop(player.resume_token, None)
+
+    def game_settings(self):
+        return {
+            "mode": self.game_type.get("mode", "normal"),
+            "disable_copy": self.game_type.get("disable_copy", False),
+            "shuffle_answers": self.game_type.get("shuffle_answers", False)
+        }
+
+    def question_payload(self):
+        """The current question as players see it: no correct answer, points added."""
+        question_obj = self.quiz["questions"][self.current_question].copy()
+        question_points = question_obj.get("point", 1)
+        del question_obj["correct"]
+        
+        # Add points info to question object
+        question_obj["points"] = question_points
+        return question_obj
+
+    # Membership updates for the host are deltas: player_joined / player_left frames carry a
+    # sequence number, and the host asks for a players_snapshot when it notices a gap.
+    def announce_join(self, user: User):
+        """Queue a join notice; joins within JOIN_COALESCE_MS go out as one frame."""
+        self.pending_joins.append(user)
+        if self.join_flush is None:
+            self.join_flush = asyncio.get_running_loop().call_later(JOIN_COALESCE_MS / 1000, self.actor.post, self.flush_joins)
+
+    def flush_joins(self):
+        if self.join_flush is not None:
+            self.join_flush.cancel()
+            self.join_flush = None
+        if not self.pending_joins:
+            return
+        self.members_seq += 1
+        self.host.send({
+            "type": "player_joined",
+            "seq": self.members_seq,
+            "joined": [{"id": el.user_id, "username": el.username} for el in self.pending_joins]
+        })
+        self.pending_joins = []
+
+    def announce_leave(self, user: User):
+        self.flush_joins()  # Keep the host's view in order: a join always precedes its leave
+        self.members_seq += 1
+        self.host.send({
+            "type": "player_left",
+            "seq": self.members_seq,
+            "left": [{"id": user.user_id, "username": user.username}]
+        })
+
+    def send_members_snapshot(self):
+        """Full player list for the host, e.g. after it detected a gap in the sequence."""
+        self.flush_joins()
+        self.host.send({
+            "type": "players_snapshot",
+            "seq": self.members_seq,
+            "players": [{"id": el.user_id, "username": el.username} for el in self.players]
+        })
+
+    @timed("broadcast")
+    def broadcast(self, message):
+        """Fan a frame out to every player. Each send only enqueues, so no socket can stall the others."""
+        if isinstance(message, dict):
+            message = SharedFrame(message)
+        for el in self.players:
+            el.send(message)
+
+    def reset_round(self):
+        """Clear per-round state for the current question before it is revealed."""
+        self.answers = []
+        self.answered_user_ids = set()
+        self.round_stats = {"right": 0, "wrong": 0, "by_answer": {}}
+        question = self.quiz["questions"][self.current_question]
+        self.answer_columns.open(self.current_question)
+        if self.round_timer is not None:
+            self.round_timer.cancel()
+        self.round_timer = round_timers.schedule(int(question.get("timeLimit", 60) * 1000),
+                                                 partial(self.actor.post, self.on_round_timeout, self.current_question))
+        # Option histogram (skip for text questions)
+        if question.get("type", "single") != "text":
+            self.round_stats["by_answer"] = {i: 0 for i in range(len(question.get("options", [])))}
+
+    async def start_game(self):
+        game_log.info("Game started with %d questions", len(self.quiz["questions"]), extra={"lobby": self.code, "game_id": self.game_id})
+        self.currently_round = True
+        self.started = True
+        write_behind.flush_soon(self.game_id)
+        self.current_question += 1
+        self.reset_round()
+        question_obj = self.question_payload()
+        
+        frame = SharedFrame(question_obj)
+        self.host.send(frame)
+        self.broadcast(frame)
+
+    @timed("save_answer")
+    async def save_answer(self, user: User, answer):
+        if not self.currently_round:
+            user.send({"type": "error", "message": "Round is not active!"})
+            return
+        
+        # Check if user already answered this question
+        if user.user_id in self.answered_user_ids:
+            user.send({"type": "error", "message": "You already answered this question!"})
+            return
+        
+        # Check if answer is correct and update score immediately
+        grader = self.graders[self.current_question]
+        is_correct = grader.grade(answer)
+        question_points = grader.points
+        points_earned = question_points if is_correct else 0
+        
+        self.answers.append({"user": user, "answer": answer, "correct": is_correct})
+        self.answered_user_ids.add(user.user_id)
+        
+        # Update round statistics for the host as the answer comes in
+        stats = self.round_stats
+        stats["right" if is_correct else "wrong"] += 1
+        by_answer = stats["by_answer"]
+        for selected_answer in (answer if isinstance(answer, list) else [answer]):
+            try:
+                if selected_answer in by_answer:
+                    by_answer[selected_answer] += 1
+            except TypeError:  # Unhashable junk in the answer
+                pass
+        
+        if is_correct:
+            self.score_board[user.user_id][1] += question_points
+            self.rank_index.update(user.user_id, self.score_board[user.user_id][1])
+            user.send({"correct": True, "points_earned": question_points})
+        else:
+            user.send({"correct": False, "points_earned": 0})
+        
+        # Store the answer for this user
+        self.answer_columns.record(self.current_question, user.user_id, answer, is_correct)
+        if answer_log.isEnabledFor(logging.DEBUG):
+            answer_log.debug("Recorded answer on Q%d: %s (%s/%s pts)", self.current_question, "correct" if is_correct else "wrong",
+                             points_earned, question_points, extra={"lobby": self.code, "user": user.user_id, "sampled": True})
+        
+        user.send({"type": "answer_saved", "message": "Saved! Waiting for end of round...."})
+        
+        # The scoreboard and the host's answer counter go out once per tick, not once per answer
+        self.tick_dirty = True
+        if not self.tick_ms and not self.actor.batching:
+            self.flush_tick()
+        elif self.tick_handle is None:
+            self.tick_handle = asyncio.get_running_loop().call_later(self.tick_ms / 1000, self.actor.post, self.flush_tick)
+        
+        # Check if everyone has answered
+        if len(self.answers) == len(self.players):
+            await self.finish_round()
+
+    def flush_tick(self):
+        """Send the scoreboard and answer count collected since the last tick."""
+        if self.tick_handle is not None:
+            self.tick_handle.cancel()
+            self.tick_handle = None
+        if not self.tick_dirty:
+            return
+        self.tick_dirty = False
+        # Players get the top of the table plus their own place; only the host gets all of it
+        self.send_ranked({"type": "scoreboard", "top": self.top_scores()})
+        self.host.send({"type": "scoreboard", "data": self.score_board})
+        self.host.send({"answers": len(self.answers)})
+
+    def top_scores(self):
+        """The SCOREBOARD_TOP_K best entries of score_board, best first, in the same {user_id: [name, score]} shape."""
+        return {user_id: self.score_board[user_id] for user_id in self.rank_index.top(SCOREBOARD_TOP_K)}
+
+    def send_ranked(self, payload, players=None, variants=None):
+        """Send payload to each player with their own "rank", "score" and "total_players" added.
+
+        The shared part is serialized once; the per-player tail is appended to the JSON text.
+        variants maps user_id -> a key into a dict of alternative payloads to use instead.
+        """
+        heads = {}
+        ranks = self.rank_index.ranks()
+        total = len(self.score_board)  # Parked players still hold a place
+        for player in (self.players if players is None else players):
+            score = self.rank_index.user_scores.get(player.user_id, 0)
+            key, source = None, payload
+            if variants is not None:
+                key, source = variants(player)
+            if player.wire.binary:
+                # Unique per player, so packed straight from the dict rather than via JSON text
+                player.send({**source, "rank": ranks.get(score, total), "score": score, "total_players": total})
+                continue
+            if key not in heads:
+                heads[key] = encode(source)[:-1]
+            player.send(f'{heads[key]}, "rank": {ranks.get(score, total)}, "score": {encode(score)}, "total_players": {total}}}')
+
+    @timed("finish_round")
+    async def finish_round(self):
+        """Finish current round and send results to all players"""
+        self.flush_tick()  # Answers from the last partial tick must be counted before the results
+        self.currently_round = False
+        self.round_timer.cancel()
+        grader = self.graders[self.current_question]
+        info_for_host = self.round_stats
+        
+        # Add question points info for host
+        question_points = grader.points
+        info_for_host["question_points"] = question_points
+        info_for_host["total_possible_points"] = question_points * len(self.players)
+        info_for_host["total_earned_points"] = info_for_host["right"] * question_points
+        
+        # Send results to host
+        self.host.send({"type": "round_results", "data": info_for_host})
+        
+        # Send round results with answer correctness, the top of the scoreboard and each
+        # player's own place. Players who did not answer in time get a "missed" variant.
+        top = self.top_scores()
+        ended = {
+            True: {"type": "round_ended", "correct": True, "scoreboard": top, "question_points": question_points},
+            False: {"type": "round_ended", "correct": False, "scoreboard": top, "question_points": question_points},
+            "missed": {
+                "type": "round_ended",
+                "correct": False,
+                "missed": True,
+                "message": "Время вышло! Вы не успели ответить на вопрос.",
+                "scoreboard": top,
+                "question_points": question_points
+            }
+        }
+        correct_by_user = {answer_info["user"].user_id: answer_info["correct"] for answer_info in self.answers}
+
+        def variant(player):
+            key = correct_by_user.get(player.user_id, "missed")
+            return key, ended[key]
+
+        self.send_ranked(ended["missed"], variants=variant)
+        
+        # Record missed answers for players who did not answer in time
+        missed = 0
+        for player in self.players:
+            if player.user_id not in self.answered_user_ids:
+                self.answer_columns.mark_missed(self.current_question, player.user_id)
+                missed += 1
+        answer_log.debug("Recorded %d missed answers on Q%d", missed, self.current_question, extra={"lobby": self.code})
+        
+        # Clear answers for next question
+        self.answers = []
+        self.answered_user_ids = set()
+
+    async def on_round_timeout(self, question):
+        # The host may have moved on while this was queued
+        if not self.currently_round or self.current_question != question:
+            return
+        await self.finish_round()
+        if self.current_question >= len(self.quiz["questions"]) - 1:
+            # Last question completed, wait for host to show results
+            self.host.send({"type": "last_question_completed", "message": "All questions completed! Use 'show_results' to view final results."})
+
+    # The host can hold the clock (e.g. to explain a question) and give extra time. Everyone
+    # gets a "timer" frame with the time left so their countdowns follow.
+    def timer_frame(self):
+        return {"type": "timer", "remaining_ms": self.round_timer.remaining_ms(), "paused": self.round_timer.paused}
+
+    def control_timer(self, action, seconds=0):
+        """Pause, resume or extend the current question's timer on the host's request."""
+        if not self.currently_round:
+            self.host.send({"type": "error", "message": "Round is not active!"})
+            return
+        if action == "pause":
+            self.round_timer.pause()
+        elif action == "resume":
+            self.round_timer.resume()
+        else:
+            self.round_timer.extend(int(min(max(seconds, 0), ROUND_EXTEND_MAX_SECONDS) * 1000))
+        frame = SharedFrame(self.timer_frame())
+        self.host.send(frame)
+        self.broadcast(frame)
+        game_log.debug("Round timer %s", action, extra={"lobby": self.code})
+
+    async def start_next_round(self):
+        """Start the next round (only called by host)"""
+        if self.current_question >= len(self.quiz["questions"]) - 1:
+            # This is the last question, don't auto-finish game
+            self.host.send({"type": "last_question_completed", "message": "All questions completed! Use 'show_results' to view final results."})
+            return
+        
+        self.current_question += 1
+        self.reset_round()
+        self.currently_round = True
+        question_obj = self.question_payload()
+        
+        frame = SharedFrame(question_obj)
+        self.host.send(frame)
+        self.broadcast(frame)
+
+    @timed("finish_game")
+    async def finish_game(self):
+        """Finish the game, send final results, then persist them in the background"""
+        self.finished = True  # Mark game as finished
+        self.currently_round = False
+        if self.round_timer is not None:
+            self.round_timer.cancel()
+        
+        # Sort players by score (descending), ties broken by name so the order is stable
+        sorted_players = sorted(self.score_board.items(), key=lambda x: (-x[1][1], x[1][0], x[0]))
+        
+        # Create leaderboard with placements. Equal scores share a place ("1, 2, 2, 4")
+        leaderboard = []
+        placements = {}  # user_id -> place
+        previous_score = None
+        place = 0
+        for position, (user_id, [username, score]) in enumerate(sorted_players, 1):
+            if score != previous_score:
+                place = position
+                previous_score = score
+            placements[user_id] = place
+            leaderboard.append({
+                "place": place,
+                "username": username,
+                "score": score,
+                "user_id": user_id,
+                "tab_switches": self.tab_switches.get(user_id, 0)
+            })
+        
+        # Populate results object for each student with their score info
+        for user_id, [username, score] in self.score_board.items():
+            # Calculate answer statistics
+            correct_count, wrong_count, missed_count = self.answer_columns.counts(user_id)
+            
+            self.results[user_id] = {
+                "user_id": user_id,
+                "username": username,
+                "score": score,
+                "placement": placements[user_id],
+                "total_questions": len(self.quiz["questions"]),
+                "total_players": len(leaderboard),
+                "tab_switches": self.tab_switches.get(user_id, 0),
+                "correct_answers": correct_count,
+                "wrong_answers": wrong_count,
+                "missed_answers": missed_count
+            }
+        
+        # Send individual placement to each player
+        for player in self.players:
+            if player.user_id in placements:
+                player.send({
+                    "type": "game_finished",
+                    "game_id": self.game_id,
+                    "placement": placements[player.user_id],
+                    "score": self.score_board[player.user_id][1],
+                    "total_players": len(leaderboard)
+                })
+        
+        # Send full leaderboard to host (include tab switches if tracking was enabled)
+        self.host.send({
+            "type": "game_finished",
+            "game_id": self.game_id,
+            "leaderboard": leaderboard,
+            "total_questions": len(self.quiz["questions"]),
+            "total_players": len(leaderboard),
+            "game_mode": self.game_type.get("mode", "normal")
+        })
+        
+        # Nobody waits on Firestore for their results; the host is told once they're stored.
+        # The documents are built now, while everything they're made of is certainly still here.
+        self.persist_status = "saving"
+        self.persist_task = asyncio.create_task(self.persist_results(leaderboard, self.result_documents()))
+
+    def result_documents(self):
+        """Each student's result with their answer records, built from the answer columns to be saved."""
+        questions = self.quiz["questions"]
+        return {
+            user_id: {**result, "answers": self.answer_columns.records(user_id, questions, self.graders)}
+            for user_id, result in self.results.items()
+        }
+
+    async def persist_results(self, leaderboard, documents):
+        """Mark the game finished in Firebase and write every student's result document"""
+        started = time.monotonic()
+        try:
+            await write_behind.flush(self.game_id)
+            writes = await store.save_results(self.game_id, {
+                "active": False,
+                "game_finished": True,
+                "finished_at": firestore.SERVER_TIMESTAMP,
+                "final_results": leaderboard,
+                "game_mode": self.game_type.get("mode", "normal")
+            }, documents)
+            self.persist_status = "saved"
+            game_log.info("Game finished and %d results saved (%d writes in %.2fs)", len(self.results), writes, time.monotonic() - started,
+                          extra={"lobby": self.code, "game_id": self.game_id})
+        except Exception as e:
+            self.persist_status = "failed"
+            game_log.error("Error saving results", extra={"lobby": self.code, "game_id": self.game_id, "error": str(e)})
+        self.host.send({"type": "results_saved", "status": self.persist_status})
+
+    async def serve_next(self):
+        self.current_question += 1
+        self.currently_round = False
+
+
+class LobbyRegistry:
+    """Live lobbies indexed by room code and by game id, plus the room-code allocator.
+
+    Codes only have to be unique among running games (that's where joins look them up),
+    so picking one is a set lookup instead of a Firestore query. A released code is handed
+    out again, so nothing may find a finished game by its code: game_finished frames carry
+    the game id for the results pages.
+    """
+
+    def __init__(self, code_length=6, alphabet=string.ascii_uppercase + string.digits):
+        self.code_length = code_length
+        self.alphabet = alphabet
+        self.by_code = {}
+        self.by_game_id = {}
+        self.reserved = set()  # Codes handed out, including ones whose lobby is still being created
+
+    def allocate_code(self):
+        while True:
+            code = "".join(random.choices(self.alphabet, k=self.code_length))
+            if code not in self.reserved:
+                self.reserved.add(code)
+                return code
+
+    def release_code(self, code):
+        self.reserved.discard(code)
+
+    def add(self, lobby):
+        self.reserved.add(lobby.code)
+        self.by_code[lobby.code] = lobby
+        self.by_game_id[lobby.game_id] = lobby
+
+    def remove(self, lobby):
+        if self.by_code.get(lobby.code) is lobby:
+            del self.by_code[lobby.code]
+            self.by_game_id.pop(lobby.game_id, None)
+            self.release_code(lobby.code)
+
+    def get(self, code):
+        return self.by_code.get(code)
+
+    def get_by_game_id(self, game_id):
+        return self.by_game_id.get(game_id)
+
+    def __contains__(self, lobby):
+        return self.by_code.get(lobby.code) is lobby
+
+    def __iter__(self):
+        return iter(list(self.by_code.values()))
+
+    def __len__(self):
+        return len(self.by_code)
+
+    def __repr__(self):
+        return f"LobbyRegistry({sorted(self.by_code)})"
+
+
+LOBBIES = LobbyRegistry()
+USERS = {}
+METRICS.gauge("quizit_active_lobbies", "Lobbies hosted by this worker", source=lambda: len(LOBBIES))
+METRICS.gauge("quizit_lobby_events_queued", "Events waiting on lobby actors", source=lambda: sum(len(lobby.actor) for lobby in LOBBIES.by_code.values()))
+METRICS.gauge("quizit_lobby_queue_depth_max", "Longest event queue of any lobby", source=lambda: max((len(lobby.actor) for lobby in LOBBIES.by_code.values()), default=0))
+METRICS.gauge("quizit_active_connections", "Open WebSocket connections, including ones relayed from other workers", source=lambda: len(USERS))
+SESSIONS = {}  # resume token -> Lobby holding that player's seat
+
+
+# Sharding across workers/nodes: each lobby lives on the worker that created it, and
+# players who land on another worker are relayed to it over a pub/sub backend.
+# "memory://" keeps everything in this process; "redis://[:password@]host:port/db" shares
+# room ownership and worker channels through Redis.
+PUBSUB_URL = os.getenv("PUBSUB_URL", "memory://")
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# Room ownership keys expire on their own in case a worker dies without releasing them
+ROOM_TTL = int(os.getenv("ROOM_TTL", "86400"))
+# A lost Redis connection is retried with exponential backoff between these bounds (seconds).
+# Commands issued while it is down fail with ConnectionError instead of waiting.
+REDIS_RECONNECT_MIN = float(os.getenv("REDIS_RECONNECT_MIN", "0.1"))
+REDIS_RECONNECT_MAX = float(os.getenv("REDIS_RECONNECT_MAX", "10"))
+
+
+class PubSub(ABC):
+    """Channels plus a tiny key/value store for room ownership."""
+
+    async def start(self):
+        pass
+
+    @abstractmethod
+    async def publish(self, channel, data):
+        ...
+
+    @abstractmethod
+    async def subscribe(self, channel, handler):
+        ...
+
+    @abstractmethod
+    async def claim(self, key, value, ttl):
+        """Set key to value unless it is already taken. Returns True if we got it."""
+
+    @abstractmethod
+    async def lookup(self, key):
+        ...
+
+    @abstractmethod
+    async def release(self, key, value):
+        """Delete key, but only if it still holds value."""
+
+    async def close(self):
+        pass
+
+
+class MemoryPubSub(PubSub):
+    """Single-process backend. Handlers run in publish order, one at a time per channel."""
+
+    def __init__(self):
+        self.channels = {}  # channel -> queue of payloads
+        self.consumers = {}
+        self.keys = {}  # key -> (value, expires_at)
+
+    async def publish(self, channel, data):
+        if channel in self.channels:
+            self.channels[channel].put_nowait(data)
+
+    async def subscribe(self, channel, handler):
+        self.channels[channel] = asyncio.Queue()
+        self.consumers[channel] = asyncio.create_task(self.consume(self.channels[channel], handler))
+
+    async def consume(self, queue, handler):
+        while True:
+            data = await queue.get()
+            try:
+                await handler(data)
+            except Exception:
+                shard_log.exception("Pub/sub handler failed")
+
+    async def claim(self, key, value, ttl):
+        if await self.lookup(key) is not None:
+            return False
+        self.keys[key] = (value, time.monotonic() + ttl)
+        return True
+
+    async def lookup(self, key):
+        value, expires_at = self.keys.get(key, (None, 0))
+        if expires_at <= time.monotonic():
+            self.keys.pop(key, None)
+            return None
+        return value
+
+    async def release(self, key, value):
+        if self.keys.get(key, (None,))[0] == value:
+            del self.keys[key]
+
+    async def close(self):
+        for task in self.consumers.values():
+            task.cancel()
+
+
+class RedisError(Exception):
+    pass
+
+
+def encode_command(*args):
+    """RESP2 array of bulk strings."""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        arg = arg if isinstance(arg, bytes) else str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def read_reply(reader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Redis connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        raise RedisError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        if rest == b"-1":
+            return None
+        return (await reader.readexactly(int(rest) + 2))[:-2]
+    if kind == b"*":
+        if rest == b"-1":
+            return None
+        return [await read_reply(reader) for _ in range(int(rest))]
+    raise RedisError(f"Unexpected reply: {line!r}")
+
+
+class RedisPubSub(PubSub):
+    """
+    Redis backend speaking RESP over plain asyncio streams, so no extra client library is needed.
+    One pipelined connection carries commands, a second one sits in SUBSCRIBE mode.
+    Either one is reconnected when it drops; the subscriber then subscribes to its channels again.
+    """
+
+    # Compare-and-delete, so a worker never releases a code someone else has claimed since
+    RELEASE_SCRIPT = 'if redis.call("get", KEYS[1]) == ARGV[1] then return redis.call("del", KEYS[1]) else return 0 end'
+
+    def __init__(self, url):
+        parsed = urlsplit(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.handlers = {}  # channel -> coroutine function
+        self.pending = deque()  # futures waiting for replies, in the order the commands went out
+        self.writer = None
+        self.subscriber = None
+        self.tasks = []
+
+    async def connect(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(encode_command("AUTH", self.password))
+            await read_reply(reader)
+        if self.db:
+            writer.write(encode_command("SELECT", self.db))
+            await read_reply(reader)
+        return reader, writer
+
+    async def start(self):
+        commands = await self.connect()
+        subscriber = await self.connect()
+        self.tasks.append(asyncio.create_task(self.run_commands(*commands)))
+        self.tasks.append(asyncio.create_task(self.run_subscriber(*subscriber)))
+
+    async def reconnect(self, role):
+        """Open a new connection, backing off exponentially between failed attempts."""
+        delay = REDIS_RECONNECT_MIN
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                connection = await self.connect()
+            except (OSError, RedisError) as e:
+                shard_log.warning("Redis %s reconnect failed, retrying in %.1fs", role, min(delay * 2, REDIS_RECONNECT_MAX), extra={"error": str(e)})
+                delay = min(delay * 2, REDIS_RECONNECT_MAX)
+                continue
+            shard_log.info("Redis %s connection restored", role)
+            return connection
+
+    def execute(self, *args):
+        """Send a command without waiting for the previous ones; returns a future for the reply."""
+        future = asyncio.get_running_loop().create_future()
+        if self.writer is None:
+            future.set_exception(ConnectionError("Redis command connection is down"))
+            return future
+        self.pending.append(future)
+        self.writer.write(encode_command(*args))
+        return future
+
+    def fail_pending(self, reason):
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(ConnectionError(reason))
+
+    async def run_commands(self, reader, writer):
+        while True:
+            self.writer = writer
+            try:
+                await self.read_replies(reader)
+            except Exception as e:
+                shard_log.error("Redis command connection lost", extra={"error": str(e)})
+            # Nothing more will be answered on this connection: fail what's waiting, then reconnect
+            self.writer = None
+            writer.close()
+            self.fail_pending("Redis command connection lost")
+            reader, writer = await self.reconnect("command")
+
+    async def read_replies(self, reader):
+        while True:
+            try:
+                reply = await read_reply(reader)
+            except RedisError as e:
+                reply = e
+            future = self.pending.popleft()
+            if future.done():
+                continue  # The caller gave up (cancelled) while the reply was in flight
+            if isinstance(reply, RedisError):
+                future.set_exception(reply)
+            else:
+                future.set_result(reply)
+
+    async def run_subscriber(self, reader, writer):
+        while True:
+            self.subscriber = writer
+            try:
+                for channel in self.handlers:
+                    writer.write(encode_command("SUBSCRIBE", channel))
+                await writer.drain()
+                await self.listen(reader)
+            except Exception as e:
+                shard_log.error("Redis subscriber connection lost", extra={"error": str(e)})
+            self.subscriber = None
+            writer.close()
+            reader, writer = await self.reconnect("subscriber")
+
+    async def listen(self, reader):
+        while True:
+            reply = await read_reply(reader)
+            if reply[0] != b"message":
+                continue
+            handler = self.handlers.get(reply[1].decode())
+            if handler:
+                try:
+                    await handler(reply[2].decode())
+                except Exception:
+                    shard_log.exception("Pub/sub handler failed")
+
+    async def publish(self, channel, data):
+        await self.execute("PUBLISH", channel, data)
+
+    async def subscribe(self, channel, handler):
+        # While the subscriber is reconnecting, run_subscriber picks the channel up from handlers
+        self.handlers[channel] = handler
+        if self.subscriber is not None:
+            self.subscriber.write(encode_command("SUBSCRIBE", channel))
+            await self.subscriber.drain()
+
+    async def claim(self, key, value, ttl):
+        return await self.execute("SET", key, value, "NX", "EX", ttl) == "OK"
+
+    async def lookup(self, key):
+        value = await self.execute("GET", key)
+        return value.decode() if value is not None else None
+
+    async def release(self, key, value):
+        await self.execute("EVAL", self.RELEASE_SCRIPT, 1, key, value)
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        for writer in (self.writer, self.subscriber):
+            if writer:
+                writer.close()
+
+
+def make_pubsub(url):
+    if url.startswith("memory://"):
+        return MemoryPubSub()
+    if url.startswith("redis://"):
+        return RedisPubSub(url)
+    raise ValueError(f"Unsupported PUBSUB_URL: {url}")
+
+
+class RemoteSocket:
+    """
+    Owner-side stand-in for a player socket held by another worker.
+    Outgoing frames are published to that worker; incoming messages are handled in arrival order.
+    """
+
+    client = None
+
+    def __init__(self, router, edge, conn_id):
+        self.router = router
+        self.edge = edge
+        self.conn_id = conn_id
+        self.inbox = asyncio.Queue()
+        self.pump = asyncio.create_task(self.handle_messages())
+
+    async def send_text(self, data):
+        await self.router.publish(self.edge, {"op": "send", "conn": self.conn_id, "data": data})
 
-            if user_obj["user"].teacher and "quiz" in message and not user_obj["lobby"]:
-                await websocket.send_text(json.dumps({"type": "creating_game", "message": "creating..."}))
-                game_type = message.get("game_type", {})
-                quiz_id = message.get("quiz")
-                code, game_id = create_game(user_obj["user"], message.get("group"), game_type, quiz_id)
-                print(code, game_id)
-                quiz = fetch_quiz(quiz_id)
-                user_obj["lobby"] = Lobby(user_obj["user"], quiz, game_id, code, game_type)
-                LOBBIES.append(user_obj["lobby"])
-                await websocket.send_text(json.dumps({"type": "game_created", "message": f"done! room code: {code}", "code": code}))
-                await websocket.send_text(json.dumps({"type": "quiz_info", "message": f"quiz questions: {quiz['questions']}", "questions": quiz["questions"]}))
-                print(LOBBIES)
-                print(USERS)
-
-            if "code" in message and not user_obj["lobby"]:
-                await websocket.send_text(json.dumps({"type": "joining", "message": "joining..."}))
-                
-                # Find lobby by code
-                target_lobby = None
-                for lobby in LOBBIES:
-                    if lobby.code == message.get("code"):
-                        target_lobby = lobby
-                        break
-                
-                if target_lobby:
-                    await target_lobby.connect(user_obj["user"])
-                    user_obj["lobby"] = target_lobby
-                    await websocket.send_text(json.dumps({
-                        "type": "joined", 
-                        "message": "Joined! Waiting for start", 
-                        "game_settings": {
-                            "mode": target_lobby.game_type.get("mode", "normal"),
-                            "disable_copy": target_lobby.game_type.get("disable_copy", False),
-                            "shuffle_answers": target_lobby.game_type.get("shuffle_answers", False)
-                        }
-                    }))
-                    print(target_lobby.quiz["title"])
-                else:
-                    await websocket.send_text(json.dumps({"type": "error", "message": "Invalid room code!"}))
+    async def send_bytes(self, data):
+        # Envelopes are JSON text and a binary frame (msgpack) need not be UTF-8, so it goes as base64
+        await self.router.publish(self.edge, {"op": "send", "conn": self.conn_id, "data": base64.b64encode(data).decode(), "binary": True})
 
-            if "start" in message and user_obj["lobby"].host == user_obj["user"]:
-                await user_obj["lobby"].start_game()
+    async def close(self, code=1000):
+        await self.router.publish(self.edge, {"op": "close", "conn": self.conn_id, "code": code})
 
-            if "next" in message and user_obj["lobby"].host == user_obj["user"]:
-                await user_obj["lobby"].start_next_round()
+    async def handle_messages(self):
+        while True:
+            message = await self.inbox.get()
+            if message is None:
+                # The edge worker saw the socket close
+                await cleanup_user(self)
+                return
+            user_obj = USERS.get(self)
+            if user_obj is None or not user_obj["auth"]:
+                continue
+            try:
+                kind = message_kind(message)
+                if await admit(self, user_obj, kind):
+                    await handle_message(self, user_obj, message, kind)
+            except Exception:
+                shard_log.exception("Error handling relayed message from %s", self.conn_id, extra={"user": user_obj["user"].user_id})
 
-            if "show_results" in message and user_obj["lobby"].host == user_obj["user"]:
-                await user_obj["lobby"].finish_game()
 
-            print(f"📨 Received message: {message}")
-            print(f"👤 User object state: auth={user_obj.get('auth')}, has_user={bool(user_obj.get('user'))}, has_lobby={bool(user_obj.get('lobby'))}")
-            
-            if "answer" in message and user_obj.get("lobby"):
-                print("saving answer")
-                await user_obj["lobby"].save_answer(user_obj["user"], message.get("answer"))
-            
-            # Handle tab switch reports
-            if "report" in message:
-                print(f"🔍 Report detected in message: {message.get('report')}")
-                
-                if not user_obj.get("lobby"):
-                    print(f"⚠️ User has no lobby")
-                elif not user_obj.get("user"):
-                    print(f"⚠️ User not authenticated")
-                elif message.get("report") != "switched_tabs":
-                    print(f"⚠️ Unknown report type: {message.get('report')}")
-                else:
-                    print(f"🚨 PROCESSING TAB SWITCH REPORT from {user_obj['user'].username}")
-                    lobby = user_obj["lobby"]
-                    user = user_obj["user"]
-                    game_mode = lobby.game_type.get("mode", "normal")
-                    print(f"🎮 Game mode: {game_mode}")
-                    
-                    if game_mode == "tab_tracking":
-                        # Track tab switches
-                        if user.user_id in lobby.tab_switches:
-                            lobby.tab_switches[user.user_id] += 1
-                        else:
-                            lobby.tab_switches[user.user_id] = 1
-                        
-                        print(f"📊 Tab switch recorded for {user.username}: {lobby.tab_switches[user.user_id]} times")
-                        
-                        # Notify host about tab switch
-                        try:
-                            await lobby.host.ws_id.send_text(json.dumps({
-                                "type": "tab_switch_report",
-                                "username": user.username,
-                                "user_id": user.user_id,
-                                "total_switches": lobby.tab_switches[user.user_id]
-                            }))
-                            print(f"✅ Notification sent to host")
-                        except Exception as e:
-                            print(f"❌ Error notifying host: {e}")
-                        
-                        # Acknowledge to the student
-                        try:
-                            await user.ws_id.send_text(json.dumps({
-                                "type": "tab_switch_recorded",
-                                "message": "Переключение вкладки зафиксировано"
-                            }))
-                            print(f"✅ Acknowledgment sent to student")
-                        except Exception as e:
-                            print(f"❌ Error acknowledging student: {e}")
-                    
-                    elif game_mode == "lockdown":
-                        # Remove player in lockdown mode
-                        print(f"🔒 LOCKDOWN VIOLATION: Removing {user.username} from game")
-                        
-                        # Notify the player they are being removed
-                        try:
-                            await user.ws_id.send_text(json.dumps({
-                                "type": "kicked",
-                                "reason": "lockdown_violation",
-                                "message": "Вы были удалены из игры за нарушение режима блокировки (выход из полноэкранного режима)"
-                            }))
-                        except Exception as e:
-                            print(f"❌ Error notifying kicked player: {e}")
-                        
-                        # Notify host about the violation
-                        try:
-                            await lobby.host.ws_id.send_text(json.dumps({
-                                "type": "player_kicked",
-                                "username": user.username,
-                                "user_id": user.user_id,
-                                "reason": "Нарушение режима блокировки"
-                            }))
-                        except Exception as e:
-                            print(f"❌ Error notifying host: {e}")
-                        
-                        # Remove from lobby
-                        if user in lobby.players:
-                            lobby.players.remove(user)
-                        if user.user_id in lobby.players_ids:
-                            lobby.players_ids.remove(user.user_id)
-                        if user.user_id in lobby.score_board:
-                            del lobby.score_board[user.user_id]
-                        if user.user_id in lobby.tab_switches:
-                            del lobby.tab_switches[user.user_id]
-                        if user.user_id in lobby.user_answers:
-                            del lobby.user_answers[user.user_id]
-                        
-                        print(f"🗑️ Removed {user.username} from lobby data structures")
-                        
-                        # Notify remaining players
-                        try:
-                            await lobby.broadcast(json.dumps({
-                                "type": "player_removed",
-                                "username": user.username,
-                                "reason": "Нарушение режима блокировки"
-                            }))
-                        except Exception as e:
-                            print(f"❌ Error broadcasting removal: {e}")
-                        
-                        # Update host's player list
-                        try:
-                            await lobby.host.ws_id.send_text(json.dumps({
-                                "type": "players_updated",
-                                "players": [player.username for player in lobby.players]
-                            }))
-                        except Exception as e:
-                            print(f"❌ Error updating host player list: {e}")
-                        
-                        # Close the user's connection
-                        try:
-                            await websocket.close(code=1008)
-                            print(f"🔌 Closed websocket connection")
-                        except Exception as e:
-                            print(f"❌ Error closing websocket: {e}")
-                        
-                        # Clean up user data
-                        if websocket in USERS:
-                            del USERS[websocket]
-                            print(f"🗑️ Cleaned up user data from USERS dict")
-                    
-                    else:
-                        print(f"⚠️ Game mode '{game_mode}' does not require tracking")
+class ShardRouter:
+    """
+    Routes players to the worker that owns their lobby.
+
+    Room codes are claimed in the shared backend when a lobby is created. A player whose
+    code belongs to another worker stays connected here (the edge) while every message
+    is relayed to the owner, which runs the lobby with a RemoteSocket in place of the socket.
+    """
+
+    def __init__(self, pubsub, worker_id):
+        self.pubsub = pubsub
+        self.worker_id = worker_id
+        self.edge_connections = {}  # conn id -> local user_obj relayed to another worker
+        self.remote_sockets = {}  # conn id -> RemoteSocket for players held by another worker
+        self.connection_ids = 0
+
+    @staticmethod
+    def channel(worker_id):
+        return f"quizit:worker:{worker_id}"
+
+    @staticmethod
+    def room_key(code):
+        return f"quizit:room:{code}"
+
+    async def start(self):
+        await self.pubsub.start()
+        await self.pubsub.subscribe(self.channel(self.worker_id), self.receive)
+
+    async def close(self):
+        await self.pubsub.close()
+
+    async def publish(self, worker_id, op):
+        await self.pubsub.publish(self.channel(worker_id), encode(op))
+
+    async def claim_room(self, code):
+        return await self.pubsub.claim(self.room_key(code), self.worker_id, ROOM_TTL)
+
+    async def release_room(self, code):
+        await self.pubsub.release(self.room_key(code), self.worker_id)
+
+    async def owner_of(self, code):
+        return await self.pubsub.lookup(self.room_key(code))
+
+    async def route(self, websocket, user_obj, message):
+        """Attach the connection to a remote owner if this is a join for a lobby we don't hold."""
+        code = message.get("code")
+        if not code or user_obj["lobby"] or LOBBIES.get(code):
+            return False
+        owner = await self.owner_of(code)
+        if owner is None or owner == self.worker_id:
+            return False
+        self.connection_ids += 1
+        conn_id = f"{self.worker_id}:{self.connection_ids}"
+        user_obj["owner"] = owner
+        user_obj["conn"] = conn_id
+        self.edge_connections[conn_id] = user_obj
+        await self.publish(owner, {
+            "op": "open",
+            "conn": conn_id,
+            "edge": self.worker_id,
+            "user_id": user_obj["user"].user_id,
+            "profile": user_obj["profile"],
+        })
+        shard_log.info("Relaying player to worker %s", owner, extra={"lobby": code, "user": user_obj["user"].user_id})
+        return True
+
+    async def forward(self, user_obj, message):
+        await self.publish(user_obj["owner"], {"op": "message", "conn": user_obj["conn"], "message": message})
+
+    async def detach(self, user_obj):
+        """Edge side: the local socket closed, let the owner clean up the player."""
+        self.edge_connections.pop(user_obj["conn"], None)
+        await self.publish(user_obj["owner"], {"op": "close", "conn": user_obj["conn"]})
+
+    async def receive(self, data):
+        op = decode(data)
+        kind = op["op"]
+        if kind == "open":
+            remote = RemoteSocket(self, op["edge"], op["conn"])
+            self.remote_sockets[op["conn"]] = remote
+            USERS[remote] = {"auth": True, "user": User(remote, op["user_id"], op["profile"]), "lobby": None, "profile": op["profile"], "wire": LEGACY_WIRE,
+                            "limiter": RateLimiter()}
+        elif kind == "message":
+            remote = self.remote_sockets.get(op["conn"])
+            if remote:
+                remote.inbox.put_nowait(op["message"])
+        elif kind == "close" and op["conn"] in self.remote_sockets:
+            self.remote_sockets.pop(op["conn"]).inbox.put_nowait(None)
+        elif kind == "send":
+            user_obj = self.edge_connections.get(op["conn"])
+            if user_obj:
+                user_obj["user"].send(base64.b64decode(op["data"]) if op.get("binary") else op["data"])
+        elif kind == "close":
+            user_obj = self.edge_connections.pop(op["conn"], None)
+            if user_obj:
+                asyncio.create_task(self.close_edge(user_obj, op.get("code", 1000)))
+
+    async def close_edge(self, user_obj, code):
+        """Close a relayed socket once the owner's last frames are written."""
+        await user_obj["user"].flush()
+        await user_obj["user"].ws_id.close(code=code)
+
+
+router = ShardRouter(make_pubsub(PUBSUB_URL), WORKER_ID)
+
+
+async def cleanup_user(websocket):
+    """Clean up user data when WebSocket connection is closed"""
+    if websocket in USERS:
+        user_obj = USERS[websocket]
+        user = user_obj.get("user")
+        lobby = user_obj.get("lobby")
+        
+        if user:
+            user.stop()
+
+        if user_obj.get("owner"):
+            try:
+                await router.detach(user_obj)
+            except Exception as e:
+                shard_log.error("Error telling worker %s about the disconnect", user_obj["owner"], extra={"error": str(e)})
+
+        if user and lobby:
+            await lobby.actor.call(leave_lobby, lobby, user, bounded=False)
+        
+        # Remove user from USERS
+        del USERS[websocket]
+        conn_log.debug("Cleaned up user data", extra={"user": user.user_id if user else None})
+
+
+async def leave_lobby(lobby, user: User):
+    """Take a disconnected user out of their lobby; runs on the lobby's actor."""
+    # Check if this is the host disconnecting
+    is_host = lobby.host == user
+    
+    # Remove user from lobby (the host is told through a player_left delta).
+    # A player in a running game keeps their seat for a while so they can resume.
+    if is_host or lobby.finished or not lobby.park(user):
+        lobby.remove_player(user)
+    
+    # Handle host disconnection
+    if is_host:
+        # If host disconnects, end the game for all players
+        if lobby.players:
+            lobby.broadcast({
+                "type": "host_disconnected", 
+                "message": "Host has left the game. The game is ending.",
+                "username": user.username
+            })
+    
+        # Check if game was finished or not
+        if lobby.finished:
+            # Game was completed - keep results in Firebase, just remove from local LOBBIES
+            game_log.info("Host left a completed game, keeping results", extra={"lobby": lobby.code, "game_id": lobby.game_id})
+        else:
+            # Game was not completed - delete from Firebase
+            try:
+                write_behind.discard(lobby.game_id)
+                deleted_results = await store.delete_game(lobby.game_id)
+                game_log.info("Host left, deleted incomplete game and %d result documents", deleted_results,
+                              extra={"lobby": lobby.code, "game_id": lobby.game_id})
+            except Exception as e:
+                game_log.error("Error deleting game from Firebase", extra={"lobby": lobby.code, "game_id": lobby.game_id, "error": str(e)})
+    
+        # Remove lobby from LOBBIES (always, whether finished or not)
+        if lobby in LOBBIES:
+            await remove_lobby(lobby)
+            game_log.info("Removed lobby", extra={"lobby": lobby.code})
+    else:
+        # Regular player disconnection
+        if lobby.players:  # If there are still players left
+            lobby.broadcast({
+                "type": "player_disconnected", 
+                "message": f"{user.username} has left the game",
+                "username": user.username
+            })
+    
+        # If lobby is empty, remove it
+        if not lobby.players and not lobby.parked:
+            if lobby in LOBBIES:
+                await remove_lobby(lobby)
+                game_log.info("Removed empty lobby", extra={"lobby": lobby.code})
+
+
+async def remove_lobby(lobby):
+    """Drop a lobby from this worker and give its room code back to every worker."""
+    LOBBIES.remove(lobby)
+    lobby.drop_sessions()
+    if lobby.round_timer is not None:
+        lobby.round_timer.cancel()
+    try:
+        await router.release_room(lobby.code)
+    except Exception as e:
+        shard_log.error("Error releasing room", extra={"lobby": lobby.code, "error": str(e)})
+
+
+async def release_code(code):
+    LOBBIES.release_code(code)
+    await router.release_room(code)
+
+
+async def create_game(user: User, group_id, game_type, quiz_id):
+    # Codes are unique per worker locally; the shared claim makes them unique across workers
+    game_code = LOBBIES.allocate_code()
+    while not await router.claim_room(game_code):
+        LOBBIES.release_code(game_code)
+        game_code = LOBBIES.allocate_code()
+    try:
+        game_id = await store.create_game({
+            "host": user.user_id, 
+            "players": [], 
+            "group_id": group_id, 
+            "active": True, 
+            "game_finished": False,
+            "code": game_code,
+            "type": game_type,
+            "quiz_id": quiz_id
+        })
+    except Exception:
+        await release_code(game_code)
+        raise
+    if game_id:
+        return game_code, game_id
+    await release_code(game_code)
+
+
+# Reaper. Every HEARTBEAT_INTERVAL seconds the worker pings its sockets with {"type": "ping"}
+# frames; clients answer {"type": "pong"}. A client that has answered before and then goes
+# HEARTBEAT_TIMEOUT seconds without sending anything is closed, as is a connection that hasn't
+# authenticated within AUTH_TIMEOUT. (Clients that never pong, i.e. ones built before the
+# heartbeat, are only dropped by the protocol-level pings of the server.) Lobbies go away once
+# finished for FINISHED_LOBBY_TTL seconds, or after IDLE_LOBBY_TTL seconds without any event;
+# an unfinished one takes its Firestore game document with it, as when the host leaves.
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", "20"))
+HEARTBEAT_TIMEOUT = float(os.getenv("HEARTBEAT_TIMEOUT", "60"))
+AUTH_TIMEOUT = float(os.getenv("AUTH_TIMEOUT", "30"))
+FINISHED_LOBBY_TTL = float(os.getenv("FINISHED_LOBBY_TTL", "900"))
+IDLE_LOBBY_TTL = float(os.getenv("IDLE_LOBBY_TTL", "7200"))
+
+REAPED = METRICS.counter("quizit_reaped_total", "Connections closed and lobbies evicted by the reaper", ("what",))
+REAPED_BYTES = METRICS.counter("quizit_reaped_bytes_total", "Estimated memory held by lobbies the reaper evicted")
+
+
+def deep_size(obj, seen=None):
+    """Rough bytes held by obj and everything it refers to, not counting users, lobbies or asyncio objects."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen or isinstance(obj, (User, Lobby, RemoteSocket, TimerScheduler, asyncio.Future, asyncio.Handle, type)):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(deep_size(el, seen) for el in obj)
+    elif hasattr(obj, "__dict__"):
+        size += deep_size(vars(obj), seen)
+    return size
+
+
+def lobby_size(lobby):
+    """What evicting the lobby frees, roughly: its quiz, scores, results and answer history."""
+    seen = set()
+    return sys.getsizeof(lobby) + sum(deep_size(getattr(lobby, name), seen) for name in Lobby.__slots__)
+
+
+async def evict_lobby(lobby, reason):
+    """Close a lobby nobody is using any more; runs on the lobby's actor."""
+    frame = SharedFrame({"type": "lobby_closed", "reason": reason, "message": "This game has been closed."})
+    lobby.host.send(frame)
+    lobby.broadcast(frame)
+    for user_obj in USERS.values():
+        if user_obj["lobby"] is lobby:
+            user_obj["lobby"] = None
+    if not lobby.finished:
+        try:
+            write_behind.discard(lobby.game_id)
+            await store.delete_game(lobby.game_id)
+        except Exception as e:
+            game_log.error("Error deleting game from Firebase", extra={"lobby": lobby.code, "game_id": lobby.game_id, "error": str(e)})
+    if lobby in LOBBIES:
+        await remove_lobby(lobby)
+
+
+async def close_idle(websocket, code, reason):
+    try:
+        await asyncio.wait_for(websocket.close(code=code), 5)
+    except Exception as e:
+        conn_log.debug("Error closing idle connection", extra={"error": str(e)})
+    REAPED.inc(reason)
+
+
+async def sweep():
+    """One reaper pass: ping or close sockets, evict stale lobbies. Returns what it did."""
+    now = time.monotonic()
+    closing = []
+    pinged = 0
+    for websocket, user_obj in list(USERS.items()):
+        if isinstance(websocket, RemoteSocket):
+            continue  # Its own worker pings it
+        if not user_obj["auth"]:
+            if now - user_obj["connected_at"] > AUTH_TIMEOUT:
+                closing.append(close_idle(websocket, 1008, "unauthenticated"))
+        elif user_obj.get("heartbeat") and now - user_obj["last_seen"] > HEARTBEAT_TIMEOUT:
+            closing.append(close_idle(websocket, 1001, "unresponsive"))
+        else:
+            user_obj["user"].send({"type": "ping"})
+            pinged += 1
+    await asyncio.gather(*closing)
+
+    evicted = 0
+    reclaimed = 0
+    for lobby in LOBBIES:
+        idle = now - lobby.last_activity
+        if lobby.finished and idle > FINISHED_LOBBY_TTL:
+            reason = "finished"
+        elif idle > IDLE_LOBBY_TTL:
+            reason = "idle"
+        else:
+            continue
+        size = lobby_size(lobby)
+        await lobby.actor.call(evict_lobby, lobby, reason, bounded=False)
+        game_log.info("Evicted %s lobby after %.0fs without activity (~%d KB)", reason, idle, size // 1024,
+                      extra={"lobby": lobby.code, "game_id": lobby.game_id})
+        REAPED.inc(f"lobby_{reason}")
+        evicted += 1
+        reclaimed += size
+    REAPED_BYTES.inc(amount=reclaimed)
+    return {"pinged": pinged, "closed": len(closing), "evicted": evicted, "reclaimed_bytes": reclaimed}
+
+
+async def reap_loop():
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        try:
+            result = await sweep()
+        except Exception as e:
+            log.error("Reaper sweep failed", extra={"error": str(e)})
+            continue
+        if result["closed"] or result["evicted"]:
+            log.info("Reaper closed %d connections, evicted %d lobbies, reclaimed ~%d KB", result["closed"], result["evicted"],
+                     result["reclaimed_bytes"] // 1024)
+
+
+# Client messages. Each type has one handler in MESSAGE_HANDLERS, found with a single dict
+# lookup. Messages may name their type ({"type": "answer", "answer": 2}); older clients send
+# no "type" and are told apart by which known key they carry ({"answer": 2}).
+MESSAGE_HANDLERS = {}  # message type -> MessageSpec
+
+
+class MessageSpec:
+    def __init__(self, kind, handler, fields, before_auth=False, needs_lobby=False, host_only=False, teacher_only=False):
+        self.kind = kind
+        self.handler = handler
+        self.fields = fields  # required key -> accepted type(s)
+        self.before_auth = before_auth  # Only valid as the first message of a connection
+        self.needs_lobby = needs_lobby
+        self.host_only = host_only
+        self.teacher_only = teacher_only
+
+    def validate(self, user_obj, message):
+        """None if the message may be handled, otherwise the reason it can't."""
+        for field, types in self.fields.items():
+            if not isinstance(message.get(field), types):
+                return f"'{field}' is missing or has the wrong type"
+        if self.needs_lobby and not user_obj["lobby"]:
+            return "you are not in a game"
+        if self.host_only and user_obj["lobby"].host is not user_obj["user"]:
+            return "only the host can do that"
+        if self.teacher_only and not user_obj["user"].teacher:
+            return "only teachers can do that"
+        return None
+
+
+def message(kind, before_auth=False, needs_lobby=False, host_only=False, teacher_only=False, **fields):
+    """Register the decorated coroutine as the handler for `kind` messages."""
+    def register(handler):
+        MESSAGE_HANDLERS[kind] = MessageSpec(kind, handler, fields, before_auth, needs_lobby or host_only, host_only, teacher_only)
+        return handler
+    return register
+
+
+def message_kind(message):
+    """Handler name of a message, or "unknown". Safe as a metric label: never raw client input."""
+    kind = message.get("type")
+    if kind is not None:
+        return kind if isinstance(kind, str) and kind in MESSAGE_HANDLERS else "unknown"
+    for key in message:
+        if key in MESSAGE_HANDLERS:
+            return key
+    return "unknown"
+
+
+async def admit(websocket, user_obj, kind):
+    """Charge one message to the connection's rate limits. False if it has to be dropped."""
+    lobby = user_obj["lobby"]
+    mode = lobby.game_type.get("mode", "normal") if lobby else "normal"
+    limiter = user_obj["limiter"]
+    if limiter.allow(kind if kind in MESSAGE_HANDLERS else "unknown", mode):
+        return True
+    RATE_LIMITED.inc(kind if kind in MESSAGE_HANDLERS else "unknown")
+    user = user_obj["user"]
+    if limiter.dropped > RATE_LIMIT_MAX_DROPS:
+        message_log.warning("Client keeps flooding (%d messages dropped), disconnecting", limiter.dropped,
+                            extra={"user": user.user_id, "msg_type": kind})
+        limiter.dropped = 0
+        await websocket.close(code=1008)
+    elif time.monotonic() - limiter.warned_at >= 1:
+        limiter.warned_at = time.monotonic()
+        user.send({"type": "error", "message": "Too many messages, slow down"})
+    return False
+
+
+async def handle_message(websocket, user_obj, message, kind=None):
+    """Validate and dispatch one message from an authenticated connection (local, or relayed from another worker)."""
+    spec = MESSAGE_HANDLERS.get(kind or message_kind(message))
+    if message_log.isEnabledFor(logging.DEBUG):
+        message_log.debug("Received message", extra={
+            "msg_type": spec.kind if spec else "unknown",
+            "user": user_obj["user"].user_id,
+            "lobby": user_obj["lobby"].code if user_obj.get("lobby") else None,
+            "sampled": True
+        })
+    if spec is None or spec.before_auth:
+        user_obj["user"].send({"type": "error", "message": "Unknown message"})
+        return
+    problem = spec.validate(user_obj, message)
+    if problem:
+        user_obj["user"].send({"type": "error", "message": f"Invalid {spec.kind} message: {problem}"})
+        return
+    if user_obj["lobby"] is None:
+        await spec.handler(websocket, user_obj, message)
+    else:
+        await user_obj["lobby"].actor.call(spec.handler, websocket, user_obj, message)
+
+
+@message("user_id", before_auth=True, user_id=str)
+async def on_auth(websocket, user_obj, message):
+    await user_obj["wire"].send(websocket, {"type": "auth_attempt", "message": "trying to auth you ahh"})
+    user = await store.get_user_info(message["user_id"])
+    if user:
+        user_obj["auth"] = True
+        user_obj["user"] = User(websocket, message["user_id"], user, user_obj["wire"])
+        user_obj["profile"] = user
+        user_obj["user"].send({"type": "auth_success", "message": f"yeah wsg wats the haps {user['name']}"})
+    else:
+        await websocket.close(code=1008)
+
+
+@message("resume", before_auth=True, resume=str)
+async def on_resume(websocket, user_obj, message):
+    # Reconnect within the grace period: no Firestore, the new socket takes over the parked seat
+    lobby = SESSIONS.get(message["resume"])
+
+    def reattach():
+        user = lobby.resume(message["resume"], websocket, user_obj["wire"])
+        if user:
+            user_obj.update(auth=True, user=user, lobby=lobby)
+            lobby.replay(user)
+        return user
+
+    user = await lobby.actor.call(reattach) if lobby else None
+    if user:
+        game_log.info("Player resumed", extra={"lobby": lobby.code, "user": user.user_id})
+    else:
+        await user_obj["wire"].send(websocket, {"type": "resume_failed", "message": "Session expired, please join again"})
+
+
+@message("quiz", teacher_only=True, quiz=str)
+async def on_create_game(websocket, user_obj, message):
+    if user_obj["lobby"]:
+        return
+    user_obj["user"].send({"type": "creating_game", "message": "creating..."})
+    game_type = message.get("game_type") or {}
+    quiz_id = message["quiz"]
+    code, game_id = await create_game(user_obj["user"], message.get("group"), game_type, quiz_id)
+    try:
+        quiz = await store.fetch_quiz(quiz_id)
+    except Exception:
+        await release_code(code)
+        raise
+    user_obj["lobby"] = Lobby(user_obj["user"], quiz, game_id, code, game_type)
+    LOBBIES.add(user_obj["lobby"])
+    user_obj["user"].send({"type": "game_created", "message": f"done! room code: {code}", "code": code})
+    user_obj["user"].send({"type": "quiz_info", "message": f"quiz questions: {quiz['questions']}", "questions": quiz["questions"]})
+    game_log.info("Game created for quiz %s (%d lobbies on this worker)", quiz_id, len(LOBBIES),
+                  extra={"lobby": code, "game_id": game_id, "user": user_obj["user"].user_id})
+
+
+@message("code", code=str)
+async def on_join(websocket, user_obj, message):
+    if user_obj["lobby"]:
+        return
+    user_obj["user"].send({"type": "joining", "message": "joining..."})
+    
+    target_lobby = LOBBIES.get(message["code"])
+    
+    async def join():
+        await target_lobby.connect(user_obj["user"])
+        user_obj["lobby"] = target_lobby
+        user_obj["user"].send({
+            "type": "joined", 
+            "message": "Joined! Waiting for start", 
+            "game_settings": target_lobby.game_settings(),
+            "resume_token": user_obj["user"].resume_token
+        })
+
+    if target_lobby:
+        await target_lobby.actor.call(join)
+        game_log.debug("Player joined", extra={"lobby": target_lobby.code, "user": user_obj["user"].user_id})
+    else:
+        user_obj["user"].send({"type": "error", "message": "Invalid room code!"})
+
+
+@message("start", host_only=True)
+async def on_start(websocket, user_obj, message):
+    await user_obj["lobby"].start_game()
+
+
+@message("next", host_only=True)
+async def on_next(websocket, user_obj, message):
+    await user_obj["lobby"].start_next_round()
+
+
+@message("show_results", host_only=True)
+async def on_show_results(websocket, user_obj, message):
+    await user_obj["lobby"].finish_game()
+
 
+@message("pause_timer", host_only=True)
+async def on_pause_timer(websocket, user_obj, message):
+    user_obj["lobby"].control_timer("pause")
 
 
+@message("resume_timer", host_only=True)
+async def on_resume_timer(websocket, user_obj, message):
+    user_obj["lobby"].control_timer("resume")
+
+
+@message("extend_timer", host_only=True, extend_timer=(int, float))
+async def on_extend_timer(websocket, user_obj, message):
+    """{"extend_timer": 15} adds 15 seconds to the current question."""
+    user_obj["lobby"].control_timer("extend", message["extend_timer"])
+
+
+@message("pong")
+async def on_pong(websocket, user_obj, message):
+    user_obj["heartbeat"] = True  # This client answers pings, hold it to HEARTBEAT_TIMEOUT
+
+
+@message("players_snapshot", host_only=True)
+async def on_players_snapshot(websocket, user_obj, message):
+    user_obj["lobby"].send_members_snapshot()
+
+
+@message("answer", needs_lobby=True, answer=(int, float, str, list))
+async def on_answer(websocket, user_obj, message):
+    await user_obj["lobby"].save_answer(user_obj["user"], message["answer"])
+
+
+async def close_kicked(websocket, user: User):
+    await user.flush()
+    user.stop()
+    try:
+        await websocket.close(code=1008)
+    except Exception as e:
+        conn_log.info("Error closing websocket", extra={"user": user.user_id, "error": str(e)})
+
+
+@message("report", needs_lobby=True, report=str)
+async def on_report(websocket, user_obj, message):
+    """Tab switch reports: counted in tab_tracking mode, a kick in lockdown mode."""
+    if message["report"] != "switched_tabs":
+        message_log.warning("Unknown report type: %s", message["report"], extra={"user": user_obj["user"].user_id, "msg_type": "report"})
+        return
+    lobby = user_obj["lobby"]
+    user = user_obj["user"]
+    game_mode = lobby.game_type.get("mode", "normal")
+    
+    if game_mode == "tab_tracking":
+        # One switch usually arrives as several reports; count it once
+        now = monotonic_ms()
+        if now - lobby.last_tab_switch.get(user.user_id, -REPORT_COALESCE_MS) < REPORT_COALESCE_MS:
+            game_log.debug("Tab switch report coalesced", extra={"lobby": lobby.code, "user": user.user_id, "sampled": True})
+            return
+        lobby.last_tab_switch[user.user_id] = now
+        
+        # Track tab switches
+        if user.user_id in lobby.tab_switches:
+            lobby.tab_switches[user.user_id] += 1
+        else:
+            lobby.tab_switches[user.user_id] = 1
+        
+        game_log.info("Tab switch recorded (%d so far)", lobby.tab_switches[user.user_id], extra={"lobby": lobby.code, "user": user.user_id})
+        
+        # Notify host about tab switch
+        try:
+            lobby.host.send({
+                "type": "tab_switch_report",
+                "username": user.username,
+                "user_id": user.user_id,
+                "total_switches": lobby.tab_switches[user.user_id]
+            })
+        except Exception as e:
+            game_log.error("Error notifying host", extra={"lobby": lobby.code, "error": str(e)})
+        
+        # Acknowledge to the student
+        try:
+            user.send({
+                "type": "tab_switch_recorded",
+                "message": "Переключение вкладки зафиксировано"
+            })
+        except Exception as e:
+            game_log.error("Error acknowledging student", extra={"lobby": lobby.code, "user": user.user_id, "error": str(e)})
+    
+    elif game_mode == "lockdown":
+        # Remove player in lockdown mode
+        game_log.info("Lockdown violation, removing player", extra={"lobby": lobby.code, "user": user.user_id})
+        
+        # Notify the player they are being removed
+        try:
+            user.send({
+                "type": "kicked",
+                "reason": "lockdown_violation",
+                "message": "Вы были удалены из игры за нарушение режима блокировки (выход из полноэкранного режима)"
+            })
+        except Exception as e:
+            game_log.error("Error notifying kicked player", extra={"lobby": lobby.code, "user": user.user_id, "error": str(e)})
+        
+        # Notify host about the violation
+        try:
+            lobby.host.send({
+                "type": "player_kicked",
+                "username": user.username,
+                "user_id": user.user_id,
+                "reason": "Нарушение режима блокировки"
+            })
+        except Exception as e:
+            game_log.error("Error notifying host", extra={"lobby": lobby.code, "error": str(e)})
+        
+        # Remove from lobby (this also sends the host a player_left delta)
+        lobby.remove_player(user)
+        
+        # Notify remaining players
+        try:
+            lobby.broadcast({
+                "type": "player_removed",
+                "username": user.username,
+                "reason": "Нарушение режима блокировки"
+            })
+        except Exception as e:
+            game_log.error("Error broadcasting removal", extra={"lobby": lobby.code, "error": str(e)})
+        
+        # Close the user's connection once the kick notice has been written. That waits on the
+        # socket, so it happens off the lobby's actor; anything the client sends meanwhile is refused.
+        user_obj.update(auth=False, lobby=None)
+        asyncio.create_task(close_kicked(websocket, user))
+    
+    else:
+        game_log.debug("Game mode %s does not track tab switches", game_mode, extra={"lobby": lobby.code})
+
+
+async def main_handler(websocket: WebSocket):
+    """Main WebSocket handler."""
+    wire = negotiate_wire(websocket)
+    await websocket.accept(subprotocol=wire.name)
+    # Log when a client connects
+    client_info = f"{websocket.client.host}:{websocket.client.port}" if websocket.client else "unknown"
+    conn_log.debug("New connection from %s (%d open)", client_info, len(USERS) + 1)
+    await wire.send(websocket, {"type": "welcome", "message": "WELCOME! you have to auth first though..."})
+    USERS[websocket] = {"auth": False, "user": None, "lobby": None, "wire": wire, "limiter": RateLimiter(),
+                        "connected_at": time.monotonic(), "last_seen": time.monotonic()}
+    try:
+        # Handle incoming messages
+        while True:
+            message = await receive_message(websocket, wire)
+            user_obj = USERS[websocket]
+            user_obj["last_seen"] = time.monotonic()
+            kind = message_kind(message)
+            MESSAGES_RECEIVED.inc(kind)
+
+            if user_obj["auth"] is False:
+                spec = MESSAGE_HANDLERS.get(kind)
+                if spec is None or not spec.before_auth or spec.validate(user_obj, message):
+                    # The first message has to be a well-formed auth or resume
+                    await websocket.close(code=1008)
+                    continue
+                await spec.handler(websocket, user_obj, message)
+                continue
+
+            if not await admit(websocket, user_obj, kind):
+                continue
+
+            # Heartbeats concern this socket only: never relayed, and no activity for the lobby
+            if kind == "pong":
+                await on_pong(websocket, user_obj, message)
+                continue
+
+            # Players whose lobby lives on another worker: relay everything to the owning worker
+            if user_obj.get("owner") or (kind == "code" and await router.route(websocket, user_obj, message)):
+                await router.forward(user_obj, message)
+                continue
+
+            await handle_message(websocket, user_obj, message, kind)
 
     except WebSocketDisconnect:
         # Log when the client disconnects
-        client_info = f"{websocket.client.host}:{websocket.client.port}" if websocket.client else "unknown"
-        print(f"Connection closed: {client_info}")
-    except Exception as e:
+        conn_log.debug("Connection closed: %s", client_info)
+    except Exception:
         # Log other errors
-        client_info = f"{websocket.client.host}:{websocket.client.port}" if websocket.client else "unknown"
-        print(f"Connection closed with error: {client_info}, reason: {e}")
+        conn_log.warning("Connection closed with error: %s", client_info, exc_info=True)
     finally:
         # Always clean up user data when connection closes (normal or error)
-        client_info = f"{websocket.client.host}:{websocket.client.port}" if websocket.client else "unknown"
-        print(f"Cleaning up connection: {client_info}")
         await cleanup_user(websocket)
 
 
@@ -863,7 +3120,356 @@ async def websocket_endpoint(websocket: WebSocket):
     await main_handler(websocket)
 
 
+@app.on_event("startup")
+async def startup():
+    """Join the other workers: subscribe to this worker's relay channel."""
+    await router.start()
+    round_timers.start()
+    asyncio.create_task(watch_loop_lag())
+    asyncio.create_task(reap_loop())
+    shard_log.info("Routing through %s", PUBSUB_URL.split("@")[-1], extra={"worker": WORKER_ID})
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Write out buffered game updates, then release the Firestore worker threads."""
+    round_timers.stop()
+    await write_behind.flush()
+    await router.close()
+    store.close()
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint."""
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/")
 async def root():
     """Health check endpoint."""
-    return JSONResponse({"status": "ok", "service": "QuizIT Backend"})
\ No newline at end of file
+    return JSONResponse({"status": "ok", "service": "QuizIT Backend"})
+
+
+# Homework. Students post their answers here instead of writing a graded submission themselves:
+# the server grades them against the quiz with the same graders as a live round and, in the same
+# batch as the submission, adds the result to homework_stats/{homework_id}. That document holds
+# running sums (submissions, completed, cheated, late, score_sum, percentage_sum) and per-question
+# correct/wrong/missed counts, so a teacher's view reads one document instead of every submission.
+HOMEWORK_SUBMISSIONS = METRICS.counter("quizit_homework_submissions_total", "Homework submissions, by outcome", ("outcome",))
+HOMEWORK_STATUSES = ("completed", "cheated")
+
+
+def parse_timestamp(value):
+    """Aware datetime from a Firestore timestamp, an ISO string or epoch milliseconds, else None."""
+    if isinstance(value, datetime.datetime):
+        return value if value.tzinfo else value.replace(tzinfo=datetime.timezone.utc)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return datetime.datetime.fromtimestamp(value / 1000, datetime.timezone.utc)
+    if isinstance(value, str):
+        try:
+            return parse_timestamp(datetime.datetime.fromisoformat(value))
+        except ValueError:
+            return None
+    return None
+
+
+def is_missed(answer):
+    if isinstance(answer, str):
+        return not answer.strip()
+    return answer is None or answer == []
+
+
+def grade_homework(questions, answers, cheated=False):
+    """Grade a whole homework attempt with the live-round graders.
+
+    Returns the submission's score fields, its answer records and each question's outcome
+    ("correct", "wrong" or "missed"). A cheated attempt scores nothing and counts as all missed.
+    """
+    score = max_score = 0
+    counts = {"correct": 0, "wrong": 0, "missed": 0}
+    records = []
+    outcomes = []
+    for index, question in enumerate(questions):
+        grader = compile_grader(question)
+        answer = answers[index] if index < len(answers) else None
+        if cheated or is_missed(answer):
+            outcome = "missed"
+        else:
+            outcome = "correct" if grader.grade(answer) else "wrong"
+        points_earned = grader.points if outcome == "correct" else 0
+        score += points_earned
+        max_score += grader.points
+        counts[outcome] += 1
+        outcomes.append(outcome)
+        question_type = question.get("type", "single")
+        records.append({
+            "question_index": index,
+            "question_text": question.get("question", ""),
+            "student_answer": ("" if question_type == "text" else []) if answer is None else answer,
+            "correct_answer": grader.correct_answer,
+            "is_correct": outcome == "correct",
+            "points_earned": points_earned,
+            "max_points": grader.points,
+            "question_type": question_type,
+        })
+    total = len(questions)
+    fields = {
+        "score": score,
+        "max_score": max_score,
+        "total_questions": total,
+        "correct_answers": counts["correct"],
+        "wrong_answers": counts["wrong"],
+        "missed_answers": counts["missed"],
+        # Rounded half up, like Math.round on the client
+        "percentage": math.floor(counts["correct"] * 100 / total + 0.5) if total else 0,
+    }
+    return fields, records, outcomes
+
+
+def stats_increments(fields, outcomes, status, is_late):
+    """The homework_stats update that adds one graded submission to the running totals."""
+    return {
+        "total_questions": fields["total_questions"],
+        "max_score": fields["max_score"],
+        "submissions": firestore.Increment(1),
+        **{name: firestore.Increment(int(status == name)) for name in HOMEWORK_STATUSES},
+        "late": firestore.Increment(int(is_late)),
+        "score_sum": firestore.Increment(fields["score"]),
+        "percentage_sum": firestore.Increment(fields["percentage"]),
+        # Map keys have to be strings in Firestore
+        "questions": {str(index): {outcome: firestore.Increment(1)} for index, outcome in enumerate(outcomes)},
+        "updated_at": firestore.SERVER_TIMESTAMP,
+    }
+
+
+def submission_outcomes(submission):
+    """Per-question outcomes of a saved submission, including ones the client graded itself."""
+    outcomes = []
+    for record in submission.get("answers", []):
+        if submission.get("status") == "cheated" or is_missed(record.get("student_answer")):
+            outcomes.append("missed")
+        else:
+            outcomes.append("correct" if record.get("is_correct") else "wrong")
+    return outcomes
+
+
+def stats_from_submissions(submissions):
+    """A full homework_stats document worked out from the submissions already saved."""
+    stats = {
+        "total_questions": 0,
+        "max_score": 0,
+        "submissions": len(submissions),
+        **{name: 0 for name in HOMEWORK_STATUSES},
+        "late": 0,
+        "score_sum": 0,
+        "percentage_sum": 0,
+        "questions": {},
+        "updated_at": firestore.SERVER_TIMESTAMP,
+    }
+    for submission in submissions:
+        stats["total_questions"] = submission.get("total_questions", stats["total_questions"])
+        stats["max_score"] = submission.get("max_score", stats["max_score"])
+        status = submission.get("status", "completed")
+        if status in HOMEWORK_STATUSES:
+            stats[status] += 1
+        stats["late"] += int(bool(submission.get("is_late")))
+        stats["score_sum"] += submission.get("score", 0)
+        stats["percentage_sum"] += submission.get("percentage", 0)
+        for index, outcome in enumerate(submission_outcomes(submission)):
+            counts = stats["questions"].setdefault(str(index), {})
+            counts[outcome] = counts.get(outcome, 0) + 1
+    return stats
+
+
+async def ensure_homework_stats(homework_id):
+    """The homework's stats document, built from its submissions if it doesn't exist yet.
+
+    Homework submitted before the running totals existed has submissions but no stats. Every
+    submission saved through this server calls this first, so increments only ever land on a
+    document that already counts the older submissions. Two workers racing to build it write the
+    same totals; create() lets one win and the other reads the result.
+    """
+    stats = await store.fetch_homework_stats(homework_id)
+    if stats is not None:
+        return stats
+    submissions = await store.fetch_submissions(homework_id)
+    try:
+        await store.create_homework_stats(homework_id, stats_from_submissions(submissions))
+        homework_log.info("Built stats from %d existing submissions", len(submissions), extra={"homework": homework_id})
+    except google_exceptions.AlreadyExists:
+        pass
+    return await store.fetch_homework_stats(homework_id)
+
+
+def http_error(status_code, message):
+    return JSONResponse({"error": message}, status_code=status_code)
+
+
+# Homework requests are made by the signed-in student and carry their Firebase ID token as
+# "Authorization: Bearer <token>"; the submission is filed under the token's uid. Google's
+# signing certificates are fetched once and reused until their Cache-Control max-age runs out.
+FIREBASE_PROJECT_ID = os.getenv("FIREBASE_PROJECT_ID") or db.project
+FIREBASE_CERTS_URL = "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+
+
+class TokenVerifier:
+    """Checks Firebase ID tokens against Google's published certificates. Blocking: run it off the loop."""
+
+    def __init__(self, project_id, certs_url=FIREBASE_CERTS_URL):
+        self.project_id = project_id
+        self.certs_url = certs_url
+        self.certs = {}
+        self.certs_expire = 0.0
+
+    def fetch_certs(self):
+        if time.monotonic() < self.certs_expire:
+            return self.certs
+        response = AuthRequest()(self.certs_url, method="GET")
+        if response.status != 200:
+            raise GoogleAuthError(f"Could not fetch token certificates: HTTP {response.status}")
+        max_age = 3600
+        for directive in response.headers.get("cache-control", "").split(","):
+            name, _, value = directive.strip().partition("=")
+            if name == "max-age" and value.isdigit():
+                max_age = int(value)
+        self.certs = json.loads(response.data)
+        self.certs_expire = time.monotonic() + max_age
+        return self.certs
+
+    def verify(self, token):
+        """uid of a valid, unexpired ID token issued for this project; raises ValueError otherwise."""
+        claims = jwt.decode(token, certs=self.fetch_certs(), audience=self.project_id)
+        if claims.get("iss") != f"https://securetoken.google.com/{self.project_id}" or not claims.get("sub"):
+            raise ValueError("Not a Firebase ID token for this project")
+        return claims["sub"]
+
+
+token_verifier = TokenVerifier(FIREBASE_PROJECT_ID)
+
+
+async def authenticated_uid(request):
+    """uid from the request's bearer token, or None if it's missing or doesn't verify."""
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return await asyncio.get_running_loop().run_in_executor(store.executor, token_verifier.verify, token.strip())
+    except (ValueError, GoogleAuthError) as e:
+        homework_log.info("Rejected ID token", extra={"error": str(e)})
+        return None
+
+
+async def is_assigned(homework, student_id):
+    """Whether the homework is set for this student: its assignee list if it has one, else its whole group."""
+    assigned = homework.get("assigned_to_students")
+    if isinstance(assigned, list):
+        return student_id in assigned
+    group_id = homework.get("group_id")
+    group = await store.fetch_group(group_id) if isinstance(group_id, str) and group_id else None
+    return group is not None and student_id in group.get("students", [])
+
+
+@app.post("/homework/{homework_id}/submissions")
+@timed("submit_homework")
+async def submit_homework(homework_id: str, request: Request):
+    """Grade the signed-in student's homework answers, save the submission and update the homework stats.
+
+    Body: {"student_name", "answers": [...], "tab_switches", "time_started",
+    "status": "completed" | "cheated", "violation_reason"}. Answers are in quiz order.
+    """
+    student_id = await authenticated_uid(request)
+    if student_id is None:
+        HOMEWORK_SUBMISSIONS.inc("unauthenticated")
+        return http_error(401, "A valid Firebase ID token is required")
+    try:
+        body = await request.json()
+    except ValueError:
+        return http_error(400, "Body must be JSON")
+    answers = body.get("answers", []) if isinstance(body, dict) else None
+    status = body.get("status", "completed") if isinstance(body, dict) else None
+    if not isinstance(answers, list) or status not in HOMEWORK_STATUSES:
+        HOMEWORK_SUBMISSIONS.inc("invalid")
+        return http_error(400, "Expected an answers list and a status of completed or cheated")
+
+    homework, student = await asyncio.gather(store.fetch_homework(homework_id), store.get_user_info(student_id))
+    if homework is None:
+        return http_error(404, "Homework not found")
+    if student is None or not await is_assigned(homework, student_id):
+        HOMEWORK_SUBMISSIONS.inc("not_assigned")
+        return http_error(403, "This homework isn't assigned to you")
+    quiz, _ = await asyncio.gather(store.fetch_quiz(homework["quiz_id"]), ensure_homework_stats(homework_id))
+    questions = quiz["questions"]
+    if len(answers) > len(questions):
+        HOMEWORK_SUBMISSIONS.inc("invalid")
+        return http_error(400, "More answers than questions")
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    deadline = parse_timestamp(homework.get("deadline"))
+    is_late = deadline is not None and now > deadline
+    time_started = parse_timestamp(body.get("time_started"))
+    fields, records, outcomes = grade_homework(questions, answers, cheated=status == "cheated")
+    time_limit_minutes = homework.get("time_limit_minutes")
+    tab_switches = body.get("tab_switches", 0)
+    submission = {
+        "student_id": student_id,
+        "student_name": body.get("student_name") or f"{student.get('name', '')} {student.get('lastName', '')}".strip(),
+        "submitted_at": firestore.SERVER_TIMESTAMP,
+        **fields,
+        "is_late": is_late,
+        "tab_switches": tab_switches if isinstance(tab_switches, int) else 0,
+        "answers": records,
+        "status": status,
+        "time_started": time_started,
+        "time_completed": firestore.SERVER_TIMESTAMP,
+        "time_taken_seconds": max(int((now - time_started).total_seconds()), 0) if time_started else 0,
+        "time_limit_seconds": time_limit_minutes * 60 if time_limit_minutes else None,
+    }
+    if status == "cheated":
+        submission["violation_reason"] = str(body.get("violation_reason", ""))
+
+    try:
+        await store.save_submission(homework_id, student_id, submission, stats_increments(fields, outcomes, status, is_late))
+    except google_exceptions.AlreadyExists:
+        HOMEWORK_SUBMISSIONS.inc("duplicate")
+        return http_error(409, "Homework already submitted")
+    HOMEWORK_SUBMISSIONS.inc(status)
+    homework_log.info("Submission graded (%s%s): %d/%d points", status, ", late" if is_late else "", fields["score"], fields["max_score"],
+                      extra={"homework": homework_id, "user": student_id})
+    return JSONResponse({"status": "saved", **fields, "is_late": is_late})
+
+
+@app.get("/homework/{homework_id}/stats")
+async def homework_stats(homework_id: str, request: Request):
+    """Aggregated results of a homework, with the averages worked out from the running sums. Teacher only."""
+    teacher_id = await authenticated_uid(request)
+    if teacher_id is None:
+        return http_error(401, "A valid Firebase ID token is required")
+    homework = await store.fetch_homework(homework_id)
+    if homework is None or homework.get("teacher_id") != teacher_id:
+        return http_error(403, "Only the homework's teacher can see its stats")
+    stats = await ensure_homework_stats(homework_id)
+    submissions = stats.get("submissions", 0)
+    stats["average_score"] = stats.get("score_sum", 0) / submissions if submissions else 0
+    stats["average_percentage"] = stats.get("percentage_sum", 0) / submissions if submissions else 0
+    return JSONResponse(jsonable_encoder(stats))
+
+
+# permessage-deflate for `python main.py`. Every socket keeps its own zlib state for the life of
+# the connection, so the window and memLevel decide memory per client. uvicorn's sans-I/O
+# websockets protocol negotiates a 12-bit window with memLevel 5 (roughly 40 KB of zlib state
+# per socket rather than nearly 300 KB at zlib's defaults), which is what this server wants.
+WS_DEFLATE = os.getenv("WS_DEFLATE", "1") == "1"
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        app,
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        ws="websockets-sansio",
+        ws_per_message_deflate=WS_DEFLATE,
+        ws_max_size=MAX_MESSAGE_SIZE,
+    )
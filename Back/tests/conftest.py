@@ -0,0 +1,11 @@
+"""Tests run main.py on top of fake_firestore, the same way bench.py and loadtest.py do."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import fake_firestore  # noqa: E402
+
+fake_firestore.install()
@@ -0,0 +1,48 @@
+"""Slow Firestore calls must not stall the event loop: they run on FirestoreStore's thread pool."""
+
+import asyncio
+import time
+
+import main
+
+FIRESTORE_DELAY = 0.5
+TICK = 0.01
+
+
+async def heartbeat(gaps, stop):
+    """Sleep TICK over and over, recording how long each tick really took."""
+    last = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(TICK)
+        now = time.perf_counter()
+        gaps.append(now - last)
+        last = now
+
+
+def test_loop_keeps_ticking_during_slow_firestore_calls(monkeypatch):
+    monkeypatch.setattr(main.db, "latency", FIRESTORE_DELAY)
+    main.db.seed("users/slow-user", {"name": "Slow", "lastName": "User", "isTeacher": True})
+    main.db.seed("questions/slow-q", {"question": "?", "type": "single", "correct": [0], "point": 1})
+    main.db.seed("quizes/slow-quiz", {"questions": ["slow-q"]})
+
+    async def scenario():
+        gaps, stop = [], asyncio.Event()
+        ticker = asyncio.create_task(heartbeat(gaps, stop))
+        started = time.perf_counter()
+        profile, quiz, game_id = await asyncio.gather(
+            main.store.get_user_info("slow-user"),
+            main.store.fetch_quiz("slow-quiz"),
+            main.store.create_game({"host": "slow-user", "players": []}),
+        )
+        await main.store.update_game(game_id, {"active": True})
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await ticker
+        return profile, quiz, elapsed, gaps
+
+    profile, quiz, elapsed, gaps = asyncio.run(scenario())
+    assert profile["name"] == "Slow"
+    assert len(quiz["questions"]) == 1
+    assert elapsed >= 2 * FIRESTORE_DELAY  # The calls really were slow...
+    assert len(gaps) >= elapsed / TICK / 2  # ...yet the heartbeat kept running the whole time
+    assert max(gaps) < 0.1, f"event loop stalled for {max(gaps) * 1000:.0f} ms"
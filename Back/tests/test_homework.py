@@ -0,0 +1,45 @@
+"""Homework stats for homework whose submissions predate homework_stats."""
+
+from starlette.testclient import TestClient
+
+import main
+
+
+def legacy_submission(student_id, score, answers, status="completed", is_late=False):
+    """A submission as the old client wrote it, graded in the browser."""
+    return {
+        "student_id": student_id,
+        "score": score,
+        "max_score": 2,
+        "total_questions": 2,
+        "percentage": score * 50,
+        "status": status,
+        "is_late": is_late,
+        "answers": [{"student_answer": answer, "is_correct": correct} for answer, correct in answers],
+    }
+
+
+def test_stats_are_built_from_existing_submissions(monkeypatch):
+    monkeypatch.setattr(main.token_verifier, "verify", lambda token: token)
+    main.db.seed("questions/legacy-q0", {"question": "a", "type": "single", "correct": [0], "point": 1})
+    main.db.seed("questions/legacy-q1", {"question": "b", "type": "single", "correct": [1], "point": 1})
+    main.db.seed("quizes/legacy-quiz", {"questions": ["legacy-q0", "legacy-q1"]})
+    main.db.seed("homework/legacy-hw", {"quiz_id": "legacy-quiz", "teacher_id": "legacy-teacher",
+                                        "assigned_to_students": ["s1", "s2", "s3"]})
+    main.db.seed("users/s3", {"name": "S", "lastName": "3"})
+    main.db.seed("homework/legacy-hw/submissions/s1", legacy_submission("s1", 2, [([0], True), ([1], True)]))
+    main.db.seed("homework/legacy-hw/submissions/s2", legacy_submission("s2", 0, [([], False), ([], False)], "cheated", True))
+
+    with TestClient(main.app) as client:
+        stats = client.get("/homework/legacy-hw/stats", headers={"Authorization": "Bearer legacy-teacher"}).json()
+        assert stats["submissions"] == 2 and stats["completed"] == 1 and stats["cheated"] == 1 and stats["late"] == 1
+        assert stats["average_score"] == 1
+        assert stats["questions"] == {"0": {"correct": 1, "missed": 1}, "1": {"correct": 1, "missed": 1}}
+
+        # A new submission adds to the built totals rather than starting from zero
+        response = client.post("/homework/legacy-hw/submissions", headers={"Authorization": "Bearer s3"},
+                               json={"answers": [[0], [0]]})
+        assert response.status_code == 200
+        stats = client.get("/homework/legacy-hw/stats", headers={"Authorization": "Bearer legacy-teacher"}).json()
+    assert stats["submissions"] == 3 and stats["completed"] == 2
+    assert stats["questions"]["1"] == {"correct": 1, "missed": 1, "wrong": 1}
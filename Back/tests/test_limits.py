@@ -0,0 +1,24 @@
+"""Inbound size limit: MAX_MESSAGE_SIZE counts bytes, whatever the frame type."""
+
+import json
+
+import pytest
+from starlette.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+import main
+
+
+@pytest.mark.parametrize("text, closed", [("a" * 60, False), ("ж" * 60, True)])
+def test_text_frames_are_measured_in_utf8_bytes(monkeypatch, text, closed):
+    monkeypatch.setattr(main, "MAX_MESSAGE_SIZE", 100)
+    with TestClient(main.app) as client:
+        with client.websocket_connect("/ws") as ws:
+            ws.receive_text()
+            ws.send_text(json.dumps({"user_id": text}, ensure_ascii=False))
+            if closed:
+                with pytest.raises(WebSocketDisconnect) as disconnect:
+                    ws.receive_text()
+                assert disconnect.value.code == 1009
+            else:
+                assert json.loads(ws.receive_text())["type"] == "auth_attempt"
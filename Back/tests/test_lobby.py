@@ -0,0 +1,79 @@
+"""Seats of a lobby: parking a dropped player and joining again with the same account."""
+
+import asyncio
+
+import main
+
+
+class NullSocket:
+    async def send_text(self, data):
+        pass
+
+    async def send_bytes(self, data):
+        pass
+
+    async def close(self, code=1000):
+        pass
+
+
+def make_user(user_id, teacher=False):
+    return main.User(NullSocket(), user_id, {"name": user_id, "lastName": "", "isTeacher": teacher})
+
+
+def make_lobby():
+    quiz = {"questions": [
+        {"question": f"Q{i}", "type": "single", "options": ["a", "b"], "correct": 0, "timeLimit": 60, "point": 1}
+        for i in range(2)
+    ]}
+    return main.Lobby(make_user("seat-host", teacher=True), quiz, "seat-game", "SEAT01", {"tick_ms": 0})
+
+
+def test_rejoin_by_code_takes_over_the_parked_seat():
+    async def scenario():
+        lobby = make_lobby()
+        first = make_user("seat-player")
+        await lobby.connect(first)
+        await lobby.start_game()
+        await lobby.save_answer(first, 0)
+        old_token = first.resume_token
+
+        # The socket drops, then the same account joins by code instead of resuming
+        first.stop()
+        assert lobby.park(first)
+        second = make_user("seat-player")
+        await lobby.connect(second)
+        assert old_token not in lobby.parked and old_token not in main.SESSIONS
+        assert lobby.score_board["seat-player"][1] == 1  # Kept from the parked seat
+
+        # An expiry that was already queued for the old seat must leave the new one alone
+        lobby.expire(old_token)
+        await lobby.start_next_round()
+        await lobby.save_answer(second, 0)
+        assert lobby.score_board["seat-player"][1] == 2
+        assert lobby.players == [second]
+
+        lobby.remove_player(second)
+        assert "seat-player" not in lobby.score_board
+        lobby.drop_sessions()
+        lobby.host.stop()
+        second.stop()
+
+    asyncio.run(scenario())
+
+
+def test_leaving_one_of_two_live_seats_keeps_the_account_rows():
+    async def scenario():
+        lobby = make_lobby()
+        tabs = [make_user("two-tabs"), make_user("two-tabs")]
+        for tab in tabs:
+            await lobby.connect(tab)
+        await lobby.start_game()
+        lobby.remove_player(tabs[0])
+        await lobby.save_answer(tabs[1], 0)
+        assert lobby.score_board["two-tabs"][1] == 1
+        lobby.drop_sessions()
+        lobby.host.stop()
+        for tab in tabs:
+            tab.stop()
+
+    asyncio.run(scenario())
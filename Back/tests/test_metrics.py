@@ -0,0 +1,71 @@
+"""/metrics: what clients can put in it, and what the instrumentation costs per message."""
+
+import asyncio
+import json
+import time
+
+from starlette.testclient import TestClient
+
+import main
+
+
+def test_label_values_are_escaped():
+    counter = main.Counter("quizit_test_escape_total", "Escaping", ("type",))
+    counter.inc('a"b\\c\nd')
+    assert list(counter.samples()) == ['quizit_test_escape_total{type="a\\"b\\\\c\\nd"} 1']
+
+
+def test_message_types_from_clients_do_not_become_labels():
+    injected = '"}\nquizit_fake_metric 999\n'
+    with TestClient(main.app) as client:
+        with client.websocket_connect("/ws") as ws:
+            ws.receive_text()
+            ws.send_text(json.dumps({"type": ["not", "a", "string"]}))
+        with client.websocket_connect("/ws") as ws:
+            ws.receive_text()
+            ws.send_text(json.dumps({"type": injected}))
+        text = client.get("/metrics").text
+    assert not any(line.startswith("quizit_fake_metric") for line in text.splitlines())
+    assert all(kind == "unknown" or kind in main.MESSAGE_HANDLERS for kind, in main.MESSAGES_RECEIVED.values)
+    assert main.MESSAGES_RECEIVED.values[("unknown",)] >= 2
+
+
+# bench.py metrics checks the same thing against a 5 us budget for manual runs. This allows
+# three times that, so a busy CI machine doesn't fail it, while still catching a real regression
+# such as a lock, a label lookup or a log call on the per-message path.
+METRICS_BUDGET_US = 5.0
+METRICS_BUDGET_MARGIN = 3
+MESSAGES = 20_000
+
+
+def test_instrumentation_stays_under_budget():
+    message = {"answer": 1}
+
+    async def handler():
+        pass
+
+    timed_handler = main.timed("test_budget")(handler)
+
+    async def plain():
+        for _ in range(MESSAGES):
+            await handler()
+
+    async def instrumented():
+        for _ in range(MESSAGES):
+            main.MESSAGES_RECEIVED.inc(main.message_kind(message))
+            await timed_handler()
+
+    async def best_of(fn, repeat=5):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            await fn()
+            timings.append(time.perf_counter() - started)
+        return min(timings)
+
+    async def scenario():
+        return await best_of(plain), await best_of(instrumented)
+
+    plain_s, instrumented_s = asyncio.run(scenario())
+    overhead_us = (instrumented_s - plain_s) / MESSAGES * 1e6
+    assert overhead_us <= METRICS_BUDGET_US * METRICS_BUDGET_MARGIN, f"{overhead_us:.2f} us/message"
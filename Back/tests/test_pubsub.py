@@ -0,0 +1,213 @@
+"""RedisPubSub against an in-process stand-in that speaks just enough RESP."""
+
+import asyncio
+
+import pytest
+
+import main
+
+
+class RespServer:
+    """Tiny Redis on 127.0.0.1: SET NX, GET, the release EVAL, PUBLISH and SUBSCRIBE."""
+
+    def __init__(self):
+        self.keys = {}
+        self.subscribers = {}  # channel -> [writer]
+        self.writers = set()
+        self.stalled = False  # Swallow commands without answering
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return f"redis://127.0.0.1:{self.server.sockets[0].getsockname()[1]}"
+
+    def drop(self):
+        """Cut every client connection, like a Redis restart."""
+        for writer in list(self.writers):
+            writer.close()
+        self.writers.clear()
+        self.subscribers.clear()
+
+    async def close(self):
+        self.drop()
+        self.server.close()
+        await self.server.wait_closed()
+
+    @staticmethod
+    def bulk(value):
+        return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+
+    async def read_command(self, reader):
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int((await reader.readline())[1:-2])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                args = await self.read_command(reader)
+                command = args[0].upper()
+                if self.stalled:
+                    continue
+                if command == b"SET":
+                    if b"NX" in args and args[1] in self.keys:
+                        writer.write(b"$-1\r\n")
+                    else:
+                        self.keys[args[1]] = args[2]
+                        writer.write(b"+OK\r\n")
+                elif command == b"GET":
+                    writer.write(self.bulk(self.keys.get(args[1])))
+                elif command == b"EVAL":
+                    deleted = self.keys.get(args[3]) == args[4]
+                    if deleted:
+                        del self.keys[args[3]]
+                    writer.write(b":%d\r\n" % deleted)
+                elif command == b"PUBLISH":
+                    receivers = self.subscribers.get(args[1], [])
+                    for subscriber in receivers:
+                        subscriber.write(b"*3\r\n" + self.bulk(b"message") + self.bulk(args[1]) + self.bulk(args[2]))
+                    writer.write(b":%d\r\n" % len(receivers))
+                elif command == b"SUBSCRIBE":
+                    self.subscribers.setdefault(args[1], []).append(writer)
+                    writer.write(b"*3\r\n" + self.bulk(b"subscribe") + self.bulk(args[1]) + b":1\r\n")
+                else:
+                    writer.write(b"-ERR unknown command\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writers.discard(writer)
+
+
+@pytest.fixture(autouse=True)
+def fast_reconnect(monkeypatch):
+    monkeypatch.setattr(main, "REDIS_RECONNECT_MIN", 0.01)
+    monkeypatch.setattr(main, "REDIS_RECONNECT_MAX", 0.05)
+
+
+async def until(predicate, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def test_rooms_and_channels():
+    async def scenario():
+        server = RespServer()
+        pubsub = main.RedisPubSub(await server.start())
+        await pubsub.start()
+        received = []
+
+        async def handler(data):
+            received.append(data)
+
+        await pubsub.subscribe("worker:a", handler)
+        await until(lambda: server.subscribers.get(b"worker:a"))
+        assert await pubsub.claim("room:ABC", "a", 60)
+        assert not await pubsub.claim("room:ABC", "b", 60)
+        assert await pubsub.lookup("room:ABC") == "a"
+        await pubsub.release("room:ABC", "b")  # Not b's to release
+        assert await pubsub.lookup("room:ABC") == "a"
+        await pubsub.release("room:ABC", "a")
+        assert await pubsub.lookup("room:ABC") is None
+        await pubsub.publish("worker:a", "hello")
+        await until(lambda: received == ["hello"])
+        await pubsub.close()
+        await server.close()
+
+    asyncio.run(scenario())
+
+
+def test_commands_in_flight_fail_when_the_connection_drops():
+    async def scenario():
+        server = RespServer()
+        pubsub = main.RedisPubSub(await server.start())
+        await pubsub.start()
+        server.stalled = True
+        lookup = asyncio.ensure_future(pubsub.lookup("room:ABC"))
+        await asyncio.sleep(0.05)
+        server.drop()
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(lookup, 2)
+        await pubsub.close()
+        await server.close()
+
+    asyncio.run(scenario())
+
+
+def test_reconnects_and_resubscribes():
+    async def scenario():
+        server = RespServer()
+        pubsub = main.RedisPubSub(await server.start())
+        await pubsub.start()
+        received = []
+
+        async def handler(data):
+            received.append(data)
+
+        await pubsub.subscribe("worker:a", handler)
+        await until(lambda: server.subscribers.get(b"worker:a"))
+        old_writer = pubsub.writer
+        server.drop()
+        # Back to normal once both connections are re-established
+        await until(lambda: pubsub.writer not in (None, old_writer) and server.subscribers.get(b"worker:a"))
+        assert await pubsub.claim("room:XYZ", "a", 60)
+        await pubsub.publish("worker:a", "after")
+        await until(lambda: received == ["after"])
+        await pubsub.close()
+        await server.close()
+
+    asyncio.run(scenario())
+
+
+class FrameSocket:
+    """The edge worker's client socket: keeps every frame as it would go on the wire."""
+
+    def __init__(self):
+        self.frames = []
+
+    async def send_text(self, data):
+        self.frames.append(data)
+
+    async def send_bytes(self, data):
+        self.frames.append(data)
+
+    async def close(self, code=1000):
+        pass
+
+
+def test_binary_frames_reach_players_on_another_worker_intact():
+    async def scenario():
+        server = RespServer()
+        url = await server.start()
+        owner = main.ShardRouter(main.RedisPubSub(url), "owner")
+        edge = main.ShardRouter(main.RedisPubSub(url), "edge")
+        for router in (owner, edge):
+            await router.start()
+        await until(lambda: server.subscribers.get(b"quizit:worker:edge"))
+
+        socket = FrameSocket()
+        player = main.User(socket, "relayed", {"name": "R", "lastName": "", "isTeacher": False}, main.MsgpackWire("quizit.msgpack"))
+        edge.edge_connections["edge:1"] = {"user": player}
+        remote = main.RemoteSocket(owner, "edge", "edge:1")
+        packed = main.msgpack.packb({"type": "scoreboard", "top": [["Ана", 3]], "blob": b"\xff\x00"})
+        await remote.send_bytes(packed)
+        await remote.send_text(main.encode({"type": "timer", "remaining_ms": 500}))
+        await until(lambda: len(socket.frames) == 2)
+        assert socket.frames[0] == packed
+        assert main.msgpack.unpackb(socket.frames[1]) == {"type": "timer", "remaining_ms": 500}
+
+        remote.pump.cancel()
+        player.stop()
+        for router in (owner, edge):
+            await router.close()
+        await server.close()
+
+    asyncio.run(scenario())
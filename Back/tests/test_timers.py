@@ -0,0 +1,36 @@
+"""TimerScheduler keeps its runner task on the loop that is serving the app."""
+
+import asyncio
+
+import main
+
+
+def test_timers_fire_after_the_app_moves_to_a_new_loop():
+    scheduler = main.TimerScheduler()
+
+    async def first_loop():
+        scheduler.start()
+        scheduler.schedule(60_000, lambda: None)  # Still pending when this loop goes away
+
+    async def second_loop():
+        fired = asyncio.Event()
+        scheduler.schedule(10, fired.set)
+        await asyncio.wait_for(fired.wait(), 1)
+        assert scheduler.task.get_loop() is asyncio.get_running_loop()
+        scheduler.stop()
+
+    asyncio.run(first_loop())
+    asyncio.run(second_loop())
+
+
+def test_stop_cancels_the_runner():
+    async def scenario():
+        scheduler = main.TimerScheduler()
+        scheduler.start()
+        task = scheduler.task
+        scheduler.stop()
+        await asyncio.sleep(0)
+        assert task.cancelled()
+        assert scheduler.task is None
+
+    asyncio.run(scenario())
@@ -1,10 +1,31 @@
 import React, { useEffect, useState } from 'react';
 import { useNavigate, useSearchParams } from 'react-router-dom';
-import { getDoc, getDocs, collection, doc } from 'firebase/firestore';
+import { getDoc, getDocs, collection, doc, query, orderBy, limit, startAfter } from 'firebase/firestore';
+import type { QueryDocumentSnapshot } from 'firebase/firestore';
 import { onAuthStateChanged } from 'firebase/auth';
 import { db, auth } from '@/lib/firebase';
 import { Button } from '@/components/ui/button';
-import { ArrowLeft, Clock, CheckCircle, XCircle, AlertTriangle, Users } from 'lucide-react';
+import { ArrowLeft, Clock, CheckCircle, XCircle, AlertTriangle, Users, BarChart3 } from 'lucide-react';
+import type { HomeworkStats } from '@/types/homework';
+
+const BACKEND_URL = 'https://thatisdreamer-quiz-it-back-1e40.twc1.net';
+// The summary comes from the stats document; the table only reads submissions a page at a time
+const SUBMISSIONS_PAGE_SIZE = 50;
+
+const EMPTY_STATS: HomeworkStats = {
+  submissions: 0,
+  completed: 0,
+  cheated: 0,
+  late: 0,
+  score_sum: 0,
+  percentage_sum: 0,
+  total_questions: 0,
+  max_score: 0,
+  questions: {},
+  updated_at: null,
+  average_score: 0,
+  average_percentage: 0
+};
 
 interface Answer {
   question_index: number;
@@ -54,9 +75,35 @@ const HomeworkDetails: React.FC = () => {
   
   const [homework, setHomework] = useState<HomeworkData | null>(null);
   const [submissions, setSubmissions] = useState<Submission[]>([]);
+  const [stats, setStats] = useState<HomeworkStats>(EMPTY_STATS);
   const [selectedSubmission, setSelectedSubmission] = useState<Submission | null>(null);
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState<string | null>(null);
+  const [lastSubmission, setLastSubmission] = useState<QueryDocumentSnapshot | null>(null);
+  const [hasMoreSubmissions, setHasMoreSubmissions] = useState(false);
+  const [loadingMore, setLoadingMore] = useState(false);
+
+  const fetchSubmissionsPage = async (after: QueryDocumentSnapshot | null) => {
+    const submissionsRef = collection(db, 'homework', homeworkId!, 'submissions');
+    const snapshot = await getDocs(after
+      ? query(submissionsRef, orderBy('submitted_at', 'desc'), startAfter(after), limit(SUBMISSIONS_PAGE_SIZE))
+      : query(submissionsRef, orderBy('submitted_at', 'desc'), limit(SUBMISSIONS_PAGE_SIZE)));
+    setLastSubmission(snapshot.docs[snapshot.docs.length - 1] ?? after);
+    setHasMoreSubmissions(snapshot.docs.length === SUBMISSIONS_PAGE_SIZE);
+    return snapshot.docs.map((submissionDoc) => submissionDoc.data() as Submission);
+  };
+
+  const loadMoreSubmissions = async () => {
+    setLoadingMore(true);
+    try {
+      const page = await fetchSubmissionsPage(lastSubmission);
+      setSubmissions(prev => [...prev, ...page]);
+    } catch (error) {
+      setError('Ошибка при загрузке результатов');
+    } finally {
+      setLoadingMore(false);
+    }
+  };
 
   useEffect(() => {
     const unsubscribe = onAuthStateChanged(auth, async (user) => {
@@ -98,20 +145,24 @@ const HomeworkDetails: React.FC = () => {
         const homeworkData = homeworkDoc.data() as HomeworkData;
         setHomework(homeworkData);
         
-        const submissionsSnapshot = await getDocs(collection(db, 'homework', homeworkId, 'submissions'));
-        const submissionsData: Submission[] = [];
-        
-        submissionsSnapshot.forEach((doc) => {
-          submissionsData.push(doc.data() as Submission);
-        });
-        
+        // The summary comes from the aggregate the backend keeps per homework (built on first request
+        // for homework submitted before it existed)
+        const idToken = await user.getIdToken();
+        const [statsResponse, submissionsData, studentSubmission] = await Promise.all([
+          fetch(`${BACKEND_URL}/homework/${homeworkId}/stats`, {
+            headers: { 'Authorization': `Bearer ${idToken}` }
+          }),
+          fetchSubmissionsPage(null),
+          studentId ? getDoc(doc(db, 'homework', homeworkId, 'submissions', studentId)) : Promise.resolve(null)
+        ]);
+        if (!statsResponse.ok) {
+          throw new Error(`Stats request failed with status ${statsResponse.status}`);
+        }
+        setStats(await statsResponse.json());
         setSubmissions(submissionsData);
         
-        if (studentId) {
-          const submission = submissionsData.find(s => s.student_id === studentId);
-          if (submission) {
-            setSelectedSubmission(submission);
-          }
+        if (studentSubmission?.exists()) {
+          setSelectedSubmission(studentSubmission.data() as Submission);
         }
         
       } catch (error) {
@@ -383,13 +434,13 @@ const HomeworkDetails: React.FC = () => {
 
         {/* Statistics */}
         <div className="bg-white rounded-lg shadow-md p-6 mb-6">
-          <div className="grid grid-cols-1 md:grid-cols-4 gap-6">
+          <div className="grid grid-cols-1 md:grid-cols-5 gap-6">
             <div>
               <div className="flex items-center">
                 <Users className="h-8 w-8 text-blue-600 mr-3" />
                 <div>
                   <p className="text-sm font-medium text-gray-600">Отправлено</p>
-                  <p className="text-2xl font-bold text-gray-900">{submissions.length}</p>
+                  <p className="text-2xl font-bold text-gray-900">{stats.submissions}</p>
                 </div>
               </div>
             </div>
@@ -400,7 +451,7 @@ const HomeworkDetails: React.FC = () => {
                 <div>
                   <p className="text-sm font-medium text-gray-600">Выполнено</p>
                   <p className="text-2xl font-bold text-green-600">
-                    {submissions.filter(s => s.status === 'completed').length}
+                    {stats.completed}
                   </p>
                 </div>
               </div>
@@ -412,7 +463,7 @@ const HomeworkDetails: React.FC = () => {
                 <div>
                   <p className="text-sm font-medium text-gray-600">С опозданием</p>
                   <p className="text-2xl font-bold text-yellow-600">
-                    {submissions.filter(s => s.is_late).length}
+                    {stats.late}
                   </p>
                 </div>
               </div>
@@ -424,7 +475,19 @@ const HomeworkDetails: React.FC = () => {
                 <div>
                   <p className="text-sm font-medium text-gray-600">Нарушения</p>
                   <p className="text-2xl font-bold text-red-600">
-                    {submissions.filter(s => s.status === 'cheated').length}
+                    {stats.cheated}
+                  </p>
+                </div>
+              </div>
+            </div>
+
+            <div>
+              <div className="flex items-center">
+                <BarChart3 className="h-8 w-8 text-purple-600 mr-3" />
+                <div>
+                  <p className="text-sm font-medium text-gray-600">Средний балл</p>
+                  <p className="text-2xl font-bold text-purple-600">
+                    {(stats.average_score ?? 0).toFixed(1)}/{stats.max_score} ({Math.round(stats.average_percentage ?? 0)}%)
                   </p>
                 </div>
               </div>
@@ -432,6 +495,33 @@ const HomeworkDetails: React.FC = () => {
           </div>
         </div>
 
+        {/* Per-question correctness */}
+        {stats.submissions > 0 && (
+          <div className="bg-white rounded-lg shadow-md p-6 mb-6">
+            <h2 className="text-lg font-semibold text-gray-900 mb-4">Ответы по вопросам</h2>
+            <div className="space-y-2">
+              {Array.from({ length: stats.total_questions }, (_, index) => {
+                const counts = stats.questions[String(index)] || {};
+                const correct = counts.correct || 0;
+                return (
+                  <div key={index} className="flex items-center gap-4 text-sm">
+                    <span className="w-24 font-medium text-gray-900">Вопрос {index + 1}</span>
+                    <div className="flex-1 bg-gray-100 rounded-full h-3 overflow-hidden">
+                      <div
+                        className="bg-green-500 h-3"
+                        style={{ width: `${Math.round((correct / stats.submissions) * 100)}%` }}
+                      />
+                    </div>
+                    <span className="text-green-600">✅ {correct}</span>
+                    <span className="text-red-600">❌ {counts.wrong || 0}</span>
+                    <span className="text-yellow-600">⏱️ {counts.missed || 0}</span>
+                  </div>
+                );
+              })}
+            </div>
+          </div>
+        )}
+
         {/* Students List */}
         <div className="bg-white rounded-lg shadow-md overflow-hidden">
           <div className="px-6 py-4 border-b border-gray-200">
@@ -518,6 +608,13 @@ const HomeworkDetails: React.FC = () => {
               </tbody>
             </table>
           </div>
+          {hasMoreSubmissions && (
+            <div className="px-6 py-4 border-t border-gray-200 text-center">
+              <Button variant="outline" onClick={loadMoreSubmissions} disabled={loadingMore}>
+                {loadingMore ? 'Загрузка...' : 'Показать ещё'}
+              </Button>
+            </div>
+          )}
         </div>
       </div>
     </div>
@@ -1,13 +1,15 @@
 import React, { useEffect, useState } from 'react';
 import { useSearchParams, useNavigate } from 'react-router-dom';
 import { onAuthStateChanged } from 'firebase/auth';
-import { getDoc, doc, setDoc, serverTimestamp } from 'firebase/firestore';
+import { getDoc, doc } from 'firebase/firestore';
 import { auth, db } from '@/lib/firebase';
 import { Button } from '@/components/ui/button';
 import { GraduationCap, Clock, Play, ArrowRight, CheckCircle, XCircle, AlertTriangle, Timer } from 'lucide-react';
 import type { Homework } from '@/types/homework';
 import QuizHomeworkContent from '@/components/QuizHomeworkContent';
 
+const BACKEND_URL = 'https://thatisdreamer-quiz-it-back-1e40.twc1.net';
+
 interface QuizQuestion {
   question: string;
   type: string;
@@ -347,6 +349,30 @@ const HomeworkQuiz: React.FC = () => {
     setCurrentQuiestion(questionNumber);
   };
 
+  // Grading happens on the server, which also keeps the homework's aggregated stats up to date
+  const postSubmission = async (status: 'completed' | 'cheated', violationReason?: string) => {
+    const idToken = await auth.currentUser?.getIdToken();
+    if (!idToken) {
+      throw new Error('Not signed in');
+    }
+    const response = await fetch(`${BACKEND_URL}/homework/${homeworkId}/submissions`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json', 'Authorization': `Bearer ${idToken}` },
+      body: JSON.stringify({
+        student_name: userName,
+        answers: (state.quiz?.questions || []).map((_, index) => answers[index] ?? null),
+        tab_switches: tabSwitches,
+        time_started: timeStarted ? timeStarted.toISOString() : null,
+        status,
+        violation_reason: violationReason
+      })
+    });
+    if (!response.ok) {
+      throw new Error(`Submission failed with status ${response.status}`);
+    }
+    return response.json();
+  };
+
   const handleLockdownViolation = async () => {
     if (!homeworkId || !userUid || !userName || !state.homework || !state.quiz || autoSubmitted) {
       return;
@@ -356,60 +382,7 @@ const HomeworkQuiz: React.FC = () => {
     setIsSubmitting(true);
 
     try {
-      const timeCompleted = new Date();
-      const timeTakenSeconds = timeStarted 
-        ? Math.floor((timeCompleted.getTime() - timeStarted.getTime()) / 1000)
-        : 0;
-
-      const deadline = state.homework.deadline?.toDate 
-        ? state.homework.deadline.toDate() 
-        : new Date(state.homework.deadline);
-      const isLate = timeCompleted > deadline;
-
-      const totalQuestions = state.quiz.questions.length;
-
-      const detailedAnswers = state.quiz.questions.map((question, index) => {
-        const defaultAnswer = question.type === 'text' ? '' : [];
-        return {
-          question_index: index,
-          question_text: question.question,
-          student_answer: answers[index] !== undefined ? answers[index] : defaultAnswer,
-          correct_answer: question.type === 'text' ? (question.textAnswer || question.correct) : question.correct,
-          is_correct: false,
-          points_earned: 0,
-          max_points: question.point,
-          question_type: question.type
-        };
-      });
-
-      const submission = {
-        student_id: userUid,
-        student_name: userName,
-        submitted_at: serverTimestamp(),
-        score: 0,
-        max_score: state.quiz.questions.reduce((sum, q) => sum + q.point, 0),
-        total_questions: totalQuestions,
-        correct_answers: 0,
-        wrong_answers: 0,
-        missed_answers: totalQuestions,
-        percentage: 0,
-        is_late: isLate,
-        tab_switches: tabSwitches,
-        answers: detailedAnswers,
-        status: 'cheated',
-        time_started: timeStarted,
-        time_completed: serverTimestamp(),
-        time_taken_seconds: timeTakenSeconds,
-        time_limit_seconds: state.homework.time_limit_minutes 
-          ? state.homework.time_limit_minutes * 60 
-          : null,
-        violation_reason: 'Выход из полноэкранного режима в режиме блокировки'
-      };
-
-      await setDoc(
-        doc(db, 'homework', homeworkId, 'submissions', userUid),
-        submission
-      );
+      await postSubmission('cheated', 'Выход из полноэкранного режима в режиме блокировки');
 
       
       alert('⚠️ НАРУШЕНИЕ РЕЖИМА БЛОКИРОВКИ!\n\nВы вышли из полноэкранного режима.\nКвиз автоматически завершен с результатом 0 баллов.\n\nВаш преподаватель будет уведомлен о нарушении.');
@@ -434,98 +407,7 @@ const HomeworkQuiz: React.FC = () => {
     setIsSubmitting(true);
 
     try {
-      const timeCompleted = new Date();
-      const timeTakenSeconds = timeStarted 
-        ? Math.floor((timeCompleted.getTime() - timeStarted.getTime()) / 1000)
-        : 0;
-
-      let score = 0;
-      let correctAnswers = 0;
-      let wrongAnswers = 0;
-      let missedAnswers = 0;
-
-      const detailedAnswers = state.quiz.questions.map((question, index) => {
-        const defaultAnswer = question.type === 'text' ? '' : [];
-        const studentAnswer = answers[index] !== undefined ? answers[index] : defaultAnswer;
-        
-        let isCorrect = false;
-        let hasAnswer = false;
-        
-        if (question.type === 'text') {
-          // For text questions, compare strings (case-insensitive)
-          const studentText = typeof studentAnswer === 'string' ? studentAnswer.trim().toLowerCase() : '';
-          const correctText = (question.textAnswer || question.correct || '').toString().trim().toLowerCase();
-          hasAnswer = studentText.length > 0;
-          isCorrect = hasAnswer && studentText === correctText;
-        } else {
-          // For choice questions, compare arrays
-          hasAnswer = Array.isArray(studentAnswer) && studentAnswer.length > 0;
-          if (hasAnswer && Array.isArray(studentAnswer)) {
-            isCorrect = studentAnswer.length === question.correct.length &&
-              studentAnswer.every((ans: number) => question.correct.includes(ans));
-          }
-        }
-        
-        if (!hasAnswer) {
-          missedAnswers++;
-        } else if (isCorrect) {
-          correctAnswers++;
-          score += question.point;
-        } else {
-          wrongAnswers++;
-        }
-
-        return {
-          question_index: index,
-          question_text: question.question,
-          student_answer: studentAnswer,
-          correct_answer: question.type === 'text' ? (question.textAnswer || question.correct) : question.correct,
-          is_correct: isCorrect,
-          points_earned: isCorrect ? question.point : 0,
-          max_points: question.point,
-          question_type: question.type
-        };
-      });
-
-      const totalQuestions = state.quiz.questions.length;
-      const percentage = totalQuestions > 0 
-        ? Math.round((correctAnswers / totalQuestions) * 100) 
-        : 0;
-
-      const deadline = state.homework.deadline?.toDate 
-        ? state.homework.deadline.toDate() 
-        : new Date(state.homework.deadline);
-      const isLate = timeCompleted > deadline;
-
-      const maxScore = state.quiz.questions.reduce((sum, q) => sum + q.point, 0);
-
-      const submission = {
-        student_id: userUid,
-        student_name: userName,
-        submitted_at: serverTimestamp(),
-        score: score,
-        max_score: maxScore,
-        total_questions: totalQuestions,
-        correct_answers: correctAnswers,
-        wrong_answers: wrongAnswers,
-        missed_answers: missedAnswers,
-        percentage: percentage,
-        is_late: isLate,
-        tab_switches: tabSwitches,
-        answers: detailedAnswers,
-        status: 'completed',
-        time_started: timeStarted,
-        time_completed: serverTimestamp(),
-        time_taken_seconds: timeTakenSeconds,
-        time_limit_seconds: state.homework.time_limit_minutes 
-          ? state.homework.time_limit_minutes * 60 
-          : null
-      };
-
-      await setDoc(
-        doc(db, 'homework', homeworkId, 'submissions', userUid),
-        submission
-      );
+      const result = await postSubmission('completed');
 
       
       // Helper function to exit fullscreen (cross-browser)
@@ -556,7 +438,7 @@ const HomeworkQuiz: React.FC = () => {
         }
       }
       
-      alert(`Квиз успешно отправлен!\n\nВаш результат:\n${correctAnswers} из ${totalQuestions} правильных ответов\nБаллы: ${score} из ${maxScore}\nПроцент: ${percentage}%`);
+      alert(`Квиз успешно отправлен!\n\nВаш результат:\n${result.correct_answers} из ${result.total_questions} правильных ответов\nБаллы: ${result.score} из ${result.max_score}\nПроцент: ${result.percentage}%`);
       
       navigate('/');
     } catch (error) {
@@ -1,4 +1,4 @@
-import React, { useEffect, useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import { useSearchParams, useNavigate } from 'react-router-dom';
 import { doc, getDoc, collection, getDocs } from 'firebase/firestore';
 import { onAuthStateChanged } from 'firebase/auth';
@@ -10,6 +10,9 @@ import QuizContent from '@/components/QuizContent';
 import RoundResults from '@/components/RoundResults';
 import GameResults from '@/components/GameResults';
 
+// A players_snapshot request can be rate-limited or its reply lost; ask again after this long
+const SNAPSHOT_RETRY_MS = 3000;
+
 interface Question {
   id: string;
   question: string;
@@ -81,6 +84,12 @@ const HostQuiz: React.FC = () => {
   const [roundResults, setRoundResults] = useState<RoundResultsData | null>(null);
   const [currentQuestionNumber, setCurrentQuestionNumber] = useState(0);
   const [gameResults, setGameResults] = useState<GameResultsData | null>(null);
+  // Players by id and the last membership sequence number applied (server sends deltas)
+  const membersRef = useRef<Map<string, string>>(new Map());
+  const membersSeqRef = useRef(0);
+  // Set while a requested players_snapshot is on its way; deltas before it are already in it
+  const snapshotPendingRef = useRef(false);
+  const snapshotRetryRef = useRef<ReturnType<typeof setTimeout> | null>(null);
 
   const quizId = searchParams.get('id');
   const groupId = searchParams.get('group');
@@ -90,6 +99,23 @@ const HostQuiz: React.FC = () => {
 
   useEffect(() => {
     const websocket = new WebSocket('wss://thatisdreamer-quiz-it-back-1e40.twc1.net/ws');
+
+    const clearSnapshotRetry = () => {
+      if (snapshotRetryRef.current) {
+        clearTimeout(snapshotRetryRef.current);
+        snapshotRetryRef.current = null;
+      }
+    };
+
+    const requestSnapshot = () => {
+      snapshotPendingRef.current = true;
+      clearSnapshotRetry();
+      if (websocket.readyState !== WebSocket.OPEN) {
+        return;
+      }
+      websocket.send(JSON.stringify({ players_snapshot: true }));
+      snapshotRetryRef.current = setTimeout(requestSnapshot, SNAPSHOT_RETRY_MS);
+    };
     
     websocket.onopen = () => {
       setWsConnected(true);
@@ -100,8 +126,33 @@ const HostQuiz: React.FC = () => {
       try {
         const message = JSON.parse(event.data);
         
-        if (message.players !== undefined) {
-          setPlayers(message.players || []);
+        if (message.type === 'players_snapshot') {
+          membersRef.current = new Map(
+            (message.players || []).map((p: { id: string; username: string }) => [p.id, p.username])
+          );
+          membersSeqRef.current = message.seq;
+          snapshotPendingRef.current = false;
+          clearSnapshotRetry();
+          setPlayers(Array.from(membersRef.current.values()));
+          return;
+        }
+
+        if (message.type === 'player_joined' || message.type === 'player_left') {
+          if (snapshotPendingRef.current) {
+            return;
+          }
+          if (message.seq !== membersSeqRef.current + 1) {
+            // Missed a delta: ask for the full list instead of guessing, and keep asking until it comes
+            requestSnapshot();
+            return;
+          }
+          membersSeqRef.current = message.seq;
+          if (message.type === 'player_joined') {
+            message.joined.forEach((p: { id: string; username: string }) => membersRef.current.set(p.id, p.username));
+          } else {
+            message.left.forEach((p: { id: string }) => membersRef.current.delete(p.id));
+          }
+          setPlayers(Array.from(membersRef.current.values()));
           return;
         }
         
@@ -117,6 +168,10 @@ const HostQuiz: React.FC = () => {
           case 'welcome':
             break;
             
+          case 'ping':
+            websocket.send(JSON.stringify({ type: 'pong' }));
+            break;
+            
           case 'auth_attempt':
             break;
             
@@ -134,6 +189,12 @@ const HostQuiz: React.FC = () => {
           case 'creating_game':
             break;
             
+          case 'timer':
+            // The host paused or extended the question
+            setTimeLeft(Math.ceil(message.remaining_ms / 1000));
+            setTimerActive(!message.paused);
+            break;
+            
           case 'round_results':
             setRoundResults(message.data);
             setCurrentQuestion(null); 
@@ -170,6 +231,10 @@ const HostQuiz: React.FC = () => {
       setAuthSuccess(false);
       setQuizCreated(false);
       setPlayers([]);
+      membersRef.current = new Map();
+      membersSeqRef.current = 0;
+      snapshotPendingRef.current = false;
+      clearSnapshotRetry();
       setQuizStarted(false);
       setCurrentQuestion(null);
       setTimeLeft(0);
@@ -184,6 +249,7 @@ const HostQuiz: React.FC = () => {
     };
 
     return () => {
+      clearSnapshotRetry();
       websocket.close();
     };
   }, []);
@@ -1,7 +1,7 @@
 import React, { useEffect, useState, useCallback } from 'react';
 import { useSearchParams, useNavigate } from 'react-router-dom';
 import { onAuthStateChanged } from 'firebase/auth';
-import { getDoc, doc, collection, query, where, getDocs } from 'firebase/firestore';
+import { getDoc, doc } from 'firebase/firestore';
 import { auth, db } from '@/lib/firebase';
 import { Button } from '@/components/ui/button';
 import { GraduationCap, Users, Clock, Play, ArrowRight } from 'lucide-react';
@@ -16,6 +16,8 @@ interface QuestionData {
   textAnswer?: string;
 }
 
+const RESUME_TOKEN_KEY = 'quizit_resume_token';
+
 const PlayQuiz: React.FC = () => {
   const [searchParams] = useSearchParams();
   const navigate = useNavigate();
@@ -79,6 +81,10 @@ const PlayQuiz: React.FC = () => {
           case 'welcome':
             break;
             
+          case 'ping':
+            websocket.send(JSON.stringify({ type: 'pong' }));
+            break;
+            
           case 'auth_attempt':
             break;
             
@@ -87,6 +93,13 @@ const PlayQuiz: React.FC = () => {
             break;
             
           case 'joined':
+          case 'resumed':
+            if (message.type === 'resumed') {
+              setAuthSuccess(true);
+            }
+            if (message.resume_token) {
+              sessionStorage.setItem(RESUME_TOKEN_KEY, message.resume_token);
+            }
             setGameJoined(true);
             if (message.game_settings?.mode) {
               setGameMode(message.game_settings.mode);
@@ -99,6 +112,12 @@ const PlayQuiz: React.FC = () => {
             }
             break;
             
+          case 'resume_failed':
+            // Seat expired: authenticate and join from scratch
+            sessionStorage.removeItem(RESUME_TOKEN_KEY);
+            setAuthSent(false);
+            break;
+            
           case 'game_joined':
             setGameJoined(true);
             break;
@@ -107,9 +126,16 @@ const PlayQuiz: React.FC = () => {
             alert('Игра с таким кодом не найдена');
             break;
             
+          case 'timer':
+            // The host paused or extended the question
+            setTimeLeft(Math.ceil(message.remaining_ms / 1000));
+            setTimerActive(!message.paused);
+            break;
+            
           case 'round_ended':
-            let placement: number | undefined;
-            if (message.scoreboard) {
+            let placement: number | undefined = message.rank;
+            // Older servers sent the whole scoreboard and no rank
+            if (placement === undefined && message.scoreboard) {
               const sortedPlayers = Object.entries(message.scoreboard)
                 .sort(([,a], [,b]) => ((b as [string, number])[1]) - ((a as [string, number])[1]));
               
@@ -134,6 +160,7 @@ const PlayQuiz: React.FC = () => {
             break;
             
           case 'game_finished':
+            sessionStorage.removeItem(RESUME_TOKEN_KEY);
             setGameFinished({
               placement: message.placement,
               score: message.score,
@@ -142,13 +169,14 @@ const PlayQuiz: React.FC = () => {
             setCurrentQuestion(null);
             setRoundResult(null);
             setTimerActive(false);
-            // Find gameId by game code
-            if (gameCode || gameCodeParam) {
-              findGameIdByCode(gameCode || gameCodeParam || '');
+            // Room codes are reused once a game is over, so the results link goes by game id
+            if (message.game_id) {
+              setFinishedGameId(message.game_id);
             }
             break;
             
           case 'kicked':
+            sessionStorage.removeItem(RESUME_TOKEN_KEY);
             setIsKicked(true);
             setKickReason(message.message || 'Вы были удалены из игры');
             setCurrentQuestion(null);
@@ -190,7 +218,9 @@ const PlayQuiz: React.FC = () => {
 
   useEffect(() => {
     if (wsConnected && ws && !authSent && userUid) {
-      const authMessage = { user_id: userUid };
+      // A resume token from this tab takes us straight back to our seat in a running game
+      const resumeToken = sessionStorage.getItem(RESUME_TOKEN_KEY);
+      const authMessage = resumeToken ? { resume: resumeToken } : { user_id: userUid };
       ws.send(JSON.stringify(authMessage));
       setAuthSent(true);
     }
@@ -409,22 +439,6 @@ const PlayQuiz: React.FC = () => {
     return () => unsubscribe();
   }, [navigate]);
 
-  const findGameIdByCode = async (code: string) => {
-    try {
-      const gamesQuery = query(
-        collection(db, 'games'),
-        where('code', '==', code.toUpperCase()),
-        where('game_finished', '==', true)
-      );
-      const gamesSnapshot = await getDocs(gamesQuery);
-      if (!gamesSnapshot.empty) {
-        setFinishedGameId(gamesSnapshot.docs[0].id);
-      }
-    } catch (error) {
-    
-    }
-  };
-
   const handleCodeSubmit = () => {
     if (codeInput.trim()) {
       setGameCode(codeInput.trim());
@@ -47,6 +47,22 @@ export interface HomeworkSubmission {
   violation_reason?: string;     // Причина нарушения (если status = 'cheated')
 }
 
+// Сводная статистика по заданию (homework_stats/{homework_id}), ведётся сервером при каждой сдаче
+export interface HomeworkStats {
+  submissions: number;           // Всего сдано
+  completed: number;             // Выполнено
+  cheated: number;               // Нарушения режима
+  late: number;                  // Сдано после дедлайна
+  score_sum: number;             // Сумма баллов
+  percentage_sum: number;        // Сумма процентов
+  total_questions: number;
+  max_score: number;
+  questions: Record<string, { correct?: number; wrong?: number; missed?: number }>; // По номеру вопроса
+  updated_at: any;
+  average_score?: number;        // Только в ответе GET /homework/{id}/stats
+  average_percentage?: number;
+}
+
 export interface Group {
   id: string;
   name: string;